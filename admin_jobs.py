@@ -0,0 +1,396 @@
+"""
+Tareas en segundo plano de las operaciones largas del panel
+
+Cada manejador recibe el JobContext de job_queue.py y el payload con el que
+se encoló. Trabajan por lotes confirmados para no mantener transacciones
+enormes, informan del progreso entre lotes y son reanudables: si un intento
+se interrumpe, el siguiente continúa con lo que quede.
+"""
+
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from models import BackgroundJob, DownloadLog, FileBlob, GameFile, GameVersion, PackageBuild, UpdatePackage, db
+from job_queue import ACTIVE_STATUSES, JobCancelled, enqueue, job_handler
+from manifest_cache import invalidate_manifest
+import blob_store
+import log_dictionary
+import log_partitions
+import patch_builder
+import rollups
+import sketches
+import utils
+
+
+def _batch_size():
+    return current_app.config.get('JOB_BATCH_SIZE', 1000)
+
+
+# ==================== VERSIONES ====================
+
+@job_handler('delete_version', title='Eliminar versión')
+def delete_version(context, version_id):
+    """
+    Eliminar una versión con todos sus archivos, parches y paquetes.
+
+    Las filas de GameFile se borran por lotes; tras cada lote se reenlaza la
+    vista plana de esos nombres y se purgan los blobs que quedaron sin
+    referencias. Una vez empezado el borrado ya no se puede cancelar.
+    """
+    version = db.session.get(GameVersion, version_id)
+    if version is None:
+        return {'version_id': version_id, 'deleted_files': 0}
+    if version.is_latest:
+        raise ValueError("No se puede eliminar la versión actual")
+
+    name, version_key = version.version, version.version_key
+    total = db.session.query(db.func.count(GameFile.id)).filter(GameFile.version_id == version_id).scalar()
+    context.progress(0, total, f'Eliminando archivos de {name}', force=True)
+    context.cancellable = False
+
+    deleted = 0
+    batch_size = _batch_size()
+    while True:
+        rows = db.session.query(GameFile.id, GameFile.md5_hash, GameFile.filename).filter(
+            GameFile.version_id == version_id
+        ).order_by(GameFile.id).limit(batch_size).all()
+        if not rows:
+            break
+
+        deltas = Counter()
+        for row in rows:
+            deltas[row.md5_hash] -= 1
+        blob_store.apply_ref_deltas(deltas, {})
+        GameFile.query.filter(GameFile.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+
+        blob_store.refresh_flat_views({row.filename for row in rows})
+        blob_store.purge_unreferenced(list(deltas))
+        deleted += len(rows)
+        context.progress(deleted, total)
+
+    # Construcciones (un build en curso se aborta), parches y paquetes de la versión
+    context.progress(message='Eliminando paquetes y parches', force=True)
+    PackageBuild.query.filter(db.or_(
+        PackageBuild.version_id == version_id, PackageBuild.from_version_id == version_id
+    )).delete(synchronize_session=False)
+    patch_builder.delete_version_patches(version_id)
+
+    package_paths = []
+    for update_package in UpdatePackage.query.filter_by(version_id=version_id).all():
+        package_paths.append(update_package.file_path)
+        db.session.delete(update_package)
+
+    db.session.delete(version)
+    db.session.commit()
+    for path in package_paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+    patch_builder.purge_orphan_patches()
+    invalidate_manifest()
+
+    # La versión siguiente pasa a compararse con la anterior a la eliminada
+    following = GameVersion.query.filter(
+        GameVersion.version_key > version_key
+    ).order_by(GameVersion.version_key).first() if version_key is not None else None
+    if following is not None:
+        patch_builder.schedule_patches(following)
+
+    current_app.logger.info(f"Versión {name} eliminada en segundo plano ({deleted} archivos)")
+    return {'version_id': version_id, 'version': name, 'deleted_files': deleted}
+
+
+@job_handler('import_archive', max_attempts=2, title='Importar build')
+def import_archive(context, version_id, archive_path, strip_root=False, replace=False):
+    """Importar un build en ZIP ya subido a blobs/tmp; el ZIP se borra al terminar"""
+    from ingest import ingest_archive
+
+    def report(stage, done=None, total=None):
+        context.progress(done, total, stage)
+
+    finished = False
+    try:
+        version = db.session.get(GameVersion, version_id)
+        if version is None:
+            finished = True
+            raise ValueError(f"La versión {version_id} ya no existe")
+        if not os.path.exists(archive_path):
+            finished = True
+            raise FileNotFoundError("El ZIP subido ya no está disponible")
+
+        result = ingest_archive(version_id, archive_path, strip_root=strip_root, replace=replace,
+                                progress=report)
+        finished = True
+    except JobCancelled:
+        finished = True
+        raise
+    finally:
+        # Se conserva para el siguiente intento salvo que este sea el último
+        if (finished or context.last_attempt) and os.path.exists(archive_path):
+            os.remove(archive_path)
+
+    invalidate_manifest()
+    patch_builder.schedule_version_patches(version)
+    return dict(result.to_dict(), version=version.version)
+
+
+# ==================== LOGS ====================
+
+@job_handler('cleanup_logs', title='Limpiar logs')
+def cleanup_logs(context, days):
+    """
+    Eliminar los logs de descarga anteriores a `days` días.
+
+    Con la tabla particionada los meses completos se eliminan de golpe; lo
+    que quede antes del corte (el mes que lo contiene) se borra por lotes
+    confirmados recorriendo (created_at, id).
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    context.progress(message=f'Eliminando particiones anteriores a {days} días', force=True)
+    dropped = log_partitions.drop_partitions_before(cutoff)
+
+    context.progress(0, 0, f'Eliminando logs anteriores a {days} días', force=True)
+
+    deleted = 0
+    batch_size = current_app.config.get('JOB_LOG_BATCH_SIZE', 10000)
+    while True:
+        rows = db.session.query(DownloadLog.id, DownloadLog.created_at).filter(
+            DownloadLog.created_at < cutoff
+        ).order_by(DownloadLog.created_at, DownloadLog.id).limit(batch_size).all()
+        if not rows:
+            break
+        # El rango de fechas del lote acota el borrado a sus particiones y al índice
+        deleted += DownloadLog.query.filter(
+            DownloadLog.created_at.between(rows[0].created_at, rows[-1].created_at),
+            DownloadLog.id.in_([row.id for row in rows])
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        context.progress(deleted, message=f'{deleted} logs eliminados')
+
+    # El día que contiene el corte conserva su sketch diario
+    sketches.prune_sketches(rollups.bucket_start(cutoff, 'day'))
+    db.session.commit()
+
+    dropped_rows = sum(count for _, count in dropped)
+    current_app.logger.info(f"Eliminados {deleted} logs y {len(dropped)} particiones "
+                            f"(~{dropped_rows} logs) anteriores a {days} días")
+    return {'days': days, 'deleted': deleted,
+            'dropped_partitions': [name for name, _ in dropped], 'dropped_rows': dropped_rows}
+
+
+@job_handler('compact_download_logs', title='Compactar logs de descarga')
+def compact_download_logs(context):
+    """
+    Pasar las filas históricas de launcher_download_log al formato compacto.
+
+    Recorre (created_at, id) en orden por lotes de JOB_LOG_BATCH_SIZE: cada
+    lote se codifica con los diccionarios y se actualiza en una sola
+    sentencia ejecutada por filas. Es reanudable: solo toca filas sin file_id.
+    """
+    table = DownloadLog.__table__
+    pending = table.c.file_id.is_(None)
+    total = db.session.query(db.func.count(table.c.id)).filter(pending).scalar()
+    context.progress(0, total, 'Compactando logs de descarga', force=True)
+
+    update = table.update().where(
+        table.c.id == db.bindparam('b_id'), table.c.created_at == db.bindparam('b_created_at')
+    )
+    converted = 0
+    cursor = None
+    batch_size = current_app.config.get('JOB_LOG_BATCH_SIZE', 10000)
+    while True:
+        query = db.select(
+            table.c.id, table.c.created_at, table.c.ip_address, table.c.user_agent,
+            table.c.file_requested, table.c.file_type, table.c.success
+        ).where(pending)
+        if cursor is not None:
+            query = query.where(db.or_(
+                table.c.created_at > cursor[0],
+                db.and_(table.c.created_at == cursor[0], table.c.id > cursor[1])
+            ))
+        rows = db.session.execute(query.order_by(table.c.created_at, table.c.id).limit(batch_size)).all()
+        if not rows:
+            break
+
+        encoded = log_dictionary.encode_records([row._asdict() for row in rows])
+        for row, values in zip(rows, encoded):
+            del values['created_at'], values['success']
+            values['b_id'] = row.id
+            values['b_created_at'] = row.created_at
+        db.session.execute(update, encoded)
+        db.session.commit()
+
+        cursor = (rows[-1].created_at, rows[-1].id)
+        converted += len(rows)
+        context.progress(converted, max(total, converted))
+
+    current_app.logger.info(f"{converted} logs de descarga pasados al formato compacto")
+    enqueue_legacy_split(check_compaction=False)  # esta compactación es la que está terminando
+    return {'converted': converted}
+
+
+@job_handler('maintain_log_partitions', title='Crear particiones de logs')
+def maintain_log_partitions(context, months_ahead=2):
+    """Crear por adelantado las particiones mensuales de los logs (solo PostgreSQL)"""
+    created = log_partitions.ensure_partitions(months_ahead)
+    enqueue_legacy_split()
+    return {'created': created}
+
+
+def enqueue_legacy_split(check_compaction=True):
+    """
+    Encolar split_legacy_log_partition si queda partición legacy y no hay una
+    compactación de logs pendiente (la compactación la encola al terminar)
+    """
+    if log_partitions.legacy_partition() is None:
+        return None
+    if check_compaction and db.session.query(BackgroundJob.id).filter(
+        BackgroundJob.kind == 'compact_download_logs', BackgroundJob.status.in_(ACTIVE_STATUSES)
+    ).first() is not None:
+        return None
+    return enqueue('split_legacy_log_partition', idempotency_key='split_legacy_log_partition')
+
+
+@job_handler('split_legacy_log_partition', title='Repartir logs históricos por mes')
+def split_legacy_log_partition(context):
+    """
+    Repartir la partición legacy de la conversión en particiones mensuales,
+    del mes más antiguo al más reciente (cada mes se confirma por separado,
+    así que es reanudable). Solo se reparten meses cerrados; el resto lo
+    encola más adelante maintain_log_partitions. Se encola con
+    enqueue_legacy_split(), nunca durante una compactación de logs.
+    """
+    legacy = log_partitions.legacy_partition()
+    if legacy is None:
+        return {'created': []}
+
+    oldest = db.session.execute(db.text(f'SELECT min(created_at) FROM {log_partitions.LEGACY_TABLE}')).scalar()
+    total = 0
+    month = oldest
+    while month is not None and month < legacy.upper:
+        total += 1
+        month = log_partitions.next_month(month)
+
+    created = []
+    context.progress(0, total, 'Repartiendo logs históricos', force=True)
+    while True:
+        name = log_partitions.split_legacy_month()
+        if name is None:
+            break
+        created.append(name)
+        context.progress(len(created), max(total, len(created)), name)
+    return {'created': created}
+
+
+@job_handler('rebuild_rollups', title='Recalcular estadísticas')
+def rebuild_rollups(context, days=0, include_today=False, include_rollups=True, include_sketches=True):
+    """
+    Recalcular los agregados y los sketches de descargas día a día (cada día
+    se confirma por separado). Por defecto solo se tocan días cerrados, que ya
+    no reciben incrementos del registro de descargas ni volcados de sketches;
+    con `include_today` se recalcula también el de hoy, lo que puede contar dos
+    veces lo que se registre mientras tanto.
+    `include_rollups` / `include_sketches` limitan qué se recalcula.
+    """
+    end = datetime.utcnow()
+    if days > 0:
+        start = end - timedelta(days=days)
+    else:
+        start = db.session.query(db.func.min(DownloadLog.created_at)).scalar()
+        if start is None:
+            return {'processed': 0}
+    if not include_today:
+        end = rollups.bucket_start(end, 'day') - timedelta(days=1)
+
+    day = rollups.bucket_start(start, 'day')
+    total = max(0, (rollups.bucket_start(end, 'day') - day).days + 1)
+    processed = 0
+    for index in range(total):
+        if include_rollups:
+            processed += rollups.backfill_rollups(start=day, end=day)
+        if include_sketches:
+            count = sketches.backfill_sketches(start=day, end=day)
+            if not include_rollups:
+                processed += count
+        day += timedelta(days=1)
+        context.progress(index + 1, total, f'{processed} logs procesados')
+
+    return {'days': total, 'processed': processed}
+
+
+# ==================== MANTENIMIENTO ====================
+
+@job_handler('rotate_backups', title='Rotar backups')
+def rotate_backups(context, max_age_days=30):
+    """Eliminar los backups con más de `max_age_days` días"""
+    backup_dir = current_app.config.get('BACKUP_FOLDER') or os.path.join(
+        current_app.config['UPLOAD_FOLDER'], 'backups')
+    deleted = utils.cleanup_old_backups(backup_dir, max_age_days=max_age_days)
+    if deleted:
+        current_app.logger.info(f"Eliminados {deleted} backups con más de {max_age_days} días")
+    return {'backup_dir': backup_dir, 'deleted': deleted}
+
+
+@job_handler('integrity_scan', max_attempts=1, title='Verificar integridad')
+def integrity_scan(context, verify_hash=False):
+    """
+    Comprobar que cada blob registrado existe en disco con su tamaño y, con
+    `verify_hash`, que su MD5 coincide. También cuenta los ref_count que no
+    coinciden con las filas de GameFile. No corrige nada: solo informa.
+    """
+    total = db.session.query(db.func.count(FileBlob.md5_hash)).scalar()
+    context.progress(0, total, 'Verificando blobs', force=True)
+
+    missing, wrong_size, corrupt = [], [], []
+    checked = 0
+    last_hash = ''
+    batch_size = _batch_size()
+    while True:
+        blobs = db.session.query(FileBlob.md5_hash, FileBlob.file_size).filter(
+            FileBlob.md5_hash > last_hash
+        ).order_by(FileBlob.md5_hash).limit(batch_size).all()
+        if not blobs:
+            break
+
+        for md5_hash, file_size in blobs:
+            path = blob_store.blob_path(md5_hash)
+            if path is None or not os.path.exists(path):
+                missing.append(md5_hash)
+            elif os.path.getsize(path) != file_size:
+                wrong_size.append(md5_hash)
+            elif verify_hash and utils.calculate_file_hash(path) != md5_hash:
+                corrupt.append(md5_hash)
+            checked += 1
+            context.progress(checked, max(total, checked))
+        last_hash = blobs[-1].md5_hash
+        db.session.rollback()  # sin transacciones largas de solo lectura
+
+    references = db.session.query(
+        GameFile.md5_hash, db.func.count(GameFile.id).label('refs')
+    ).group_by(GameFile.md5_hash).subquery()
+    refcount_mismatches = db.session.query(db.func.count(FileBlob.md5_hash)).outerjoin(
+        references, references.c.md5_hash == FileBlob.md5_hash
+    ).filter(FileBlob.ref_count != db.func.coalesce(references.c.refs, 0)).scalar()
+
+    problems = len(missing) + len(wrong_size) + len(corrupt) + refcount_mismatches
+    if problems:
+        current_app.logger.warning(
+            f"Verificación de integridad: {len(missing)} blobs ausentes, {len(wrong_size)} con tamaño "
+            f"distinto, {len(corrupt)} corruptos, {refcount_mismatches} ref_count incorrectos"
+        )
+        from socketio_utils import emit_to_admin
+        emit_to_admin('notification', {
+            'type': 'warning',
+            'message': f'La verificación de integridad encontró {problems} problemas',
+            'data': {'action': 'integrity_scan', 'job_id': context.job_id}
+        })
+
+    return {
+        'checked': checked,
+        'missing': missing[:100],
+        'wrong_size': wrong_size[:100],
+        'corrupt': corrupt[:100],
+        'refcount_mismatches': refcount_mismatches,
+        'problems': problems
+    }
@@ -1,9 +1,9 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify, send_file
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
-from models import (GameVersion, GameFile, UpdatePackage, LauncherVersion, NewsMessage, DownloadLog, ServerSettings, User, db)
+from models import (GameVersion, GameFile, UpdatePackage, LauncherVersion, NewsMessage, DownloadLog, ServerSettings, User, PackageBuild, BackgroundJob, ScheduledTask, db)
 import os
-import hashlib
+import uuid
 import zipfile
 from datetime import datetime, timedelta
 import json
@@ -18,7 +18,18 @@ from socketio_utils import (
     test_socketio_connection,
     broadcast_stats_update
 )
-from utils import format_file_size
+from utils import format_file_size, validate_version_format, save_upload
+from manifest_cache import invalidate_manifest, invalidate_messages
+import blob_store
+from ingest import ingest_uploads
+import package_builder
+import patch_builder
+import rollups
+import job_queue
+import scheduler
+import sketches
+import admin_jobs  # registra los manejadores de la cola de tareas
+from pagination import keyset_paginate, approximate_table_count, TOTAL_MODES
 
 
 admin_bp = Blueprint('admin', __name__)
@@ -51,17 +62,19 @@ def test_socket():
 
 # ==================== FUNCIONES AUXILIARES ====================
 
+# Filas por bloque al exportar logs en streaming
+EXPORT_CHUNK_ROWS = 1000
+
+def approximate_log_total(file_type=None):
+    """Total aproximado de logs sin recorrer la tabla (agregados o estadísticas del planificador)"""
+    if file_type:
+        return rollups.downloads_by_type().get(file_type, 0)
+    estimate = approximate_table_count(DownloadLog.__tablename__)
+    return estimate if estimate is not None else rollups.total_downloads()
+
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
-def calculate_md5(file_path):
-    """Calcular MD5 de un archivo"""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
 # ==================== DASHBOARD ====================
 
 @admin_bp.route('/')
@@ -86,30 +99,28 @@ def get_dashboard_data():
         total_versions = GameVersion.query.count()
         total_files = GameFile.query.count()
         total_updates = UpdatePackage.query.count()
-        total_downloads = DownloadLog.query.count()
+        total_downloads = rollups.total_downloads()
 
         latest_version = GameVersion.get_latest()
         current_launcher = LauncherVersion.get_current()
 
         yesterday = datetime.utcnow() - timedelta(days=1)
-        recent_downloads = DownloadLog.query.filter(DownloadLog.created_at >= yesterday).count()
+        recent_downloads = rollups.total_downloads(since=yesterday)
 
         active_messages = NewsMessage.query.filter_by(is_active=True).count()
 
+        # Descargas de los últimos 7 días desde los agregados diarios
+        today = rollups.bucket_start(datetime.utcnow(), 'day')
+        first_day = today - timedelta(days=6)
+        daily_counts = rollups.series('day', first_day, today + timedelta(days=1))
+
         downloads_by_day = []
         for i in range(7):
-            day = datetime.utcnow() - timedelta(days=i)
-            day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
-            day_end = day_start + timedelta(days=1)
-            count = DownloadLog.query.filter(
-                DownloadLog.created_at >= day_start,
-                DownloadLog.created_at < day_end
-            ).count()
+            day_start = first_day + timedelta(days=i)
             downloads_by_day.append({
                 'date': day_start.strftime('%Y-%m-%d'),
-                'count': count
+                'count': daily_counts.get(day_start, 0)
             })
-        downloads_by_day.reverse()
 
         return jsonify({
             'stats': {
@@ -135,7 +146,7 @@ def get_dashboard_data():
 @login_required
 def versions():
     """Gestión de versiones del juego"""
-    versions = GameVersion.query.order_by(GameVersion.created_at.desc()).all()
+    versions = GameVersion.query_with_children().order_by(GameVersion.created_at.desc()).all()
     return render_template('admin/versions.html', versions=versions)
 
 # ==================== RUTAS PARA VERSIONES DEL JUEGO ====================
@@ -149,6 +160,10 @@ def create_version():
             release_notes = request.form['release_notes']
             is_latest = 'is_latest' in request.form
             
+            if not validate_version_format(version):
+                flash('Formato de versión no válido (X.Y.Z.W; X hasta 32767 y el resto hasta 65535)', 'error')
+                return render_template('admin/create_version.html')
+            
             # Verificar que la versión no exista
             existing = GameVersion.query.filter_by(version=version).first()
             if existing:
@@ -166,6 +181,7 @@ def create_version():
             
             if is_latest:
                 new_version.set_as_latest()
+                invalidate_manifest()
             
             flash(f'Versión {version} creada exitosamente', 'success')
             return redirect(url_for('admin.versions'))
@@ -184,6 +200,7 @@ def set_latest_version(version_id):
     try:
         version = GameVersion.query.get_or_404(version_id)
         version.set_as_latest()
+        invalidate_manifest()
         flash(f'Versión {version.version} establecida como la más reciente', 'success')
     except Exception as e:
         flash(f'Error: {str(e)}', 'error')
@@ -203,8 +220,8 @@ def files():
         # O se puede eliminar y que el frontend pida todas las versiones y luego filtre.
         # Por ahora, la mantendremos para la llamada API inicial.
         version_id = request.args.get('version_id', None, type=int)
-        versions = GameVersion.query.order_by(GameVersion.version.desc()).all()
-        versions_data = [v.to_dict() for v in versions]
+        versions = GameVersion.query_summaries().order_by(GameVersion.version_key.desc()).all()
+        versions_data = [v.to_summary_dict(files_count, packages_count) for v, files_count, packages_count in versions]
 
         # La plantilla necesita `versions_data` y `current_version_id` para los filtros iniciales.
         # El resto de los datos de `files` se cargarán por API.
@@ -221,16 +238,31 @@ def files():
 def get_files_data():
     """API para obtener los datos de los archivos, con paginación y filtro."""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 50, type=int)
+        cursor = request.args.get('cursor', '')
+        per_page = max(1, min(request.args.get('per_page', 50, type=int), 500))
         version_id = request.args.get('version_id', None, type=int)
+        total_mode = request.args.get('total', 'exact' if version_id else 'approx')
+        if total_mode not in TOTAL_MODES:
+            total_mode = 'exact'
 
-        query = GameFile.query
+        query = GameFile.query_with_version()
         if version_id:
             query = query.filter_by(version_id=version_id)
 
-        files_paginated = query.order_by(GameFile.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
+        total, total_is_approximate = None, False
+        if total_mode == 'exact':
+            total = query.count()
+        elif total_mode == 'approx':
+            total = approximate_table_count(GameFile.__tablename__)
+            if total is None:
+                total = query.count()
+            else:
+                total_is_approximate = True
+
+        files_paginated = keyset_paginate(
+            query, GameFile.created_at, GameFile.id,
+            cursor=cursor, per_page=per_page,
+            total=total, total_is_approximate=total_is_approximate
         )
 
         files_data = []
@@ -264,14 +296,7 @@ def get_files_data():
 
         return jsonify({
             'files': files_data,
-            'pagination': {
-                'page': files_paginated.page,
-                'pages': files_paginated.pages,
-                'perPage': files_paginated.per_page,
-                'total': files_paginated.total,
-                'hasNext': files_paginated.has_next,
-                'hasPrev': files_paginated.has_prev
-            },
+            'pagination': files_paginated.to_dict(),
             'urls': urls
         })
     except Exception as e:
@@ -288,66 +313,134 @@ def upload_files():
             uploaded_files = request.files.getlist('files')
             
             version = GameVersion.query.get_or_404(version_id)
-            files_uploaded = 0
             
+            build_archive = request.files.get('build_archive')
+            if build_archive and build_archive.filename:
+                return import_build_archive(version, build_archive)
+            
+            uploads = []
             for file in uploaded_files:
                 if file and file.filename:
                     filename = secure_filename(file.filename)
                     relative_path = request.form.get(f'relative_path_{file.filename}', f'bin/{filename}')
-                    
-                    # Guardar archivo
-                    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'files', filename)
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    file.save(file_path)
-                    
-                    # Calcular MD5
-                    md5_hash = calculate_md5(file_path)
-                    file_size = os.path.getsize(file_path)
-                    
-                    # Verificar si el archivo ya existe
-                    existing_file = GameFile.query.filter_by(
-                        filename=filename, 
-                        version_id=version_id
-                    ).first()
-                    
-                    if existing_file:
-                        # Actualizar archivo existente
-                        existing_file.md5_hash = md5_hash
-                        existing_file.file_size = file_size
-                        existing_file.relative_path = relative_path
-                        existing_file.updated_at = datetime.utcnow()
-                    else:
-                        # Crear nuevo registro
-                        game_file = GameFile(
-                            filename=filename,
-                            relative_path=relative_path,
-                            md5_hash=md5_hash,
-                            file_size=file_size,
-                            version_id=version_id
-                        )
-                        db.session.add(game_file)
-                    
-                    files_uploaded += 1
+                    uploads.append((file, filename, relative_path))
             
-            db.session.commit()
-            flash(f'{files_uploaded} archivos subidos exitosamente', 'success')
+            # Guardado y hash en paralelo, una consulta de existentes y escritura en bloque
+            report = ingest_uploads(version.id, uploads)
+            files_uploaded = report.total_files
+            invalidate_manifest()
+            schedule_patches_safely(version)
+            flash(f'{files_uploaded} archivos subidos exitosamente ({report.inserted} nuevos, '
+                  f'{report.updated} actualizados, {report.unchanged} sin cambios)', 'success')
             return redirect(url_for('admin.files'))
             
         except Exception as e:
             db.session.rollback()
             flash(f'Error al subir archivos: {str(e)}', 'error')
     
-    versions = GameVersion.query.order_by(GameVersion.version.desc()).all()
-    versions_data = [v.to_dict() for v in versions]
-    return render_template('admin/upload_files.html', versions=versions, versions_data=versions_data)
+    rows = GameVersion.query_summaries().order_by(GameVersion.version_key.desc()).all()
+    versions = [v for v, _, _ in rows]
+    versions_data = [v.to_summary_dict(files_count, packages_count) for v, files_count, packages_count in rows]
+    return render_template('admin/upload_files.html', versions=versions, versions_data=versions_data,
+                           idempotency_key=uuid.uuid4().hex)
+
+
+def schedule_patches_safely(version):
+    """Programar los parches binarios de la versión sin hacer fallar la operación que los originó"""
+    try:
+        patch_builder.schedule_version_patches(version)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error programando parches de la versión {version.version}: {e}")
+
+
+def import_build_archive(version, build_archive):
+    """Importar un build completo en ZIP como archivos de la versión"""
+    if not allowed_file(build_archive.filename, {'zip'}):
+        flash('Solo se permiten archivos ZIP', 'error')
+        return redirect(url_for('admin.upload_files'))
+    
+    # La extracción, el hash y el registro de los archivos se hacen en la cola de tareas
+    key = idempotency_key()
+    existing = job_queue.active_job(key) if key else None
+    if existing is not None:
+        flash(f'La importación ya está en curso (tarea #{existing.id})', 'info')
+        return redirect(url_for('admin.jobs'))
+    
+    archive_path = save_upload(build_archive.stream, blob_store.temp_path(), algorithms=()).path
+    try:
+        job = job_queue.enqueue('import_archive', {
+            'version_id': version.id,
+            'archive_path': archive_path,
+            'strip_root': 'strip_root' in request.form,
+            'replace': 'replace_existing' in request.form
+        }, idempotency_key=key, user_id=current_user.id)
+    except Exception:
+        os.remove(archive_path)
+        raise
+    if job.arguments.get('archive_path') != archive_path:
+        os.remove(archive_path)  # la misma petición ya se había encolado
+    
+    flash(f'Importación del build en la versión {version.version} en cola (tarea #{job.id})', 'success')
+    return redirect(url_for('admin.jobs'))
+
+
+def idempotency_key(default=None):
+    """Clave de idempotencia enviada por el formulario, o la indicada por la ruta"""
+    return request.form.get('idempotency_key') or default
 
 
 @admin_bp.route('/updates')
 @login_required
 def updates():
     """Gestión de paquetes de actualización"""
-    updates = UpdatePackage.query.join(GameVersion).order_by(GameVersion.version.desc()).all()
-    return render_template('admin/updates.html', updates=updates)
+    updates = UpdatePackage.query_with_version().order_by(GameVersion.version_key.desc()).all()
+    builds = PackageBuild.query.options(
+        db.joinedload(PackageBuild.version), db.joinedload(PackageBuild.from_version)
+    ).order_by(PackageBuild.id.desc()).limit(20).all()
+    return render_template('admin/updates.html', updates=updates, builds=builds)
+
+@admin_bp.route('/updates/build', methods=['POST'])
+@login_required
+def build_update():
+    """Construir en segundo plano el paquete de una versión a partir de la diferencia con otra"""
+    try:
+        version = GameVersion.query.get_or_404(request.form['version_id'])
+        from_version_id = request.form.get('from_version_id', '')
+        
+        # Sin origen explícito se usa la versión anterior; 'full' construye el paquete completo
+        if from_version_id == 'full':
+            from_version = None
+        elif from_version_id:
+            from_version = GameVersion.query.get_or_404(from_version_id)
+        else:
+            from_version = package_builder.previous_version(version)
+        
+        if from_version is not None and from_version.id == version.id:
+            flash('La versión de origen debe ser distinta de la versión destino', 'error')
+            return redirect(url_for('admin.create_update'))
+        
+        changed = package_builder.diff_version_files(version.id, from_version.id if from_version else None)
+        if not changed:
+            flash('No hay archivos nuevos ni modificados entre las versiones seleccionadas', 'warning')
+            return redirect(url_for('admin.create_update'))
+        
+        build = package_builder.request_build(version, from_version, user_id=current_user.id)
+        origin = from_version.version if from_version else 'paquete completo'
+        flash(f'Construcción del paquete {version.version} (desde {origin}) en cola: '
+              f'{len(changed)} archivos (build #{build.id})', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al solicitar la construcción: {str(e)}', 'error')
+        return redirect(url_for('admin.create_update'))
+    
+    return redirect(url_for('admin.updates'))
+
+@admin_bp.route('/updates/builds/<int:build_id>')
+@login_required
+def update_build_status(build_id):
+    """Estado y progreso de una construcción de paquete"""
+    return jsonify(PackageBuild.query.get_or_404(build_id).to_dict())
 
 @admin_bp.route('/updates/create', methods=['GET', 'POST'])
 @login_required
@@ -364,27 +457,32 @@ def create_update():
             
             if not update_file.filename.lower().endswith('.zip'):
                 flash('Solo se permiten archivos ZIP', 'error')
-                return render_template('admin/create_update.html', versions=GameVersion.query.order_by(GameVersion.version.desc()).all())
+                return render_template('admin/create_update.html', versions=GameVersion.query.order_by(GameVersion.version_key.desc()).all())
             
             version = GameVersion.query.get_or_404(version_id)
             filename = f"update_{version.version}.zip"
             
-            # Guardar archivo
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'updates', filename)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            update_file.save(file_path)
-            
-            # Calcular MD5 y tamaño
-            md5_hash = calculate_md5(file_path)
-            file_size = os.path.getsize(file_path)
+            # Guardar archivo calculando MD5, tamaño y hashes por bloque en la misma pasada;
+            # se publica con su MD5 en el nombre y el registro pasa a apuntarlo al confirmar
+            block_size = current_app.config.get('FILE_BLOCK_MANIFEST_SIZE', 1024 * 1024)
+            tmp_path = f"{package_builder.package_path(current_app, version.version)}.{uuid.uuid4().hex}.part"
+            try:
+                saved = save_upload(update_file.stream, tmp_path, block_size=block_size)
+                file_path = package_builder.package_path(current_app, version.version, saved.md5)
+                os.replace(tmp_path, file_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            md5_hash = saved.md5
+            file_size = saved.size
+            blob_store.record_chunk_manifests([(md5_hash, file_size, block_size, saved.blocks)])
             
             # Verificar si ya existe un paquete para esta versión
             existing_update = UpdatePackage.query.filter_by(version_id=version_id).first()
+            old_path = None
             if existing_update:
-                # Eliminar archivo anterior
+                # El archivo anterior se elimina tras confirmar
                 old_path = existing_update.file_path
-                if os.path.exists(old_path):
-                    os.remove(old_path)
                 
                 # Actualizar registro
                 existing_update.filename = filename
@@ -403,7 +501,14 @@ def create_update():
                 )
                 db.session.add(update_package)
             
-            db.session.commit()
+            try:
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                package_builder.remove_unreferenced_package(file_path)
+                raise
+            package_builder.remove_unreferenced_package(old_path, keep=file_path)
+            invalidate_manifest()
             flash(f'Paquete de actualización creado para versión {version.version}', 'success')
             return redirect(url_for('admin.updates'))
             
@@ -411,7 +516,9 @@ def create_update():
             db.session.rollback()
             flash(f'Error al crear paquete: {str(e)}', 'error')
     
-    versions = GameVersion.query.order_by(GameVersion.version.desc()).all()
+    versions = GameVersion.query.options(
+        db.selectinload(GameVersion.update_packages).load_only(UpdatePackage.id, UpdatePackage.version_id)
+    ).order_by(GameVersion.version_key.desc()).all()
     return render_template('admin/create_update.html', versions=versions)
 
 @admin_bp.route('/launcher')
@@ -443,9 +550,8 @@ def upload_launcher():
             filename = secure_filename(launcher_file.filename)
             file_path = os.path.join('static/downloads', filename)
             
-            # Guardar archivo
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            launcher_file.save(file_path)
+            # Guardar archivo (escritura atómica: el launcher actual nunca se sirve a medias)
+            save_upload(launcher_file.stream, file_path, algorithms=())
             
             # Crear registro
             launcher_version = LauncherVersion(
@@ -512,6 +618,7 @@ def create_message():
             
             db.session.add(news_message)
             db.session.commit()
+            invalidate_messages()
             
             flash('Mensaje creado exitosamente', 'success')
             return redirect(url_for('admin.messages'))
@@ -530,6 +637,7 @@ def toggle_message(message_id):
         message = NewsMessage.query.get_or_404(message_id)
         message.is_active = not message.is_active
         db.session.commit()
+        invalidate_messages()
         
         status = "activado" if message.is_active else "desactivado"
         flash(f'Mensaje {status} exitosamente', 'success')
@@ -542,42 +650,54 @@ def toggle_message(message_id):
 @login_required
 def download_logs():
     """Ver logs de descarga con estadísticas corregidas"""
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', '')
     file_type = request.args.get('file_type', '')
+    total_mode = request.args.get('total', 'approx')
+    if total_mode not in TOTAL_MODES:
+        total_mode = 'approx'
     
     query = DownloadLog.query
     if file_type:
         query = query.filter_by(file_type=file_type)
     
-    logs = query.order_by(DownloadLog.created_at.desc()).paginate(
-        page=page, per_page=100, error_out=False
+    # Paginación por cursor: el coste no depende de la profundidad de la página
+    total = None
+    if total_mode == 'exact':
+        total = query.count()
+    elif total_mode == 'approx':
+        total = approximate_log_total(file_type)
+    
+    logs = keyset_paginate(
+        query, DownloadLog.created_at, DownloadLog.id,
+        cursor=cursor, per_page=100,
+        total=total, total_is_approximate=(total_mode == 'approx')
     )
     
     # ESTADÍSTICAS CORREGIDAS
     try:
-        # Total de logs
-        total_logs = DownloadLog.query.count()
+        # Total de logs (desde los agregados diarios)
+        total_logs = rollups.total_downloads()
         
         # Logs exitosos y fallidos
-        successful_logs = DownloadLog.query.filter_by(success=True).count()
-        failed_logs = DownloadLog.query.filter_by(success=False).count()
+        successful_logs = rollups.total_downloads(success=True)
+        failed_logs = total_logs - successful_logs
         
-        # IPs únicas - CORREGIR PROBLEMA DE CONTEO
-        unique_ips_query = db.session.query(DownloadLog.ip_address).distinct()
-        unique_ips_count = unique_ips_query.count()
+        # IPs únicas (HyperLogLog diario) con su error estándar
+        if sketches.get_accumulator() is not None:
+            unique_ips = sketches.unique_ips(granularity='day')
+        else:
+            unique_ips = {'value': db.session.query(DownloadLog.ip_address).distinct().count(), 'error': 0}
         
         # Tipos de archivo únicos para el filtro
-        file_types_query = db.session.query(DownloadLog.file_type).distinct().filter(
-            DownloadLog.file_type.isnot(None)
-        ).all()
-        file_types = [ft[0] for ft in file_types_query if ft[0]]
+        file_types = [ft for ft in rollups.downloads_by_type() if ft]
         
         # Estadísticas adicionales para la página
         stats = {
             'total_logs': total_logs,
             'successful_logs': successful_logs,
             'failed_logs': failed_logs,
-            'unique_ips': unique_ips_count,
+            'unique_ips': unique_ips['value'],
+            'unique_ips_error': unique_ips['error'],
             'success_rate': round((successful_logs / total_logs * 100), 2) if total_logs > 0 else 0
         }
         
@@ -590,6 +710,7 @@ def download_logs():
             'successful_logs': 0,
             'failed_logs': 0,
             'unique_ips': 0,
+            'unique_ips_error': 0,
             'success_rate': 0
         }
         file_types = []
@@ -610,28 +731,14 @@ def cleanup_old_logs():
             flash('Debes confirmar la acción para eliminar logs antiguos', 'error')
             return redirect(url_for('admin.download_logs'))
         
-        # Calcular fecha límite
-        from datetime import datetime, timedelta
+        # El borrado se hace por lotes en la cola de tareas
         cutoff_date = datetime.utcnow() - timedelta(days=days)
+        job = job_queue.enqueue('cleanup_logs', {'days': days},
+                                idempotency_key=idempotency_key(f'cleanup_logs:{days}:{cutoff_date:%Y-%m-%d}'),
+                                user_id=current_user.id)
         
-        # Contar logs que se van a eliminar
-        logs_to_delete = DownloadLog.query.filter(
-            DownloadLog.created_at < cutoff_date
-        ).count()
-        
-        if logs_to_delete == 0:
-            flash(f'No hay logs anteriores a {days} días para eliminar', 'info')
-            return redirect(url_for('admin.download_logs'))
-        
-        # Eliminar logs antiguos
-        deleted_count = DownloadLog.query.filter(
-            DownloadLog.created_at < cutoff_date
-        ).delete()
-        
-        db.session.commit()
-        
-        current_app.logger.info(f"Eliminados {deleted_count} logs antiguos por usuario {current_user.username}")
-        flash(f'{deleted_count} logs antiguos eliminados exitosamente', 'success')
+        current_app.logger.info(f"Limpieza de logs de más de {days} días encolada por usuario {current_user.username}")
+        flash(f'Limpieza de logs anteriores a {days} días en cola (tarea #{job.id})', 'success')
         
     except Exception as e:
         db.session.rollback()
@@ -640,63 +747,137 @@ def cleanup_old_logs():
     
     return redirect(url_for('admin.download_logs'))
 
+@admin_bp.route('/logs/rollups/rebuild', methods=['POST'])
+@login_required
+def rebuild_log_rollups():
+    """Recalcular los agregados de descargas a partir de los logs históricos"""
+    try:
+        days = request.form.get('days', 0, type=int)
+        include_today = request.form.get('include_today') == '1'
+        job = job_queue.enqueue('rebuild_rollups', {'days': days, 'include_today': include_today},
+                                idempotency_key=idempotency_key(f'rebuild_rollups:{days}:{int(include_today)}'),
+                                user_id=current_user.id)
+        
+        current_app.logger.info(f"Recálculo de agregados encolado por usuario {current_user.username}")
+        flash(f'Recálculo de estadísticas en cola (tarea #{job.id})', 'success')
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error recalculando agregados: {e}")
+        flash(f'Error al recalcular estadísticas: {str(e)}', 'error')
+    
+    return redirect(url_for('admin.download_logs'))
+
 @admin_bp.route('/logs/export')
 @login_required
 def export_logs():
-    """Exportar logs como CSV"""
+    """Exportar logs como CSV o NDJSON en streaming (opcionalmente comprimido con gzip)"""
     try:
-        from datetime import datetime
         import csv
+        import zlib
         from io import StringIO
+        from flask import Response, stream_with_context
         
         # Obtener parámetros de filtro
         file_type = request.args.get('file_type', '')
         days = request.args.get('days', 30, type=int)
+        export_format = request.args.get('format', 'csv').lower()
+        use_gzip = request.args.get('gzip', 'false').lower() in ('1', 'true', 'yes')
         
-        # Crear query
-        query = DownloadLog.query
+        if export_format not in ('csv', 'ndjson'):
+            flash('Formato de exportación no válido', 'error')
+            return redirect(url_for('admin.download_logs'))
+        
+        # Crear query solo con las columnas necesarias
+        query = db.session.query(
+            DownloadLog.created_at, DownloadLog.ip_address, DownloadLog.file_requested,
+            DownloadLog.file_type, DownloadLog.success, DownloadLog.user_agent
+        )
         
         if file_type:
-            query = query.filter_by(file_type=file_type)
+            query = query.filter(DownloadLog.file_type == file_type)
         
         if days > 0:
-            from datetime import timedelta
             cutoff_date = datetime.utcnow() - timedelta(days=days)
             query = query.filter(DownloadLog.created_at >= cutoff_date)
         
-        # Obtener logs
-        logs = query.order_by(DownloadLog.created_at.desc()).all()
-        
-        # Crear CSV
-        output = StringIO()
-        writer = csv.writer(output)
+        # Cursor del lado del servidor: las filas llegan por bloques, nunca todas en memoria
+        rows = query.order_by(DownloadLog.created_at.desc()).yield_per(EXPORT_CHUNK_ROWS)
         
-        # Headers
-        writer.writerow([
-            'Fecha', 'Hora', 'IP', 'Archivo', 'Tipo', 'Estado', 'User Agent'
-        ])
-        
-        # Datos
-        for log in logs:
+        def generate_csv():
+            buffer = StringIO()
+            writer = csv.writer(buffer)
+            
+            # Headers
             writer.writerow([
-                log.created_at.strftime('%Y-%m-%d'),
-                log.created_at.strftime('%H:%M:%S'),
-                log.ip_address,
-                log.file_requested,
-                log.file_type or 'N/A',
-                'Exitoso' if log.success else 'Fallido',
-                log.user_agent or 'N/A'
+                'Fecha', 'Hora', 'IP', 'Archivo', 'Tipo', 'Estado', 'User Agent'
             ])
+            
+            for i, log in enumerate(rows, 1):
+                writer.writerow([
+                    log.created_at.strftime('%Y-%m-%d'),
+                    log.created_at.strftime('%H:%M:%S'),
+                    log.ip_address,
+                    log.file_requested,
+                    log.file_type or 'N/A',
+                    'Exitoso' if log.success else 'Fallido',
+                    log.user_agent or 'N/A'
+                ])
+                if i % EXPORT_CHUNK_ROWS == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate(0)
+            
+            yield buffer.getvalue()
+        
+        def generate_ndjson():
+            lines = []
+            for i, log in enumerate(rows, 1):
+                lines.append(json.dumps({
+                    'created_at': log.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+                    'ip_address': log.ip_address,
+                    'file_requested': log.file_requested,
+                    'file_type': log.file_type,
+                    'success': log.success,
+                    'user_agent': log.user_agent
+                }) + '\n')
+                if i % EXPORT_CHUNK_ROWS == 0:
+                    yield ''.join(lines)
+                    lines = []
+            
+            yield ''.join(lines)
+        
+        def encode(chunks):
+            try:
+                if use_gzip:
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = cabecera gzip
+                    for chunk in chunks:
+                        data = compressor.compress(chunk.encode('utf-8'))
+                        if data:
+                            yield data
+                    yield compressor.flush()
+                else:
+                    for chunk in chunks:
+                        if chunk:
+                            yield chunk.encode('utf-8')
+            except Exception as e:
+                current_app.logger.error(f"Error durante la exportación de logs: {e}")
+                raise
         
-        # Preparar respuesta
-        from flask import make_response
+        if export_format == 'csv':
+            body, mimetype, extension = generate_csv(), 'text/csv', 'csv'
+        else:
+            body, mimetype, extension = generate_ndjson(), 'application/x-ndjson', 'ndjson'
+        
+        filename = f'logs_export_{datetime.now().strftime("%Y%m%d_%H%M")}.{extension}'
+        if use_gzip:
+            filename += '.gz'
+            mimetype = 'application/gzip'
         
-        output.seek(0)
-        response = make_response(output.getvalue())
-        response.headers['Content-Type'] = 'text/csv'
-        response.headers['Content-Disposition'] = f'attachment; filename=logs_export_{datetime.now().strftime("%Y%m%d_%H%M")}.csv'
+        response = Response(stream_with_context(encode(body)), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+        response.headers['X-Accel-Buffering'] = 'no'
         
-        current_app.logger.info(f"Logs exportados por usuario {current_user.username}")
+        current_app.logger.info(f"Logs exportados por usuario {current_user.username} ({export_format}, gzip={use_gzip})")
         
         return response
         
@@ -712,6 +893,62 @@ def settings():
     settings = ServerSettings.query.all()
     return render_template('admin/settings.html', settings=settings)
 
+@admin_bp.route('/jobs')
+@login_required
+def jobs():
+    """Tareas en segundo plano con su progreso"""
+    recent = BackgroundJob.query.order_by(BackgroundJob.id.desc()).limit(100).all()
+    schedule = []
+    for row in ScheduledTask.query.order_by(ScheduledTask.next_run_at).all():
+        task = scheduler.maintenance_task(row.name)
+        if task is not None:
+            schedule.append(dict(row.to_dict(), title=task.title))
+    return render_template('admin/jobs.html', jobs=[job_queue.job_to_dict(job) for job in recent],
+                           schedule=schedule, scheduler_running=scheduler.get_scheduler() is not None)
+
+@admin_bp.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    """Estado y progreso de una tarea"""
+    return jsonify(job_queue.job_to_dict(BackgroundJob.query.get_or_404(job_id)))
+
+@admin_bp.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    """Cancelar una tarea pendiente o pedir que se detenga una en curso"""
+    try:
+        job = job_queue.cancel(job_id)
+        if job is None:
+            flash('Tarea no encontrada', 'error')
+        elif job.status == 'cancelled':
+            flash(f'Tarea #{job.id} cancelada', 'success')
+        elif job.status == 'running':
+            flash(f'Se pidió cancelar la tarea #{job.id}; se detendrá en su siguiente punto de control', 'info')
+        else:
+            flash(f'La tarea #{job.id} ya había terminado', 'warning')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al cancelar la tarea: {str(e)}', 'error')
+
+    return redirect(url_for('admin.jobs'))
+
+@admin_bp.route('/maintenance/<name>/run', methods=['POST'])
+@login_required
+def run_maintenance(name):
+    """Adelantar una tarea de mantenimiento periódica al siguiente ciclo del programador"""
+    try:
+        task = scheduler.maintenance_task(name)
+        if task is None or not scheduler.run_now(name):
+            flash('Tarea de mantenimiento no encontrada', 'error')
+        else:
+            current_app.logger.info(f"Mantenimiento '{name}' adelantado por usuario {current_user.username}")
+            flash(f'{task.title}: se ejecutará en el próximo ciclo del programador', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al programar el mantenimiento: {str(e)}', 'error')
+
+    return redirect(url_for('admin.jobs'))
+
 @admin_bp.route('/versions/<int:version_id>/delete', methods=['POST'])
 @login_required
 def delete_version(version_id):
@@ -724,24 +961,12 @@ def delete_version(version_id):
             flash('No se puede eliminar la versión actual', 'error')
             return redirect(url_for('admin.versions'))
         
-        # Eliminar archivos asociados
-        for game_file in version.files:
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'files', game_file.filename)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            db.session.delete(game_file)
-        
-        # Eliminar paquetes de actualización asociados
-        for update_package in version.update_packages:
-            if os.path.exists(update_package.file_path):
-                os.remove(update_package.file_path)
-            db.session.delete(update_package)
-        
-        # Eliminar la versión
-        db.session.delete(version)
-        db.session.commit()
+        # Archivos, parches y paquetes se eliminan por lotes en la cola de tareas
+        job = job_queue.enqueue('delete_version', {'version_id': version.id},
+                                idempotency_key=idempotency_key(f'delete_version:{version.id}:{version.version}'),
+                                user_id=current_user.id)
         
-        flash(f'Versión {version.version} eliminada exitosamente', 'success')
+        flash(f'Eliminación de la versión {version.version} en cola (tarea #{job.id})', 'success')
     except Exception as e:
         db.session.rollback()
         flash(f'Error al eliminar versión: {str(e)}', 'error')
@@ -755,19 +980,18 @@ def delete_file(file_id):
     try:
         game_file = GameFile.query.get_or_404(file_id)
         filename = game_file.filename
+        md5_hash = game_file.md5_hash
         
-        # Eliminar archivo físico
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'files', game_file.filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            current_app.logger.info(f'Archivo físico eliminado: {file_path}')
-        else:
-            current_app.logger.warning(f'Archivo físico no encontrado: {file_path}')
-        
-        # Eliminar registro de la base de datos
+        # Eliminar registro de la base de datos y su referencia al contenido
+        blob_store.release(md5_hash)
         db.session.delete(game_file)
         db.session.commit()
         
+        # El contenido solo se borra si ninguna otra versión lo usa
+        blob_store.refresh_flat_view(filename)
+        blob_store.purge_unreferenced([md5_hash])
+        invalidate_manifest()
+        
         current_app.logger.info(f'Archivo {filename} eliminado exitosamente por usuario {current_user.username}')
         flash(f'Archivo {filename} eliminado exitosamente', 'success')
     except Exception as e:
@@ -789,6 +1013,8 @@ def delete_selected_files():
         
         deleted_count = 0
         errors = []
+        released_hashes = []
+        filenames = set()
         
         for file_id in file_ids:
             try:
@@ -796,15 +1022,10 @@ def delete_selected_files():
                 if game_file:
                     filename = game_file.filename
                     
-                    # Eliminar archivo físico
-                    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'files', game_file.filename)
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        current_app.logger.info(f'Archivo físico eliminado: {file_path}')
-                    else:
-                        current_app.logger.warning(f'Archivo físico no encontrado: {file_path}')
-                    
-                    # Eliminar registro de la base de datos
+                    # Eliminar registro de la base de datos y su referencia al contenido
+                    blob_store.release(game_file.md5_hash)
+                    released_hashes.append(game_file.md5_hash)
+                    filenames.add(filename)
                     db.session.delete(game_file)
                     deleted_count += 1
                     current_app.logger.info(f'Archivo {filename} eliminado exitosamente')
@@ -815,6 +1036,10 @@ def delete_selected_files():
                 current_app.logger.error(f'Error eliminando archivo ID {file_id}: {str(e)}')
         
         db.session.commit()
+        for filename in filenames:
+            blob_store.refresh_flat_view(filename)
+        blob_store.purge_unreferenced(released_hashes)
+        invalidate_manifest()
         
         if deleted_count > 0:
             flash(f'{deleted_count} archivo(s) eliminado(s) exitosamente', 'success')
@@ -843,8 +1068,12 @@ def delete_update(update_id):
             os.remove(update_package.file_path)
         
         # Eliminar registro de la base de datos
+        PackageBuild.query.filter_by(package_id=update_package.id).update(
+            {'package_id': None}, synchronize_session=False
+        )
         db.session.delete(update_package)
         db.session.commit()
+        invalidate_manifest()
         
         flash(f'Paquete de actualización {update_package.filename} eliminado exitosamente', 'success')
     except Exception as e:
@@ -861,6 +1090,7 @@ def delete_message(message_id):
         message = NewsMessage.query.get_or_404(message_id)
         db.session.delete(message)
         db.session.commit()
+        invalidate_messages()
         
         flash('Mensaje eliminado exitosamente', 'success')
     except Exception as e:
@@ -887,6 +1117,7 @@ def delete_selected_messages():
                 deleted_count += 1
         
         db.session.commit()
+        invalidate_messages()
         flash(f'{deleted_count} mensaje(s) eliminado(s) exitosamente', 'success')
     except Exception as e:
         db.session.rollback()
@@ -935,44 +1166,43 @@ def logs_stats():
             DownloadLog.created_at >= one_hour_ago
         ).count()
         
-        last_hour_unique_ips = db.session.query(DownloadLog.ip_address).distinct().filter(
-            DownloadLog.created_at >= one_hour_ago
-        ).count()
-        
         # Archivos más populares (últimas 24 horas)
         twenty_four_hours_ago = datetime.utcnow() - timedelta(hours=24)
         
-        popular_files = db.session.query(
-            DownloadLog.file_requested,
-            db.func.count(DownloadLog.id).label('count')
-        ).filter(
-            DownloadLog.created_at >= twenty_four_hours_ago
-        ).group_by(
-            DownloadLog.file_requested
-        ).order_by(
-            db.func.count(DownloadLog.id).desc()
-        ).limit(5).all()
-        
-        # Actividad por hora (últimas 24 horas)
+        # IPs únicas y más frecuentes desde los sketches horarios (incluyen la hora completa
+        # que contiene el inicio del intervalo); cada valor lleva su error
+        if sketches.get_accumulator() is not None:
+            last_hour_unique_ips = sketches.unique_ips(since=one_hour_ago)
+            popular_files = [{'file': f['item'], 'count': f['count'], 'error': f['error']}
+                             for f in sketches.top_items('top_files', since=twenty_four_hours_ago, limit=5)]
+            top_ips = [{'ip': ip['item'], 'count': ip['count'], 'error': ip['error']}
+                       for ip in sketches.top_items('top_ips', since=twenty_four_hours_ago, limit=5)]
+        else:
+            last_hour_unique_ips = {'value': db.session.query(DownloadLog.ip_address).distinct().filter(
+                DownloadLog.created_at >= one_hour_ago
+            ).count(), 'error': 0}
+            popular_files = [{'file': f[0], 'count': f[1], 'error': 0}
+                             for f in rollups.popular_files(limit=5, since=twenty_four_hours_ago)]
+            top_ips = []
+        
+        # Actividad por hora (últimas 24 horas) desde los agregados horarios
+        current_hour = rollups.bucket_start(datetime.utcnow(), 'hour')
+        hourly_counts = rollups.series('hour', current_hour - timedelta(hours=23), current_hour + timedelta(hours=1))
+        
         hourly_activity = []
         for i in range(24):
-            hour_start = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=i)
-            hour_end = hour_start + timedelta(hours=1)
-            
-            count = DownloadLog.query.filter(
-                DownloadLog.created_at >= hour_start,
-                DownloadLog.created_at < hour_end
-            ).count()
-            
+            hour_start = current_hour - timedelta(hours=i)
             hourly_activity.append({
                 'hour': hour_start.strftime('%H:00'),
-                'count': count
+                'count': hourly_counts.get(hour_start, 0)
             })
         
         return jsonify({
             'last_hour_downloads': last_hour_downloads,
-            'last_hour_unique_ips': last_hour_unique_ips,
-            'popular_files': [{'file': f[0], 'count': f[1]} for f in popular_files],
+            'last_hour_unique_ips': last_hour_unique_ips['value'],
+            'last_hour_unique_ips_error': last_hour_unique_ips['error'],
+            'popular_files': popular_files,
+            'top_ips': top_ips,
             'hourly_activity': list(reversed(hourly_activity))
         })
         
@@ -1,24 +1,34 @@
-from flask import Blueprint, jsonify, request, send_from_directory, current_app
-from models import GameVersion, GameFile, UpdatePackage, LauncherVersion, NewsMessage, DownloadLog,launcher_ban, db
+from flask import Blueprint, jsonify, request, current_app
+from models import GameVersion, GameFile, UpdatePackage, LauncherVersion, launcher_ban, db
 import os
 import json
 from datetime import datetime
+from manifest_cache import get_manifest_snapshot, get_delta_snapshot, get_messages_snapshot
+from compression import compress_response, snapshot_response
+from log_writer import enqueue_download_log
+from ban_index import ban_index
+from file_delivery import send_resumable, block_manifest_response
+from package_builder import published_package
+import blob_store
+import patch_builder
+import rollups
 from pprint import pprint 
 
 api_bp = Blueprint('api', __name__)
 
+# Compresión al vuelo de las respuestas JSON que no tienen variantes precalculadas
+api_bp.after_request(compress_response)
+
 def log_download(file_requested, file_type, success=True):
-    """Registrar descarga en logs"""
+    """Registrar descarga en logs (escritura asíncrona por lotes)"""
     try:
-        log = DownloadLog(
+        enqueue_download_log(
             ip_address=request.remote_addr,
             user_agent=request.headers.get('User-Agent', ''),
             file_requested=file_requested,
             file_type=file_type,
             success=success
         )
-        db.session.add(log)
-        db.session.commit()
     except Exception as e:
         print(f"Error logging download: {e}")
 
@@ -35,17 +45,29 @@ def check_hwid():
         return jsonify({"error": "At least one identifier (HWID, serial or MAC) is required"}), 400
 
     try:
-        # Buscar en la base de datos usando cualquier identificador disponible
-        query = db.session.query(launcher_ban)
-        
-        if hwid:
-            query = query.filter(launcher_ban.hwid == hwid)
-        if serial:
-            query = query.filter(launcher_ban.serial_number == serial)
-        if mac:
-            query = query.filter(launcher_ban.mac_address == mac)
-        
-        device = query.first()
+        # Buscar primero en el índice en memoria
+        device = None
+        if current_app.config.get('BAN_INDEX_ENABLED', True):
+            ban_index.ensure_fresh()
+            device = ban_index.lookup(hwid, serial, mac)
+            if device is not None:
+                # Los baneos modifican la fila existente: confirmar por clave primaria
+                device = ban_index.refresh(device.id)
+
+        if not device:
+            # Buscar en la base de datos usando cualquier identificador disponible
+            query = db.session.query(launcher_ban)
+            
+            if hwid:
+                query = query.filter(launcher_ban.hwid == hwid)
+            if serial:
+                query = query.filter(launcher_ban.serial_number == serial)
+            if mac:
+                query = query.filter(launcher_ban.mac_address == mac)
+            
+            device = query.first()
+            if device:
+                ban_index.add(device)
 
         current_app.logger.info(f"Checking device - HWID: {hwid}, Serial: {serial}, MAC: {mac}")
 
@@ -62,6 +84,7 @@ def check_hwid():
             
             db.session.add(new_device)
             db.session.commit()
+            ban_index.add(new_device)
             current_app.logger.info(f"New device registered - HWID: {hwid}")
             return jsonify({
                 "status": "ok",
@@ -122,32 +145,29 @@ def launcher_update():
 def update_info():
     """Endpoint principal para información de actualizaciones del juego"""
     try:
-        latest_version = GameVersion.get_latest()
-        
-        if not latest_version:
-            return jsonify({
-                "latest_version": "1.0.0.0",
-                "updates": [],
-                "file_hashes": []
-            }), 404
+        snapshot = get_manifest_snapshot()
 
-        # Obtener todos los paquetes de actualización ordenados por versión
-        updates = UpdatePackage.query.join(GameVersion).order_by(GameVersion.version).all()
-        update_filenames = [f"update_{pkg.version.version}.zip" for pkg in updates]
+        if snapshot.status == 200:
+            log_download('update', 'update_check')
 
-        # Obtener hashes de archivos de la versión más reciente
-        files = GameFile.query.filter_by(version_id=latest_version.id).all()
-        file_hashes = [file.to_dict() for file in files]
+        return snapshot_response(snapshot.body, snapshot.variants, snapshot.etag, snapshot.status)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api_bp.route('/update/delta')
+def update_delta():
+    """Endpoint para el manifiesto delta desde la versión instalada por el cliente"""
+    try:
+        from_version = request.args.get('from', '').strip()
+        if not from_version:
+            return jsonify({"error": "Parameter 'from' is required"}), 400
 
-        log_download('update', 'update_check')
+        snapshot = get_delta_snapshot(from_version)
 
-        response_data = {
-            "latest_version": latest_version.version,
-            "updates": update_filenames,
-            "file_hashes": file_hashes
-        }
+        if snapshot.status == 200:
+            log_download('update_delta', 'update_check')
 
-        return jsonify(response_data)
+        return snapshot_response(snapshot.body, snapshot.variants, snapshot.etag, snapshot.status)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -155,21 +175,9 @@ def update_info():
 def messages():
     """Endpoint para mensajes y noticias"""
     try:
-        active_messages = NewsMessage.query.filter_by(is_active=True).order_by(NewsMessage.priority.desc(), NewsMessage.created_at.desc()).all()
-        
-        messages_data = []
-        for msg in active_messages:
-            messages_data.append({
-                'id': msg.id,
-                'type': msg.type,
-                'message': msg.message,
-                'priority': msg.priority,
-                'created_at': msg.created_at.isoformat() if msg.created_at else None
-            })
-        
+        snapshot = get_messages_snapshot()
         log_download('message', 'messages')
-        
-        return jsonify(messages_data)
+        return snapshot_response(snapshot.body, snapshot.variants, snapshot.etag, snapshot.status)
     except Exception as e:
         current_app.logger.error(f"Error in messages endpoint: {e}")
         return jsonify({"error": str(e), "messages": []}), 500
@@ -179,7 +187,7 @@ def banner():
     """Endpoint para el banner HTML del launcher"""
     try:
         log_download('banner.html', 'banner')
-        return send_from_directory('static/downloads', 'banner.html')
+        return send_resumable('static/downloads', 'banner.html')
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -187,6 +195,11 @@ def banner():
 def download_game_file(filename):
     """Endpoint para descargar archivos individuales del juego"""
     try:
+        # ?md5=<hash> sirve el contenido exacto de una versión concreta desde el almacén
+        md5_hash = request.args.get('md5')
+        if md5_hash:
+            return download_game_file_blob(filename, md5_hash.lower())
+        
         file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'files', filename)
         
         if not os.path.exists(file_path):
@@ -194,27 +207,108 @@ def download_game_file(filename):
             return jsonify({"error": "File not found"}), 404
         
         log_download(filename, 'game_file')
-        return send_from_directory(os.path.join(current_app.config['UPLOAD_FOLDER'], 'files'), filename)
+        return send_resumable(os.path.join(current_app.config['UPLOAD_FOLDER'], 'files'), filename, GameFile,
+                              variants=blob_store.variant_paths)
     except Exception as e:
         log_download(filename, 'game_file', success=False)
         return jsonify({"error": str(e)}), 500
 
+def download_game_file_blob(filename, md5_hash):
+    """Descargar un archivo del juego por nombre y hash desde el almacén por contenido"""
+    known = db.session.query(GameFile.id).filter_by(filename=filename, md5_hash=md5_hash).first() is not None
+    path = blob_store.blob_path(md5_hash) if known else None
+    
+    if path is None or not os.path.exists(path):
+        log_download(filename, 'game_file', success=False)
+        return jsonify({"error": "File not found"}), 404
+    
+    log_download(filename, 'game_file')
+    return send_resumable(os.path.dirname(path), os.path.basename(path),
+                          etag=f'{md5_hash}-{os.path.getsize(path)}', variants=blob_store.variant_paths)
+
+@api_bp.route('/files/<filename>/chunks')
+@api_bp.route('/files/<filename>/blocks')
+def game_file_blocks(filename):
+    """
+    Manifiesto de bloques de un archivo del juego (calculado al subirlo).
+
+    Sin ?md5= se usa el contenido vigente del nombre, el mismo que sirve
+    /api/files/<nombre>. Con ?format=binary se devuelven los hashes en crudo.
+    Los bloques dañados se descargan con Range sobre /api/files/<nombre>?md5=<hash>.
+    """
+    try:
+        md5_hash = (request.args.get('md5') or '').lower()
+        if md5_hash:
+            known = db.session.query(GameFile.id).filter_by(filename=filename, md5_hash=md5_hash).first()
+            md5_hash = md5_hash if known else None
+        else:
+            latest = blob_store.latest_file(filename)
+            md5_hash = latest[0] if latest else None
+        
+        manifest = blob_store.chunk_manifest(
+            md5_hash, current_app.config.get('FILE_BLOCK_MANIFEST_SIZE', 1024 * 1024)
+        ) if md5_hash else None
+        if manifest is None:
+            return jsonify({"error": "File not found"}), 404
+        
+        return block_manifest_response(manifest, filename, f"/api/files/{filename}?md5={manifest.md5_hash}",
+                                       immutable=bool(request.args.get('md5')))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @api_bp.route('/updates/<filename>')
 def download_update(filename):
     """Endpoint para descargar paquetes de actualización"""
     try:
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'updates', filename)
+        # El archivo en disco es el del registro, con el mismo MD5 que su ETag
+        package = published_package(filename)
         
-        if not os.path.exists(file_path):
+        if package is None:
             log_download(filename, 'update', success=False)
             return jsonify({"error": "Update file not found"}), 404
         
         log_download(filename, 'update')
-        return send_from_directory(os.path.join(current_app.config['UPLOAD_FOLDER'], 'updates'), filename)
+        return send_resumable(os.path.dirname(package.path), os.path.basename(package.path), etag=package.etag)
     except Exception as e:
         log_download(filename, 'update', success=False)
         return jsonify({"error": str(e)}), 500
 
+@api_bp.route('/updates/<filename>/chunks')
+@api_bp.route('/updates/<filename>/blocks')
+def update_blocks(filename):
+    """Manifiesto de bloques del paquete de actualización que sirve /api/updates/<nombre>"""
+    try:
+        package = published_package(filename)
+        
+        manifest = None
+        if package is not None and package.etag:
+            manifest = blob_store.chunk_manifest(
+                package.md5_hash, current_app.config.get('FILE_BLOCK_MANIFEST_SIZE', 1024 * 1024), path=package.path
+            )
+        if manifest is None:
+            return jsonify({"error": "Update file not found"}), 404
+        
+        return block_manifest_response(manifest, filename, f"/api/updates/{filename}")
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api_bp.route('/patches/<name>')
+def download_patch(name):
+    """Endpoint para descargar parches binarios (bsdiff) anunciados en el manifiesto"""
+    try:
+        patch = patch_builder.find_patch(name)
+        directory = patch_builder.patch_root()
+        
+        if patch is None or not os.path.exists(os.path.join(directory, name)):
+            log_download(name, 'patch', success=False)
+            return jsonify({"error": "Patch not found"}), 404
+        
+        log_download(name, 'patch')
+        return send_resumable(directory, name, etag=f'{patch.patch_md5}-{patch.patch_size}')
+    except Exception as e:
+        log_download(name, 'patch', success=False)
+        return jsonify({"error": str(e)}), 500
+
 @api_bp.route('/LauncherUpdater.exe')
 def download_launcher_updater():
     """Endpoint para descargar el actualizador del launcher"""
@@ -227,7 +321,7 @@ def download_launcher_updater():
             return jsonify({"error": "Launcher updater not found"}), 404
         
         log_download('LauncherUpdater.exe', 'launcher_updater')
-        return send_from_directory('static/downloads', 'LauncherUpdater.exe')
+        return send_resumable('static/downloads', 'LauncherUpdater.exe')
     except Exception as e:
         log_download('LauncherUpdater.exe', 'launcher_updater', success=False)
         return jsonify({"error": str(e)}), 500
@@ -245,7 +339,7 @@ def download_Config():
             return jsonify({"error": "Launcher updater not found"}), 404
         
         log_download('PBConfig.exe', 'PBConfig')
-        return send_from_directory('static/downloads', 'PBConfig.exe')
+        return send_resumable('static/downloads', 'PBConfig.exe')
     except Exception as e:
         log_download('PBConfig.exe', 'PBConfig', success=False)
         return jsonify({"error": str(e)}), 500
@@ -277,29 +371,20 @@ def api_status():
 def download_stats():
     """Endpoint para estadísticas de descarga"""
     try:
-        # Estadísticas básicas
-        total_downloads = DownloadLog.query.count()
-        successful_downloads = DownloadLog.query.filter_by(success=True).count()
-        failed_downloads = DownloadLog.query.filter_by(success=False).count()
-        
-        # Descargas por tipo
-        stats_by_type = db.session.query(
-            DownloadLog.file_type, 
-            db.func.count(DownloadLog.id).label('count')
-        ).group_by(DownloadLog.file_type).all()
+        # Estadísticas básicas (desde los agregados diarios)
+        total_downloads = rollups.total_downloads()
+        successful_downloads = rollups.total_downloads(success=True)
+        failed_downloads = total_downloads - successful_downloads
         
         # Archivos más descargados
-        popular_files = db.session.query(
-            DownloadLog.file_requested,
-            db.func.count(DownloadLog.id).label('count')
-        ).group_by(DownloadLog.file_requested).order_by(db.func.count(DownloadLog.id).desc()).limit(10).all()
+        popular_files = rollups.popular_files(limit=10)
         
         return jsonify({
             "total_downloads": total_downloads,
             "successful_downloads": successful_downloads,
             "failed_downloads": failed_downloads,
             "success_rate": round((successful_downloads / total_downloads * 100), 2) if total_downloads > 0 else 0,
-            "downloads_by_type": {stat[0]: stat[1] for stat in stats_by_type},
+            "downloads_by_type": rollups.downloads_by_type(),
             "popular_files": [{"file": stat[0], "downloads": stat[1]} for stat in popular_files]
         })
     except Exception as e:
@@ -1,10 +1,18 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, send_from_directory
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, abort
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_socketio import SocketIO, emit
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from models import db
+from log_writer import init_log_writer
+from sketches import init_sketches
+from package_builder import init_package_builder, published_package
+from patch_builder import init_patch_generator
+from job_queue import init_job_queue
+from scheduler import init_scheduler
+from file_delivery import send_resumable
+import blob_store
 import os
 import json
 import hashlib
@@ -23,10 +31,17 @@ app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'updates'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'files'), exist_ok=True)
+os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'patches'), exist_ok=True)
 os.makedirs('static/downloads', exist_ok=True)
 
 # Inicializar extensiones
 db.init_app(app)
+init_sketches(app)
+init_log_writer(app)
+init_package_builder(app)
+init_patch_generator(app)
+init_job_queue(app)
+init_scheduler(app)
 
 # IMPORTANTE: Inicializar SocketIO DESPUÉS de crear la app
 socketio = SocketIO(app, cors_allowed_origins="*", logger=True, engineio_logger=True)
@@ -127,17 +142,21 @@ def logout():
 @app.route('/Launcher/<path:filename>')
 def serve_launcher_files(filename):
     """Sirve archivos para el launcher C#"""
-    return send_from_directory('static/downloads', filename)
+    return send_resumable('static/downloads', filename)
 
 @app.route('/Launcher/updates/<path:filename>')
 def serve_update_files(filename):
     """Sirve archivos de actualización"""
-    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'updates'), filename)
+    package = published_package(filename)
+    if package is None:
+        abort(404)
+    return send_resumable(os.path.dirname(package.path), os.path.basename(package.path), etag=package.etag)
 
 @app.route('/Launcher/files/<path:filename>')
 def serve_game_files(filename):
     """Sirve archivos individuales del juego"""
-    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'files'), filename)
+    return send_resumable(os.path.join(app.config['UPLOAD_FOLDER'], 'files'), filename, GameFile,
+                          variants=blob_store.variant_paths)
 
 # ===== EVENTOS DE SOCKETIO =====
 
@@ -160,9 +179,10 @@ def handle_stats_request():
     """Cuando se solicitan estadísticas en tiempo real"""
     try:
         # Aquí puedes obtener estadísticas en tiempo real
-        from models import DownloadLog, GameVersion
+        from models import GameVersion
+        import rollups
         
-        total_downloads = DownloadLog.query.count()
+        total_downloads = rollups.total_downloads()
         latest_version = GameVersion.get_latest()
         
         stats = {
@@ -205,8 +225,10 @@ def create_admin_user():
         print("Usuario administrador creado: admin/admin123")
 
 if __name__ == '__main__':
+    from schema_upgrades import upgrade_schema
     with app.app_context():
         db.create_all()
+        upgrade_schema()
         #create_admin_user()
         port = 5000
         print(f"Iniciando servidor en puerto {port}")
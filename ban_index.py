@@ -0,0 +1,194 @@
+"""
+Índice en memoria de dispositivos (launcher_ban) para /api/check
+
+Mantiene mapas hash por hwid, serial_number y mac_address para responder la
+verificación de dispositivos sin consultar la base de datos. El índice se
+carga completo al arrancar, se actualiza de forma incremental cuando una
+ruta registra o modifica un dispositivo y se resincroniza periódicamente:
+cada BAN_INDEX_SYNC_INTERVAL segundos se leen las filas con id mayor que la
+última marca de agua, y cada BAN_INDEX_FULL_RELOAD_INTERVAL segundos se
+recarga entero (un solo hilo por proceso; el resto sigue usando los mapas
+anteriores mientras tanto).
+
+Los baneos se aplican modificando filas existentes, que la marca de agua no
+ve: el dispositivo que encuentra el índice se confirma con refresh(), una
+consulta por clave primaria, para que un baneo o desbaneo tenga efecto al
+momento.
+"""
+
+import threading
+import time
+from collections import defaultdict, namedtuple
+from flask import current_app
+from models import launcher_ban, db
+
+BanEntry = namedtuple('BanEntry', 'id hwid serial_number mac_address is_banned reason created_at')
+
+_COLUMNS = (
+    launcher_ban.id, launcher_ban.hwid, launcher_ban.serial_number,
+    launcher_ban.mac_address, launcher_ban.is_banned, launcher_ban.reason,
+    launcher_ban.created_at
+)
+
+
+class BanIndex:
+    """Mapas hwid/serial/mac -> dispositivo con marca de agua por id"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reload_lock = threading.Lock()
+        self._entries = {}
+        self._by_hwid = {}
+        self._by_serial = defaultdict(set)
+        self._by_mac = defaultdict(set)
+        self._max_id = 0
+        self._loaded = False
+        self._last_sync = 0
+        self._last_full = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _index(self, entry):
+        previous = self._entries.get(entry.id)
+        if previous is not None:
+            self._unindex(previous)
+
+        self._entries[entry.id] = entry
+        if entry.hwid:
+            self._by_hwid[entry.hwid] = entry.id
+        if entry.serial_number:
+            self._by_serial[entry.serial_number].add(entry.id)
+        if entry.mac_address:
+            self._by_mac[entry.mac_address].add(entry.id)
+        if entry.id > self._max_id:
+            self._max_id = entry.id
+
+    def _unindex(self, entry):
+        self._entries.pop(entry.id, None)
+        if entry.hwid and self._by_hwid.get(entry.hwid) == entry.id:
+            del self._by_hwid[entry.hwid]
+        for mapping, key in ((self._by_serial, entry.serial_number), (self._by_mac, entry.mac_address)):
+            if key and key in mapping:
+                mapping[key].discard(entry.id)
+                if not mapping[key]:
+                    del mapping[key]
+
+    def load(self):
+        """Cargar el índice completo desde la base de datos"""
+        rows = db.session.query(*_COLUMNS).all()
+
+        fresh = BanIndex()
+        for row in rows:
+            fresh._index(BanEntry(*row))
+
+        with self._lock:
+            self._entries = fresh._entries
+            self._by_hwid = fresh._by_hwid
+            self._by_serial = fresh._by_serial
+            self._by_mac = fresh._by_mac
+            self._max_id = fresh._max_id
+            self._loaded = True
+            self._last_sync = self._last_full = time.time()
+
+        current_app.logger.info(f"Índice de dispositivos cargado: {len(rows)} registros")
+        return len(rows)
+
+    def sync(self):
+        """Incorporar las filas nuevas posteriores a la marca de agua"""
+        rows = db.session.query(*_COLUMNS).filter(
+            launcher_ban.id > self._max_id
+        ).order_by(launcher_ban.id).all()
+
+        with self._lock:
+            for row in rows:
+                self._index(BanEntry(*row))
+            self._last_sync = time.time()
+
+        return len(rows)
+
+    def ensure_fresh(self):
+        """
+        Cargar o resincronizar según los intervalos configurados.
+
+        La primera carga la esperan todos los hilos; las siguientes las hace
+        el primero que llega y los demás siguen con los mapas actuales.
+        """
+        now = time.time()
+        full_interval = current_app.config.get('BAN_INDEX_FULL_RELOAD_INTERVAL', 300)
+        sync_interval = current_app.config.get('BAN_INDEX_SYNC_INTERVAL', 30)
+
+        if not self._loaded:
+            with self._reload_lock:
+                if not self._loaded:
+                    self.load()
+            return
+
+        if now - self._last_full >= full_interval:
+            refresh = self.load
+        elif now - self._last_sync >= sync_interval:
+            refresh = self.sync
+        else:
+            return
+
+        if self._reload_lock.acquire(blocking=False):
+            try:
+                refresh()
+            finally:
+                self._reload_lock.release()
+
+    def refresh(self, device_id):
+        """Releer un dispositivo por id y actualizar el índice (None si ya no existe)"""
+        row = db.session.query(*_COLUMNS).filter(launcher_ban.id == device_id).first()
+        with self._lock:
+            if row is None:
+                entry = self._entries.get(device_id)
+                if entry is not None:
+                    self._unindex(entry)
+                return None
+            entry = BanEntry(*row)
+            self._index(entry)
+            return entry
+
+    def lookup(self, hwid=None, serial=None, mac=None):
+        """
+        Buscar un dispositivo que coincida con todos los identificadores dados.
+
+        Equivale al filtro AND de la consulta original sobre launcher_ban.
+        """
+        with self._lock:
+            candidates = None
+
+            if hwid:
+                device_id = self._by_hwid.get(hwid)
+                if device_id is None:
+                    return None
+                candidates = {device_id}
+            if serial:
+                ids = self._by_serial.get(serial, set())
+                candidates = ids if candidates is None else candidates & ids
+            if mac:
+                ids = self._by_mac.get(mac, set())
+                candidates = ids if candidates is None else candidates & ids
+
+            if not candidates:
+                return None
+
+            return self._entries[min(candidates)]
+
+    def add(self, device):
+        """Registrar o actualizar un dispositivo (modelo launcher_ban ya confirmado)"""
+        entry = BanEntry(device.id, device.hwid, device.serial_number, device.mac_address,
+                         device.is_banned, device.reason, device.created_at)
+        with self._lock:
+            self._index(entry)
+        return entry
+
+    def remove(self, device_id):
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None:
+                self._unindex(entry)
+
+
+ban_index = BanIndex()
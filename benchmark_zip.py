@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Comparativa de creación de ZIP: zipfile secuencial frente a parallel_zip
+
+Uso:
+    python benchmark_zip.py [directorio] [--workers N] [--level N] [--exclude PATRÓN ...]
+
+Sin directorio se genera un árbol sintético con texto, binarios
+compresibles y datos aleatorios. Se mide la implementación anterior de
+utils.create_zip_archive (zipfile.write con ZIP_DEFLATED, un archivo
+tras otro) y create_zip_archive con cada ejecutor, y se comprueba que los
+ZIP resultantes contengan exactamente los mismos archivos.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from flask import Flask
+from utils import create_zip_archive, format_file_size
+
+
+def create_sample_tree(root, files=400, seed=1):
+    """Árbol de prueba de unos 200MB con una mezcla de contenidos típica de un cliente"""
+    rng = random.Random(seed)
+    words = [b'texture', b'model', b'sound', b'config', b'player', b'quest', b'item', b'npc']
+    for index in range(files):
+        kind = index % 4
+        directory = os.path.join(root, f'dir{index % 10}')
+        os.makedirs(directory, exist_ok=True)
+        size = rng.randint(64 * 1024, 1024 * 1024)
+        if kind == 0:
+            name, data = f'file{index}.xml', b' '.join(rng.choice(words) for _ in range(size // 6))
+        elif kind == 1:
+            name, data = f'file{index}.dll', bytes(rng.randrange(64) for _ in range(size // 64)) * 64
+        elif kind == 2:
+            name, data = f'file{index}.pak', os.urandom(size)
+        else:
+            name, data = f'file{index}.png', os.urandom(size)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data[:size])
+
+
+def legacy_create_zip_archive(source_path, zip_path, exclude_patterns=None):
+    """Implementación anterior de utils.create_zip_archive (referencia)"""
+    exclude_patterns = exclude_patterns or []
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for root, dirs, files in os.walk(source_path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                relative_path = os.path.relpath(file_path, source_path)
+                if not any(pattern in relative_path for pattern in exclude_patterns):
+                    zipf.write(file_path, relative_path)
+
+
+def tree_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def contents(zip_path):
+    with zipfile.ZipFile(zip_path) as zipf:
+        return {info.filename: info.CRC for info in zipf.infolist()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('source', nargs='?', help='directorio a comprimir (por defecto uno sintético)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--exclude', nargs='*', default=['.git', '__pycache__', '*.tmp'])
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='zip-bench-')
+    try:
+        source = args.source
+        if source is None:
+            source = os.path.join(work, 'tree')
+            print('Generando árbol de prueba...')
+            create_sample_tree(source)
+
+        total = tree_size(source)
+        print(f'Origen: {source} ({format_file_size(total)}), {args.workers} workers, nivel {args.level}\n')
+
+        app = Flask(__name__)
+        runs = [('secuencial (anterior)', lambda path: legacy_create_zip_archive(source, path, args.exclude))]
+        for executor in ('serial', 'thread', 'process'):
+            runs.append((f'parallel_zip {executor}', lambda path, executor=executor: create_zip_archive(
+                source, path, args.exclude, args.level, args.workers, executor
+            )))
+
+        reference = None
+        with app.app_context():
+            for label, run in runs:
+                zip_path = os.path.join(work, 'out.zip')
+                start = time.perf_counter()
+                result = run(zip_path)
+                elapsed = time.perf_counter() - start
+                if result is False:
+                    print(f'{label:28} error')
+                    continue
+
+                members = contents(zip_path)
+                if reference is None:
+                    reference = members
+                same = 'ok' if members == reference else 'DIFERENTE'
+                size = os.path.getsize(zip_path)
+                print(f'{label:28} {elapsed:7.2f}s  {format_file_size(int(total / elapsed))}/s  '
+                      f'{format_file_size(size)} ({100 * size / total:.1f}%)  contenido {same}')
+                os.remove(zip_path)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,543 @@
+"""
+Almacén de archivos del juego direccionado por contenido
+
+Cada contenido distinto se guarda una sola vez en
+uploads/blobs/<md5[0:2]>/<md5[2:4]>/<md5>, y launcher_file_blob lleva la
+cuenta de cuántas filas de GameFile lo referencian. uploads/files/<nombre>
+sigue existiendo como vista plana para las rutas de descarga por nombre: es
+un enlace (reflink, hardlink o copia, según BLOB_MATERIALIZE_MODE) al blob
+del GameFile más reciente con ese nombre. Las versiones antiguas siguen
+disponibles en /api/files/<nombre>?md5=<hash>.
+
+Flujo de escritura:
+    1. guardar la subida en temp_path() y registrarla con store_file()
+    2. acquire()/release() en la misma transacción que las filas de GameFile
+    3. tras el commit, settle_stored(), refresh_flat_view() y purge_unreferenced()
+
+Cada contenido puede llevar su manifiesto de bloques (FileChunkManifest),
+calculado en la misma pasada que el MD5 al guardar la subida, y los de tipo
+texto sus variantes precomprimidas junto al blob (<md5>.gz, .br, .zst).
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import bindparam, case, select
+from sqlalchemy.exc import IntegrityError
+from compression import FILE_SUFFIXES, available_encodings, compress_file, is_compressible
+from models import FileBlob, FileChunkManifest, GameFile, db
+from utils import BLOCK_HASH_ALGORITHM, HASH_CHUNK_SIZE, BlockHasher, calculate_file_hash
+
+FICLONE = 0x40049409  # ioctl de Linux para clonar un archivo (btrfs, xfs)
+
+_MD5_RE = re.compile(r'^[0-9a-f]{32}$')
+
+StoredFile = namedtuple('StoredFile', 'md5_hash file_size created spare')
+
+
+def blob_root():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'blobs')
+
+
+def flat_path(filename):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'files', filename)
+
+
+def blob_path(md5_hash):
+    """Ruta del blob en su directorio fragmentado, o None si el hash no es válido"""
+    md5_hash = (md5_hash or '').lower()
+    if not _MD5_RE.match(md5_hash):
+        return None
+    return os.path.join(blob_root(), md5_hash[:2], md5_hash[2:4], md5_hash)
+
+
+def temp_path():
+    """Ruta temporal dentro del almacén (mismo sistema de archivos que los blobs)"""
+    directory = os.path.join(blob_root(), 'tmp')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, uuid.uuid4().hex)
+
+
+def store_file(source_path, md5_hash=None):
+    """
+    Mover un archivo al almacén. Retorna un StoredFile.
+
+    `spare` es una reserva del contenido hasta que se registre: el propio
+    archivo de origen si el blob ya existía, o un enlace duro al blob nuevo.
+    settle_stored() la elimina tras la transacción, o la usa para restaurar
+    el blob si un purge_unreferenced() simultáneo lo borró entretanto.
+    """
+    md5_hash = md5_hash or calculate_file_hash(source_path, 'md5')
+    file_size = os.path.getsize(source_path)
+    target = blob_path(md5_hash)
+
+    if os.path.exists(target):
+        return StoredFile(md5_hash, file_size, False, source_path)
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(source_path, target)
+    try:
+        os.link(target, source_path)
+        spare = source_path
+    except OSError:
+        spare = None
+    return StoredFile(md5_hash, file_size, True, spare)
+
+
+def settle_stored(stored):
+    """
+    Cerrar un registro de store_file() tras su commit o rollback.
+
+    Los blobs con referencias cuyo archivo ya no está (purge_unreferenced()
+    los borró antes de que la referencia existiera) se restauran desde su
+    reserva; el resto de reservas se eliminan.
+    """
+    spares = [item for item in stored if item.spare]
+    if not spares:
+        return
+    registered = {row.md5_hash for row in db.session.query(FileBlob.md5_hash).filter(
+        FileBlob.md5_hash.in_({item.md5_hash for item in spares}), FileBlob.ref_count > 0
+    )}
+
+    for item in spares:
+        if not os.path.exists(item.spare):
+            continue
+        target = blob_path(item.md5_hash)
+        if item.md5_hash in registered and not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(item.spare, target)
+            current_app.logger.warning(f"Blob {item.md5_hash} restaurado: se purgó mientras se registraba")
+        else:
+            os.remove(item.spare)
+
+
+# ==================== REFERENCIAS ====================
+
+def acquire(md5_hash, file_size):
+    """Sumar una referencia al blob (sin confirmar la transacción)"""
+    apply_ref_deltas({md5_hash: 1}, {md5_hash: file_size})
+
+
+def release(md5_hash):
+    """
+    Restar una referencia al blob (sin confirmar la transacción).
+
+    El archivo no se borra aquí: purge_unreferenced() lo elimina después del
+    commit, de modo que un rollback nunca deja filas apuntando a blobs borrados.
+    """
+    apply_ref_deltas({md5_hash: -1}, {})
+
+
+def _dialect_insert():
+    """insert() con soporte ON CONFLICT para el dialecto activo, si existe"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+
+def apply_ref_deltas(deltas, sizes):
+    """
+    Aplicar en bloque variaciones de referencias {md5_hash: +n/-n}.
+
+    Las sumas se hacen en SQL sobre las filas bloqueadas (FOR UPDATE, siempre
+    en orden de hash para que dos transacciones no se esperen mutuamente), así
+    que dos ingestas o una ingesta y un borrado simultáneos no pierden
+    referencias. `sizes` da el tamaño de los blobs que aún no existen. Sin
+    confirmar la transacción.
+    """
+    hashes = sorted(md5_hash for md5_hash, delta in deltas.items() if delta)
+    if not hashes:
+        return
+
+    table = FileBlob.__table__
+    db.session.flush()
+    existing = set(db.session.execute(
+        select(table.c.md5_hash).where(table.c.md5_hash.in_(hashes))
+        .order_by(table.c.md5_hash).with_for_update()
+    ).scalars())
+
+    changed = [{'b_hash': md5_hash, 'b_delta': deltas[md5_hash]} for md5_hash in hashes if md5_hash in existing]
+    if changed:
+        refs = table.c.ref_count + bindparam('b_delta')
+        db.session.execute(
+            table.update().where(table.c.md5_hash == bindparam('b_hash'))
+            .values(ref_count=case((refs < 0, 0), else_=refs)),
+            changed
+        )
+
+    rows = [{'md5_hash': md5_hash, 'file_size': sizes[md5_hash], 'ref_count': deltas[md5_hash]}
+            for md5_hash in hashes if md5_hash not in existing and deltas[md5_hash] > 0]
+    if not rows:
+        return
+
+    insert = _dialect_insert()
+    if insert is not None:
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['md5_hash'],
+            set_={'ref_count': table.c.ref_count + stmt.excluded.ref_count}
+        )
+        db.session.execute(stmt, rows)
+        return
+
+    # Dialectos sin ON CONFLICT: insertar y si otro proceso se adelantó, sumar
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert(), row)
+        except IntegrityError:
+            db.session.execute(
+                table.update().where(table.c.md5_hash == row['md5_hash'])
+                .values(ref_count=table.c.ref_count + row['ref_count'])
+            )
+
+
+def purge_unreferenced(md5_hashes=None):
+    """
+    Eliminar los blobs sin referencias (todos o los indicados). Retorna cuántos.
+
+    Las filas se bloquean (FOR UPDATE) y se comprueba que ningún GameFile use
+    el hash antes de borrar los archivos; un registro simultáneo espera a que
+    termine esta transacción y después restaura el blob desde su reserva
+    (settle_stored).
+    """
+    query = FileBlob.query.filter(FileBlob.ref_count <= 0)
+    if md5_hashes is not None:
+        md5_hashes = list(set(md5_hashes))
+        if not md5_hashes:
+            return 0
+        query = query.filter(FileBlob.md5_hash.in_(md5_hashes))
+
+    blobs = query.order_by(FileBlob.md5_hash).with_for_update().all()
+    if not blobs:
+        db.session.commit()
+        return 0
+
+    in_use = dict(db.session.query(GameFile.md5_hash, db.func.count(GameFile.id)).filter(
+        GameFile.md5_hash.in_([blob.md5_hash for blob in blobs])
+    ).group_by(GameFile.md5_hash).all())
+    if in_use:
+        current_app.logger.warning(f"Blobs sin referencias pero en uso, se corrige su cuenta: {len(in_use)}")
+        for blob in blobs:
+            if blob.md5_hash in in_use:
+                blob.ref_count = in_use[blob.md5_hash]
+        blobs = [blob for blob in blobs if blob.md5_hash not in in_use]
+
+    for blob in blobs:
+        path = blob_path(blob.md5_hash)
+        if path and os.path.exists(path):
+            os.remove(path)
+        _remove_variants(path)
+        db.session.delete(blob)
+    if blobs:
+        FileChunkManifest.query.filter(
+            FileChunkManifest.md5_hash.in_([blob.md5_hash for blob in blobs])
+        ).delete(synchronize_session=False)
+    db.session.commit()
+
+    if blobs:
+        current_app.logger.info(f"Blobs sin referencias eliminados: {len(blobs)}")
+    return len(blobs)
+
+
+def discard_unregistered(md5_hashes):
+    """Borrar blobs recién guardados que no llegaron a registrarse (tras un rollback)"""
+    md5_hashes = set(md5_hashes)
+    if not md5_hashes:
+        return
+    registered = {row.md5_hash for row in db.session.query(FileBlob.md5_hash).filter(
+        FileBlob.md5_hash.in_(md5_hashes)
+    )}
+    for md5_hash in md5_hashes - registered:
+        path = blob_path(md5_hash)
+        if path and os.path.exists(path):
+            os.remove(path)
+        _remove_variants(path)
+
+
+def rebuild_refcounts():
+    """Recalcular ref_count a partir de las filas de GameFile"""
+    refs = select(db.func.count(GameFile.id)).where(
+        GameFile.md5_hash == FileBlob.md5_hash
+    ).scalar_subquery()
+    db.session.execute(FileBlob.__table__.update().values(ref_count=refs))
+    db.session.commit()
+
+
+# ==================== MANIFIESTOS DE BLOQUES ====================
+
+def record_chunk_manifests(manifests):
+    """
+    Registrar manifiestos de bloques (sin confirmar la transacción).
+
+    `manifests` es una lista de (md5_hash, file_size, chunk_size, digests);
+    se ignoran los contenidos que ya tienen uno.
+    """
+    manifests = {md5_hash: item for md5_hash, *item in manifests}
+    if not manifests:
+        return 0
+    known = {row.md5_hash for row in db.session.query(FileChunkManifest.md5_hash).filter(
+        FileChunkManifest.md5_hash.in_(list(manifests))
+    )}
+    rows = [{
+        'md5_hash': md5_hash, 'file_size': file_size, 'chunk_size': chunk_size,
+        'algorithm': BLOCK_HASH_ALGORITHM, 'digest_size': BlockHasher.digest_size, 'digests': digests
+    } for md5_hash, (file_size, chunk_size, digests) in manifests.items() if md5_hash not in known]
+    if rows:
+        db.session.execute(FileChunkManifest.__table__.insert(), rows)
+    return len(rows)
+
+
+def chunk_manifest(md5_hash, chunk_size, path=None):
+    """
+    Manifiesto de bloques de un contenido, o None si no existe.
+
+    Los contenidos guardados antes de que hubiera manifiestos se leen una vez
+    (del almacén, o de `path` para los que no están en él, como los paquetes
+    de actualización) y el resultado se guarda para las siguientes
+    peticiones; solo si el MD5 leído coincide con `md5_hash`.
+    """
+    manifest = db.session.get(FileChunkManifest, md5_hash)
+    if manifest is not None:
+        return manifest
+
+    if path is None:
+        path = blob_path(md5_hash)
+        if path is not None and db.session.get(FileBlob, md5_hash) is None:
+            path = None
+    if path is None or not os.path.exists(path):
+        return None
+
+    hasher = BlockHasher(chunk_size)
+    whole = hashlib.md5()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+            whole.update(chunk)
+            size += len(chunk)
+    if whole.hexdigest() != md5_hash:
+        return None  # el archivo cambió mientras tanto
+    try:
+        record_chunk_manifests([(md5_hash, size, chunk_size, hasher.digest())])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # otra petición lo guardó a la vez
+    return db.session.get(FileChunkManifest, md5_hash)
+
+
+# ==================== VARIANTES COMPRIMIDAS ====================
+
+def variant_paths(md5_hash):
+    """{codificación: ruta} de las variantes precomprimidas de un blob que se pueden servir"""
+    path = blob_path(md5_hash)
+    if path is None:
+        return {}
+    paths = {encoding: path + FILE_SUFFIXES[encoding] for encoding in available_encodings()}
+    return {encoding: variant for encoding, variant in paths.items() if os.path.exists(variant)}
+
+
+def _remove_variants(path):
+    if not path:
+        return
+    for suffix in FILE_SUFFIXES.values():
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _compress_blob(path, encodings):
+    created = 0
+    for encoding in encodings:
+        target = path + FILE_SUFFIXES[encoding]
+        if not os.path.exists(target) and compress_file(path, target, encoding) is not None:
+            created += 1
+    return created
+
+
+def create_variants(files):
+    """
+    Precomprimir los blobs de tipo texto que aún no tengan variantes.
+
+    `files` son pares (md5_hash, filename); el nombre decide si el contenido
+    es compresible. Se hace una sola vez por contenido, tras el commit de la
+    ingesta. Retorna cuántas variantes se crearon.
+    """
+    config = current_app.config
+    if not config.get('COMPRESSION_PRECOMPRESS_FILES', True):
+        return 0
+
+    max_size = config.get('COMPRESSION_MAX_FILE_SIZE', 256 * 1024 * 1024)
+    min_size = config.get('COMPRESSION_MIN_SIZE', 1024)
+    extensions = config.get('COMPRESSION_FILE_EXTENSIONS')
+    pending = set()
+    for md5_hash, filename in files:
+        path = blob_path(md5_hash)
+        if path is None or not is_compressible(filename, extensions) or not os.path.exists(path):
+            continue
+        if min_size <= os.path.getsize(path) <= max_size:
+            pending.add(path)
+    if not pending:
+        return 0
+
+    # zlib, brotli y zstandard liberan el GIL mientras comprimen
+    encodings = available_encodings()
+    with ThreadPoolExecutor(max_workers=config.get('COMPRESSION_WORKERS', 2),
+                            thread_name_prefix='precompress') as pool:
+        created = sum(pool.map(lambda path: _compress_blob(path, encodings), sorted(pending)))
+    if created:
+        current_app.logger.info(f"Variantes comprimidas creadas: {created} ({len(pending)} blobs)")
+    return created
+
+
+# ==================== VISTA PLANA ====================
+
+def _reflink(source, target):
+    import fcntl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _materialize_methods():
+    mode = current_app.config.get('BLOB_MATERIALIZE_MODE', 'auto')
+    if mode == 'reflink':
+        return (_reflink,)
+    if mode == 'hardlink':
+        return (os.link,)
+    if mode == 'copy':
+        return (shutil.copyfile,)
+    return (_reflink, os.link, shutil.copyfile)
+
+
+def materialize(md5_hash, target):
+    """Crear `target` con el contenido del blob sin duplicar bytes si el sistema lo permite"""
+    source = blob_path(md5_hash)
+    if source is None or not os.path.exists(source):
+        raise FileNotFoundError(f"Blob no encontrado: {md5_hash}")
+
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = f'{target}.{uuid.uuid4().hex}.tmp'
+
+    error = None
+    for method in _materialize_methods():
+        try:
+            method(source, tmp)
+            break
+        except OSError as e:
+            error = e
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    else:
+        raise error
+
+    os.replace(tmp, target)
+
+
+def latest_files(filenames):
+    """
+    {nombre: (md5_hash, file_size)} del GameFile vigente de cada nombre: el
+    más reciente por (updated_at, id), que es el que sirve la vista plana.
+    """
+    rows = db.session.query(
+        GameFile.filename, GameFile.md5_hash, GameFile.file_size
+    ).filter(
+        GameFile.filename.in_(list(filenames))
+    ).order_by(GameFile.updated_at, GameFile.id).all()
+
+    # Ordenadas de más antigua a más reciente: la última de cada nombre gana
+    return {filename: (md5_hash, file_size) for filename, md5_hash, file_size in rows}
+
+
+def latest_file(filename):
+    """(md5_hash, file_size) del GameFile vigente de `filename`, o None"""
+    return latest_files([filename]).get(filename)
+
+
+def refresh_flat_view(filename):
+    """
+    Apuntar uploads/files/<filename> al GameFile más reciente con ese nombre,
+    o eliminarlo si ya no queda ninguno.
+    """
+    refresh_flat_views([filename])
+
+
+def refresh_flat_views(filenames, batch_size=500):
+    """refresh_flat_view() para muchos nombres con una consulta por lote"""
+    filenames = list(set(filenames))
+    for start in range(0, len(filenames), batch_size):
+        batch = filenames[start:start + batch_size]
+        latest = latest_files(batch)
+        for filename in batch:
+            target = flat_path(filename)
+            if filename not in latest:
+                if os.path.exists(target):
+                    os.remove(target)
+                continue
+            try:
+                materialize(latest[filename][0], target)
+            except FileNotFoundError as e:
+                current_app.logger.warning(f"No se pudo materializar {filename}: {e}")
+
+
+# ==================== MIGRACIÓN ====================
+
+def adopt_flat_files():
+    """
+    Incorporar al almacén los archivos subidos antes de que existiera.
+
+    Para cada hash de GameFile sin blob se usa uploads/files/<nombre> si su
+    contenido coincide; el archivo se enlaza (no se copia) al almacén.
+    Retorna (blobs creados, hashes cuyo contenido ya no está en disco).
+    """
+    known = db.session.query(FileBlob.md5_hash)
+    rows = db.session.query(GameFile.md5_hash, GameFile.filename).filter(
+        GameFile.md5_hash.notin_(known)
+    ).group_by(GameFile.md5_hash, GameFile.filename).all()
+
+    created = 0
+    missing = set()
+    flat_hashes = {}
+    for md5_hash, filename in rows:
+        if db.session.get(FileBlob, md5_hash) is not None:
+            continue
+
+        source = flat_path(filename)
+        target = blob_path(md5_hash)
+        if filename not in flat_hashes:
+            flat_hashes[filename] = calculate_file_hash(source, 'md5') if os.path.exists(source) else None
+        if target is None or flat_hashes[filename] != md5_hash:
+            missing.add(md5_hash)
+            continue
+
+        missing.discard(md5_hash)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+
+        db.session.add(FileBlob(md5_hash=md5_hash, file_size=os.path.getsize(target), ref_count=0))
+        db.session.flush()
+        created += 1
+
+    db.session.commit()
+    if created:
+        rebuild_refcounts()
+    if missing:
+        current_app.logger.warning(
+            f"{len(missing)} hashes de GameFile sin contenido en disco (sobrescritos antes del almacén)"
+        )
+    return created, missing
@@ -0,0 +1,225 @@
+"""
+Variantes precomprimidas y negociación de Accept-Encoding
+
+Las respuestas que se repiten (manifiesto, deltas, mensajes) y los archivos
+del juego de tipos compresibles se comprimen una sola vez, al construir el
+snapshot o al ingerir el archivo, con gzip y, si están instalados, brotli y
+zstandard. Cada petición solo elige la variante según Accept-Encoding, sin
+gastar CPU en comprimir, y la respuesta lleva Vary: Accept-Encoding y un
+ETag distinto por codificación.
+
+Para el resto de respuestas JSON/texto de la API, compress_response()
+comprime al vuelo como último recurso, solo dentro de un rango de tamaños.
+"""
+
+import gzip
+import mimetypes
+import os
+import uuid
+import zlib
+from flask import current_app, request, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COPY_BUFFER_SIZE = 1024 * 1024
+MIN_SAVINGS_RATIO = 0.9  # una variante que no ahorra al menos un 10 % no se guarda
+
+# Niveles para variantes guardadas (se comprimen una vez) y para compresión al vuelo
+PRECOMPRESS_LEVELS = {'br': 9, 'zstd': 15, 'gzip': 9}
+DYNAMIC_LEVELS = {'br': 4, 'zstd': 3, 'gzip': 5}
+
+FILE_SUFFIXES = {'br': '.br', 'zstd': '.zst', 'gzip': '.gz'}
+COMPRESSIBLE_EXTENSIONS = frozenset({
+    'txt', 'xml', 'json', 'html', 'htm', 'ini', 'cfg', 'csv', 'lua', 'js', 'css', 'log'
+})
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/xml', 'application/javascript', 'text/')
+
+
+def _supported(encoding):
+    if encoding == 'br':
+        return brotli is not None
+    if encoding == 'zstd':
+        return zstandard is not None
+    return encoding == 'gzip'
+
+
+def available_encodings():
+    """Codificaciones configuradas e instaladas, en orden de preferencia del servidor"""
+    configured = current_app.config.get('COMPRESSION_ENCODINGS', ('br', 'zstd', 'gzip'))
+    return tuple(encoding for encoding in configured if _supported(encoding))
+
+
+def is_compressible(filename, extensions=None):
+    """True si la extensión del archivo indica contenido de texto"""
+    if not filename or '.' not in filename:
+        return False
+    return filename.rsplit('.', 1)[1].lower() in (extensions or COMPRESSIBLE_EXTENSIONS)
+
+
+# ==================== COMPRESIÓN ====================
+
+def compress_bytes(data, encoding, level=None):
+    level = PRECOMPRESS_LEVELS[encoding] if level is None else level
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"Codificación no soportada: {encoding}")
+
+
+def _file_compressor(encoding, level):
+    """Objeto con compress()/flush() para comprimir un archivo por trozos"""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: formato gzip
+        return compressor.compress, compressor.flush
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        return compressor.process, compressor.finish
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        return compressor.compress, compressor.flush
+    raise ValueError(f"Codificación no soportada: {encoding}")
+
+
+def compress_file(source, target, encoding, level=None):
+    """
+    Comprimir `source` en `target` (escritura atómica).
+
+    Retorna el tamaño comprimido, o None (sin dejar archivo) si no ahorra
+    lo suficiente.
+    """
+    level = PRECOMPRESS_LEVELS[encoding] if level is None else level
+    compress, flush = _file_compressor(encoding, level)
+    tmp = f'{target}.{uuid.uuid4().hex}.part'
+    size = 0
+    try:
+        with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+            for chunk in iter(lambda: src.read(COPY_BUFFER_SIZE), b''):
+                dst.write(compress(chunk))
+            dst.write(flush())
+            size = dst.tell()
+        if size >= os.path.getsize(source) * MIN_SAVINGS_RATIO:
+            return None
+        os.replace(tmp, target)
+        return size
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def build_variants(data):
+    """Variantes comprimidas de un cuerpo ya serializado: {codificación: bytes}"""
+    if len(data) < current_app.config.get('COMPRESSION_MIN_SIZE', 1024):
+        return {}
+    variants = {}
+    for encoding in available_encodings():
+        compressed = compress_bytes(data, encoding)
+        if len(compressed) < len(data) * MIN_SAVINGS_RATIO:
+            variants[encoding] = compressed
+    return variants
+
+
+# ==================== NEGOCIACIÓN ====================
+
+def negotiate(encodings):
+    """Mejor codificación de `encodings` según Accept-Encoding, o None para identidad"""
+    if not encodings:
+        return None
+    return request.accept_encodings.best_match(list(encodings))
+
+
+def variant_etag(etag, encoding):
+    return f'{etag}-{encoding}' if encoding else etag
+
+
+def _not_modified(etag, encoding):
+    # Comparación débil (RFC 9110): cualquier codificación del mismo contenido vale
+    return request.if_none_match.contains(variant_etag(etag, encoding)) or request.if_none_match.contains(etag)
+
+
+def snapshot_response(body, variants, etag, status=200, mimetype='application/json',
+                      cache_control='no-cache'):
+    """Respuesta de un cuerpo precalculado eligiendo su variante por Accept-Encoding"""
+    encoding = negotiate(variants)
+    tag = variant_etag(etag, encoding)
+
+    if _not_modified(etag, encoding):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(
+            variants[encoding] if encoding else body, status=status, mimetype=mimetype
+        )
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def send_variant(identity_path, etag, paths):
+    """
+    Enviar la variante precomprimida de un archivo si el cliente acepta alguna.
+
+    `paths` es {codificación: ruta}. Retorna None si no hay variante aceptable
+    (el llamador sirve el original, que también debe llevar Vary).
+    """
+    encoding = negotiate(paths)
+    if encoding is None:
+        return None
+
+    mimetype = mimetypes.guess_type(identity_path)[0] or 'application/octet-stream'
+    response = send_file(paths[encoding], mimetype=mimetype, etag=variant_etag(etag, encoding),
+                         conditional=True, max_age=0)
+    if response.status_code == 200:
+        response.headers['Content-Encoding'] = encoding
+    if _not_modified(etag, encoding) and response.status_code != 304:
+        response = current_app.response_class(status=304)
+        response.set_etag(variant_etag(etag, encoding))
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# ==================== AL VUELO ====================
+
+def compress_response(response):
+    """
+    Comprimir al vuelo una respuesta JSON o de texto (after_request).
+
+    Solo como último recurso: se omiten las respuestas ya negociadas, las de
+    archivos, las parciales y las que quedan fuera de
+    [COMPRESSION_MIN_SIZE, COMPRESSION_DYNAMIC_MAX_SIZE].
+    """
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or 'Accept-Encoding' in response.vary
+            or not (response.mimetype or '').startswith(COMPRESSIBLE_MIMETYPES)):
+        return response
+
+    length = response.calculate_content_length() or 0
+    config = current_app.config
+    if length < config.get('COMPRESSION_MIN_SIZE', 1024) or length > config.get('COMPRESSION_DYNAMIC_MAX_SIZE', 1024 * 1024):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(available_encodings())
+    if encoding is None:
+        return response
+
+    data = compress_bytes(response.get_data(), encoding, DYNAMIC_LEVELS[encoding])
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(variant_etag(etag, encoding), weak)
+    return response
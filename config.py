@@ -44,10 +44,109 @@ class Config:
     LAUNCHER_URL_BASE = os.environ.get('LAUNCHER_URL_BASE') or 'http://localhost:5000/Launcher'
     LAUNCHER_CHECK_INTERVAL = int(os.environ.get('LAUNCHER_CHECK_INTERVAL', '300'))  # 5 minutos
     
+    # Configuración del manifiesto de actualizaciones (/api/update)
+    MANIFEST_SNAPSHOT_CHECK_INTERVAL = int(os.environ.get('MANIFEST_SNAPSHOT_CHECK_INTERVAL', '5'))  # segundos
+    MANIFEST_DELTA_CACHE_SIZE = int(os.environ.get('MANIFEST_DELTA_CACHE_SIZE', '256'))  # pares (desde, hasta)
+    
+    # Configuración del registro de descargas (escritura asíncrona por lotes)
+    DOWNLOAD_LOG_ASYNC = os.environ.get('DOWNLOAD_LOG_ASYNC', 'True').lower() == 'true'
+    DOWNLOAD_LOG_QUEUE_SIZE = int(os.environ.get('DOWNLOAD_LOG_QUEUE_SIZE', '10000'))
+    DOWNLOAD_LOG_BATCH_SIZE = int(os.environ.get('DOWNLOAD_LOG_BATCH_SIZE', '500'))
+    DOWNLOAD_LOG_FLUSH_INTERVAL_MS = int(os.environ.get('DOWNLOAD_LOG_FLUSH_INTERVAL_MS', '1000'))
+    DOWNLOAD_LOG_QUEUE_POLICY = os.environ.get('DOWNLOAD_LOG_QUEUE_POLICY', 'drop')  # drop, block, sync
+    DOWNLOAD_LOG_BLOCK_TIMEOUT_MS = int(os.environ.get('DOWNLOAD_LOG_BLOCK_TIMEOUT_MS', '50'))
+    LOG_INTERN_CACHE_SIZE = int(os.environ.get('LOG_INTERN_CACHE_SIZE', '10000'))  # User-Agent/archivos en caché por proceso
+    LOG_SKETCHES_ENABLED = os.environ.get('LOG_SKETCHES_ENABLED', 'True').lower() == 'true'  # IPs únicas y top-K aproximados
+    LOG_HLL_PRECISION = int(os.environ.get('LOG_HLL_PRECISION', '12'))  # 2^12 registros: error estándar ~1.6%
+    LOG_TOPK_CAPACITY = int(os.environ.get('LOG_TOPK_CAPACITY', '100'))  # contadores por sketch de más descargados
+    LOG_SKETCH_FLUSH_INTERVAL = int(os.environ.get('LOG_SKETCH_FLUSH_INTERVAL', '60'))  # segundos entre volcados
+    LOG_PARTITIONING_ENABLED = os.environ.get('LOG_PARTITIONING_ENABLED', 'True').lower() == 'true'  # solo PostgreSQL
+    LOG_PARTITION_PREMAKE_MONTHS = int(os.environ.get('LOG_PARTITION_PREMAKE_MONTHS', '2'))  # meses creados por adelantado
+    LOG_PARTITION_CHECK_INTERVAL = int(os.environ.get('LOG_PARTITION_CHECK_INTERVAL', '86400'))
+    
+    # Configuración del índice de dispositivos (/api/check)
+    BAN_INDEX_ENABLED = os.environ.get('BAN_INDEX_ENABLED', 'True').lower() == 'true'
+    BAN_INDEX_SYNC_INTERVAL = int(os.environ.get('BAN_INDEX_SYNC_INTERVAL', '30'))  # filas nuevas por marca de agua
+    BAN_INDEX_FULL_RELOAD_INTERVAL = int(os.environ.get('BAN_INDEX_FULL_RELOAD_INTERVAL', '300'))  # recarga completa
+    
+    # Configuración de descargas reanudables (Range / If-Range)
+    FILE_MAX_RANGES = int(os.environ.get('FILE_MAX_RANGES', '16'))  # más rangos se sirve el archivo completo
+    FILE_BLOCK_MANIFEST_SIZE = int(os.environ.get('FILE_BLOCK_MANIFEST_SIZE', str(1024 * 1024)))  # bloques guardados al ingerir
+    
+    # Almacén por contenido de archivos del juego: auto (reflink, hardlink o copia), reflink, hardlink, copy
+    BLOB_MATERIALIZE_MODE = os.environ.get('BLOB_MATERIALIZE_MODE', 'auto').lower()
+    
+    # Ingesta masiva de archivos del juego (hilos para guardar y hashear en paralelo)
+    INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', str(min(8, (os.cpu_count() or 1) * 2))))
+    BUILD_ARCHIVE_MAX_UNCOMPRESSED = int(os.environ.get('BUILD_ARCHIVE_MAX_UNCOMPRESSED', str(50 * 1024 ** 3)))  # bytes descomprimidos por ZIP de build
+    
+    # Construcción automática de paquetes de actualización (hilo de fondo por worker)
+    PACKAGE_BUILD_ENABLED = os.environ.get('PACKAGE_BUILD_ENABLED', 'True').lower() == 'true'
+    PACKAGE_BUILD_WORKERS = int(os.environ.get('PACKAGE_BUILD_WORKERS', str(os.cpu_count() or 1)))  # hilos de compresión
+    PACKAGE_BUILD_COMPRESS_LEVEL = int(os.environ.get('PACKAGE_BUILD_COMPRESS_LEVEL', '6'))  # 0 = todo sin comprimir
+    PACKAGE_BUILD_POLL_INTERVAL = int(os.environ.get('PACKAGE_BUILD_POLL_INTERVAL', '10'))  # segundos
+    PACKAGE_BUILD_STALE_SECONDS = int(os.environ.get('PACKAGE_BUILD_STALE_SECONDS', '120'))  # sin latido: se retoma
+    
+    # Parches binarios (bsdiff4) entre versiones consecutivas de cada archivo
+    PATCH_ENABLED = os.environ.get('PATCH_ENABLED', 'True').lower() == 'true'
+    PATCH_WORKERS = int(os.environ.get('PATCH_WORKERS', '2'))  # procesos de generación
+    PATCH_WORKER_MEMORY_LIMIT = int(os.environ.get('PATCH_WORKER_MEMORY_LIMIT', str(2 * 1024 ** 3)))  # bytes por proceso
+    PATCH_MAX_RATIO = float(os.environ.get('PATCH_MAX_RATIO', '0.6'))  # parche / archivo completo máximo
+    PATCH_POLL_INTERVAL = int(os.environ.get('PATCH_POLL_INTERVAL', '30'))  # segundos
+    PATCH_STALE_SECONDS = int(os.environ.get('PATCH_STALE_SECONDS', '900'))  # reclamado sin terminar: se retoma
+    
+    # Creación de ZIP (utils.create_zip_archive): process, thread o serial
+    ZIP_EXECUTOR = os.environ.get('ZIP_EXECUTOR', 'process').lower()
+    ZIP_WORKERS = int(os.environ.get('ZIP_WORKERS', str(os.cpu_count() or 1)))
+    ZIP_COMPRESS_LEVEL = int(os.environ.get('ZIP_COMPRESS_LEVEL', '6'))
+    
+    # Cola de tareas en segundo plano (eliminar versiones, limpiar logs, importar builds...)
+    JOB_QUEUE_ENABLED = os.environ.get('JOB_QUEUE_ENABLED', 'True').lower() == 'true'
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))  # hilos por proceso
+    JOB_POLL_INTERVAL = int(os.environ.get('JOB_POLL_INTERVAL', '5'))  # segundos
+    JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', '300'))  # en curso sin latido: se retoma
+    JOB_HEARTBEAT_INTERVAL = int(os.environ.get('JOB_HEARTBEAT_INTERVAL', '60'))  # segundos entre latidos de una tarea en curso
+    JOB_RETRY_DELAY = int(os.environ.get('JOB_RETRY_DELAY', '30'))  # segundos, se duplica en cada reintento
+    JOB_PROGRESS_INTERVAL = float(os.environ.get('JOB_PROGRESS_INTERVAL', '1'))  # segundos entre avisos de progreso
+    JOB_IDEMPOTENCY_SECONDS = int(os.environ.get('JOB_IDEMPOTENCY_SECONDS', '3600'))  # una tarea terminada con la misma clave no se repite
+    JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', '1000'))  # archivos por lote al eliminar versiones
+    JOB_LOG_BATCH_SIZE = int(os.environ.get('JOB_LOG_BATCH_SIZE', '10000'))  # logs por lote al limpiar
+    
+    # Compresión de respuestas: variantes precalculadas (manifiesto, mensajes, archivos de texto)
+    # y al vuelo para el resto del JSON de la API; br y zstd solo si brotli/zstandard están instalados
+    COMPRESSION_ENCODINGS = tuple(os.environ.get('COMPRESSION_ENCODINGS', 'br,zstd,gzip').replace(' ', '').split(','))
+    COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))  # bytes; por debajo no se comprime
+    COMPRESSION_DYNAMIC_MAX_SIZE = int(os.environ.get('COMPRESSION_DYNAMIC_MAX_SIZE', str(1024 * 1024)))  # al vuelo
+    COMPRESSION_PRECOMPRESS_FILES = os.environ.get('COMPRESSION_PRECOMPRESS_FILES', 'True').lower() == 'true'
+    COMPRESSION_FILE_EXTENSIONS = {'txt', 'xml', 'json', 'html', 'htm', 'ini', 'cfg', 'csv', 'lua', 'js', 'css', 'log'}
+    COMPRESSION_MAX_FILE_SIZE = int(os.environ.get('COMPRESSION_MAX_FILE_SIZE', str(256 * 1024 * 1024)))
+    COMPRESSION_WORKERS = int(os.environ.get('COMPRESSION_WORKERS', '2'))  # hilos al precomprimir en la ingesta
+    
+    # Entrega de archivos: none, sendfile (os.sendfile bajo gunicorn), x-accel (nginx) o x-sendfile (Apache)
+    FILE_OFFLOAD_MODE = os.environ.get('FILE_OFFLOAD_MODE', 'none').lower()
+    FILE_OFFLOAD_ROOT = os.environ.get('FILE_OFFLOAD_ROOT')  # raíz que el proxy sirve; por defecto la de la aplicación
+    FILE_OFFLOAD_ACCEL_PREFIX = os.environ.get('FILE_OFFLOAD_ACCEL_PREFIX', '/_protected/')
+    
     # Configuración de backup
     BACKUP_ENABLED = os.environ.get('BACKUP_ENABLED', 'True').lower() == 'true'
     BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL', '3600'))  # 1 hora
     BACKUP_RETENTION_DAYS = int(os.environ.get('BACKUP_RETENTION_DAYS', '30'))
+    BACKUP_FOLDER = os.environ.get('BACKUP_FOLDER')  # por defecto uploads/backups
+    
+    # Mantenimiento periódico (scheduler.py); cada tarea se encola una vez por intervalo entre todos los procesos
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'True').lower() == 'true'
+    SCHEDULER_POLL_INTERVAL = int(os.environ.get('SCHEDULER_POLL_INTERVAL', '60'))  # segundos
+    SCHEDULER_JITTER = int(os.environ.get('SCHEDULER_JITTER', '300'))  # margen aleatorio máximo (hasta 1/10 del intervalo)
+    SCHEDULER_LEASE_SECONDS = int(os.environ.get('SCHEDULER_LEASE_SECONDS', '120'))  # turno caducado: lo toma otro proceso
+    SCHEDULER_HISTORY_DAYS = int(os.environ.get('SCHEDULER_HISTORY_DAYS', '30'))
+    LOG_RETENTION_ENABLED = os.environ.get('LOG_RETENTION_ENABLED', 'True').lower() == 'true'
+    LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', '90'))
+    LOG_RETENTION_INTERVAL = int(os.environ.get('LOG_RETENTION_INTERVAL', '86400'))  # 1 día
+    ROLLUP_REFRESH_ENABLED = os.environ.get('ROLLUP_REFRESH_ENABLED', 'True').lower() == 'true'
+    ROLLUP_REFRESH_INTERVAL = int(os.environ.get('ROLLUP_REFRESH_INTERVAL', '86400'))  # recalcula el día anterior
+    INTEGRITY_SCAN_ENABLED = os.environ.get('INTEGRITY_SCAN_ENABLED', 'True').lower() == 'true'
+    INTEGRITY_SCAN_INTERVAL = int(os.environ.get('INTEGRITY_SCAN_INTERVAL', '86400'))
+    INTEGRITY_SCAN_VERIFY_HASH = os.environ.get('INTEGRITY_SCAN_VERIFY_HASH', 'False').lower() == 'true'  # relee cada blob
     
     # Configuración de notificaciones
     NOTIFICATION_ENABLED = os.environ.get('NOTIFICATION_ENABLED', 'False').lower() == 'true'
@@ -0,0 +1,298 @@
+"""
+Entrega de archivos del juego y paquetes de actualización con soporte de
+descargas reanudables
+
+Las respuestas llevan un ETag fuerte derivado del md5_hash y file_size
+guardados en la base de datos, de modo que el launcher puede reanudar con
+Range + If-Range sin arriesgarse a mezclar bytes de dos versiones distintas
+del mismo archivo. Se aceptan rangos simples (206 con Content-Range) y
+múltiples (206 multipart/byteranges).
+
+Para verificar descargas parciales se ofrece además el manifiesto de bloques
+de un archivo (block_manifest_response), calculado al subirlo. Los archivos
+con variantes precomprimidas se envían con la que acepte el cliente
+(Content-Encoding) cuando no se pide un rango.
+
+FILE_OFFLOAD_MODE permite que los workers solo resuelvan metadatos:
+    none       - Flask/Werkzeug envía los bytes
+    sendfile   - bajo gunicorn, archivos completos y rangos simples con os.sendfile
+    x-accel    - cabecera X-Accel-Redirect para nginx (location interna)
+    x-sendfile - cabecera X-Sendfile para Apache mod_xsendfile / lighttpd
+"""
+
+import mimetypes
+import os
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import quote
+from flask import Response, current_app, request, send_from_directory
+from werkzeug.datastructures import Range
+from werkzeug.exceptions import NotFound, RequestedRangeNotSatisfiable
+from werkzeug.http import http_date, is_resource_modified, parse_range_header
+from werkzeug.security import safe_join
+from compression import send_variant
+from models import GameFile, db
+import blob_store
+
+READ_BLOCK_SIZE = 64 * 1024
+OFFLOAD_MODES = ('none', 'sendfile', 'x-accel', 'x-sendfile')
+
+
+def resolve_path(directory, filename):
+    """Ruta absoluta segura de `filename` dentro de `directory`, o NotFound"""
+    directory = os.path.join(current_app.root_path, directory)
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+    return path
+
+
+def strong_etag(model, filename, file_size):
+    """
+    ETag fuerte "md5-tamaño" del registro que corresponde al archivo en disco.
+
+    Para GameFile es el registro vigente que materializa la vista plana
+    (blob_store.latest_file); para el resto, el más reciente con ese nombre.
+    Si su tamaño no coincide con el del disco (p. ej. la vista aún no se ha
+    actualizado) retorna None y la respuesta usará el ETag por defecto de
+    Werkzeug, que nunca coincide con el de otro contenido.
+    """
+    name = os.path.basename(filename)
+    if model is GameFile:
+        row = blob_store.latest_file(name)
+    else:
+        row = db.session.query(model.md5_hash, model.file_size).filter(
+            model.filename == name
+        ).order_by(model.id.desc()).first()
+
+    if row is None or not row[0] or row[1] != file_size:
+        return None
+    return f'{row[0]}-{file_size}'
+
+
+def _satisfiable_ranges(parsed, file_size):
+    """Rangos (inicio, fin) satisfacibles, ordenados y fusionados si se solapan"""
+    spans = []
+    for start, stop in parsed.ranges:
+        span = Range(parsed.units, [(start, stop)]).range_for_length(file_size)
+        if span is not None:
+            spans.append(span)
+
+    merged = []
+    for start, stop in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _read_span(path, start, stop):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(READ_BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def _multipart_response(path, spans, file_size, etag, last_modified):
+    """Respuesta 206 con uno o varios rangos"""
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(last_modified)
+    }
+
+    if len(spans) == 1:
+        start, stop = spans[0]
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{file_size}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(_read_span(path, start, stop), status=206, headers=headers,
+                        mimetype='application/octet-stream', direct_passthrough=True)
+
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f'--{boundary}\r\nContent-Type: application/octet-stream\r\n'
+         f'Content-Range: bytes {start}-{stop - 1}/{file_size}\r\n\r\n').encode('ascii')
+        for start, stop in spans
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+    def generate():
+        for index, (start, stop) in enumerate(spans):
+            if index:
+                yield b'\r\n'
+            yield part_headers[index]
+            yield from _read_span(path, start, stop)
+        yield closing
+
+    length = (sum(len(h) for h in part_headers) + sum(stop - start for start, stop in spans)
+              + 2 * (len(spans) - 1) + len(closing))
+    headers['Content-Length'] = str(length)
+    return Response(generate(), status=206, headers=headers,
+                    content_type=f'multipart/byteranges; boundary={boundary}',
+                    direct_passthrough=True)
+
+
+def _offload_response(path, etag, last_modified, mode):
+    """
+    Delegar la transferencia al proxy frontal (X-Accel-Redirect o X-Sendfile).
+
+    Flask solo responde las cabeceras; nginx/Apache se encargan de los bytes,
+    de Range y de If-Range. Retorna None si la ruta no se puede mapear.
+    """
+    headers = {'Last-Modified': http_date(last_modified)}
+    if etag:
+        headers['ETag'] = f'"{etag}"'
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return Response(status=304, headers=headers)
+
+    if mode == 'x-accel':
+        root = current_app.config.get('FILE_OFFLOAD_ROOT') or current_app.root_path
+        relative = os.path.relpath(path, os.path.abspath(root))
+        if relative.startswith(os.pardir):
+            current_app.logger.warning(f"Archivo fuera de FILE_OFFLOAD_ROOT, se envía desde Python: {path}")
+            return None
+        prefix = current_app.config.get('FILE_OFFLOAD_ACCEL_PREFIX', '/_protected/').rstrip('/')
+        headers['X-Accel-Redirect'] = f"{prefix}/{quote(relative.replace(os.sep, '/'))}"
+    else:
+        headers['X-Sendfile'] = path
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    return Response(headers=headers, mimetype=mimetype)
+
+
+def _sendfile_range_response(path, span, file_size, etag, last_modified):
+    """
+    Rango simple mediante wsgi.file_wrapper de gunicorn.
+
+    El archivo se posiciona en el inicio del rango y gunicorn envía
+    Content-Length bytes con os.sendfile, sin copiarlos a Python.
+    """
+    start, stop = span
+    f = open(path, 'rb')
+    f.seek(start)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Range': f'bytes {start}-{stop - 1}/{file_size}',
+        'Content-Length': str(stop - start),
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(last_modified)
+    }
+    return Response(request.environ['wsgi.file_wrapper'](f), status=206, headers=headers,
+                    mimetype='application/octet-stream', direct_passthrough=True)
+
+
+def offload_mode():
+    """Modo de entrega configurado: none, sendfile, x-accel o x-sendfile"""
+    mode = current_app.config.get('FILE_OFFLOAD_MODE', 'none')
+    return mode if mode in OFFLOAD_MODES else 'none'
+
+
+def send_resumable(directory, filename, model=None, etag=None, variants=None):
+    """
+    Enviar un archivo con ETag fuerte, peticiones condicionales y rangos.
+
+    Según FILE_OFFLOAD_MODE la transferencia se delega al proxy frontal o,
+    bajo gunicorn, se hace con os.sendfile. En otro caso los rangos simples
+    los resuelve send_from_directory y las peticiones con varios rangos se
+    responden aquí como multipart/byteranges. `etag` permite indicar el ETag
+    cuando ya se conoce (p. ej. blobs direccionados por contenido).
+
+    `variants` es una función md5_hash -> {codificación: ruta} con las
+    variantes precomprimidas del contenido; sin Range se envía la que mejor
+    encaje con Accept-Encoding y, haya o no, la respuesta lleva Vary.
+    """
+    path = resolve_path(directory, filename)
+    stat = os.stat(path)
+    if etag is None and model is not None:
+        etag = strong_etag(model, filename, stat.st_size)
+    last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+    mode = offload_mode()
+
+    if mode in ('x-accel', 'x-sendfile'):
+        response = _offload_response(path, etag, last_modified, mode)
+        if response is not None:
+            return response
+
+    # Los ETag fuertes de este módulo son "md5-tamaño"
+    paths = variants(etag.split('-', 1)[0]) if variants is not None and etag else None
+    if not paths:
+        return _send_identity(path, stat, etag, last_modified, mode)
+
+    response = None
+    if 'Range' not in request.headers:
+        response = send_variant(path, etag, paths)
+    if response is None:
+        response = _send_identity(path, stat, etag, last_modified, mode)
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def _send_identity(path, stat, etag, last_modified, mode):
+    """Enviar el archivo sin codificar, resolviendo rangos y condicionales"""
+    environ = request.environ
+    parsed = parse_range_header(request.headers.get('Range'))
+    if etag and parsed is not None and request.method in ('GET', 'HEAD'):
+        modified = is_resource_modified(environ, etag=etag, last_modified=last_modified)
+        if_range_matches = 'HTTP_IF_RANGE' not in environ or not is_resource_modified(
+            environ, etag=etag, last_modified=last_modified, ignore_if_range=False
+        )
+        max_ranges = current_app.config.get('FILE_MAX_RANGES', 16)
+        sendfile = (mode == 'sendfile' and request.method == 'GET'
+                    and environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'))
+
+        if modified and if_range_matches and len(parsed.ranges) <= max_ranges:
+            spans = _satisfiable_ranges(parsed, stat.st_size)
+            if not spans:
+                return RequestedRangeNotSatisfiable(length=stat.st_size).get_response()
+            if len(spans) == 1 and sendfile:
+                return _sendfile_range_response(path, spans[0], stat.st_size, etag, last_modified)
+            if len(parsed.ranges) > 1:
+                return _multipart_response(path, spans, stat.st_size, etag, last_modified)
+
+        if len(parsed.ranges) > 1:
+            # send_from_directory no admite varios rangos: con If-Range distinto o
+            # demasiados rangos se sirve el archivo completo
+            environ.pop('HTTP_RANGE', None)
+
+    # Sin rango, send_from_directory ya usa wsgi.file_wrapper (os.sendfile en gunicorn)
+    try:
+        return send_from_directory(
+            os.path.dirname(path), os.path.basename(path),
+            etag=etag if etag else True, conditional=True, max_age=0
+        )
+    except RequestedRangeNotSatisfiable as e:
+        return e.get_response()
+
+
+# ==================== MANIFIESTOS DE BLOQUES ====================
+
+def block_manifest_response(manifest, filename, url, immutable=False):
+    """
+    Respuesta con el manifiesto de bloques (FileChunkManifest) de un archivo.
+
+    Con ?format=binary se devuelven los hashes concatenados en crudo y los
+    datos en cabeceras. Los bloques dañados se descargan con Range sobre `url`.
+    El manifiesto de un contenido concreto no cambia nunca (`immutable`).
+    """
+    output = request.args.get('format', 'json')
+    if output == 'binary':
+        response = Response(manifest.digests, mimetype='application/octet-stream')
+        response.headers['X-Chunk-Size'] = str(manifest.chunk_size)
+        response.headers['X-Chunk-Algorithm'] = manifest.algorithm
+        response.headers['X-File-Size'] = str(manifest.file_size)
+        response.headers['X-File-MD5'] = manifest.md5_hash
+    else:
+        data = manifest.to_dict()
+        data['filename'] = filename
+        data['url'] = url
+        response = Response(current_app.json.dumps(data), mimetype='application/json')
+
+    response.set_etag(f'{manifest.md5_hash}-{manifest.chunk_size}-{output}')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable' if immutable else 'no-cache'
+    return response.make_conditional(request)
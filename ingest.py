@@ -0,0 +1,368 @@
+"""
+Ingesta masiva de archivos del juego
+
+Procesa una subida de muchos archivos, o un build completo en ZIP, en etapas:
+    1. guardar y hashear  - en paralelo en un pool de hilos acotado (hashlib,
+                            zlib y la escritura a disco liberan el GIL); en
+                            la misma pasada se calculan los hashes por bloque
+    2. almacenar          - mover cada temporal al almacén por contenido
+    3. consultar          - una sola consulta con los GameFile de la versión
+    4. escribir           - un INSERT y un UPDATE en bloque, más las referencias
+    5. vista plana        - reenlazar uploads/files/<nombre>
+    6. precomprimir       - variantes gzip/br/zstd de los contenidos de texto
+
+Cada etapa registra archivos, bytes y tiempo para informar del rendimiento, y
+si se pasa una función `progress` se le notifica el avance (la usa la cola
+de tareas para los latidos y el progreso en el panel).
+"""
+
+import os
+import threading
+import time
+import zipfile
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import delete, update
+from werkzeug.utils import secure_filename
+from models import GameFile, db
+from utils import format_file_size, safe_archive_path, save_upload
+import blob_store
+
+
+class IngestReport:
+    """Archivos, bytes y segundos por etapa de una ingesta"""
+
+    def __init__(self, progress=None):
+        self.stages = {}
+        self.progress = progress
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def record(self, stage, seconds, files=0, size=0):
+        self.stages[stage] = {'seconds': seconds, 'files': files, 'bytes': size}
+
+    def notify(self, stage, done=None, total=None):
+        """Informar del avance a la función `progress`, si la hay"""
+        if self.progress is not None:
+            self.progress(stage, done, total)
+
+    @property
+    def total_files(self):
+        return self.inserted + self.updated + self.unchanged
+
+    def throughput(self, stage):
+        data = self.stages[stage]
+        seconds = data['seconds'] or 1e-9
+        return data['files'] / seconds, data['bytes'] / seconds
+
+    def to_dict(self):
+        stages = {}
+        for name, data in self.stages.items():
+            files_per_second, bytes_per_second = self.throughput(name)
+            stages[name] = dict(data, files_per_second=round(files_per_second, 1),
+                                bytes_per_second=int(bytes_per_second))
+        return {
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'removed': self.removed,
+            'stages': stages
+        }
+
+    def summary(self):
+        parts = []
+        for name, data in self.stages.items():
+            files_per_second, bytes_per_second = self.throughput(name)
+            part = f"{name} {data['seconds']:.2f}s ({files_per_second:.0f} archivos/s"
+            if data['bytes']:
+                part += f", {format_file_size(int(bytes_per_second))}/s"
+            parts.append(part + ')')
+        return ' | '.join(parts)
+
+
+class _StageTimer:
+    """Cronometrar una etapa y anotarla en el informe al salir del bloque"""
+
+    def __init__(self, report, stage, files=0, size=0):
+        self.report = report
+        self.stage = stage
+        self.files = files
+        self.size = size
+
+    def __enter__(self):
+        self.report.notify(self.stage)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.report.record(self.stage, time.perf_counter() - self.start, self.files, self.size)
+
+
+def _save_parallel(report, sources, save, max_workers):
+    """
+    Etapa 1: guardar y hashear en paralelo.
+
+    `save(source, temp_path)` escribe una fuente en el temporal y retorna un
+    SavedUpload. Si algo falla se borran los temporales ya escritos.
+    """
+    temp_paths = [blob_store.temp_path() for _ in sources]
+    with _StageTimer(report, 'guardar+hash', files=len(sources)) as timer:
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest') as pool:
+                saved = []
+                for item in pool.map(save, sources, temp_paths):
+                    saved.append(item)
+                    report.notify('guardar+hash', len(saved), len(sources))
+        except Exception:
+            for path in temp_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        timer.size = sum(item.size for item in saved)
+    return saved
+
+
+def _register(report, version_id, entries, key='filename', replace=False, block_size=None):
+    """
+    Etapas 2-6: almacenar, consultar existentes, escribir en bloque, vista
+    plana y variantes precomprimidas.
+
+    `entries` es una lista de (filename, relative_path, SavedUpload). Las filas
+    existentes de la versión se emparejan por `key` ('filename' o
+    'relative_path'); con `replace` se eliminan las que no aparecen. Los
+    hashes por bloque de cada SavedUpload (de `block_size` bytes) se guardan
+    como manifiesto del contenido.
+    """
+    # 2. Mover al almacén por contenido
+    with _StageTimer(report, 'almacenar', files=len(entries), size=sum(e[2].size for e in entries)):
+        stored = [blob_store.store_file(saved.path, saved.md5) for _, _, saved in entries]
+
+    # 3. Filas existentes de la versión en una sola consulta
+    with _StageTimer(report, 'consultar') as query_timer:
+        existing = {
+            getattr(row, key): row for row in db.session.query(
+                GameFile.id, GameFile.filename, GameFile.md5_hash, GameFile.relative_path
+            ).filter(GameFile.version_id == version_id)
+        }
+        query_timer.files = len(existing)
+
+    # 4. Escritura en bloque
+    now = datetime.utcnow()
+    inserts, updates, seen = [], [], set()
+    deltas, sizes = Counter(), {}
+    changed_filenames = []
+
+    for (filename, relative_path, _), (md5_hash, file_size, _, _) in zip(entries, stored):
+        sizes[md5_hash] = file_size
+        row = existing.get(relative_path if key == 'relative_path' else filename)
+        if row is None:
+            inserts.append({
+                'filename': filename, 'relative_path': relative_path, 'md5_hash': md5_hash,
+                'file_size': file_size, 'version_id': version_id,
+                'created_at': now, 'updated_at': now
+            })
+            deltas[md5_hash] += 1
+            changed_filenames.append(filename)
+            continue
+
+        seen.add(row.id)
+        if row.md5_hash == md5_hash and row.relative_path == relative_path and row.filename == filename:
+            report.unchanged += 1
+            continue
+
+        updates.append({
+            'id': row.id, 'filename': filename, 'md5_hash': md5_hash, 'file_size': file_size,
+            'relative_path': relative_path, 'updated_at': now
+        })
+        if row.md5_hash != md5_hash:
+            deltas[row.md5_hash] -= 1
+            deltas[md5_hash] += 1
+        changed_filenames.extend({row.filename, filename})
+
+    removed = [row for row in existing.values() if row.id not in seen] if replace else []
+    for row in removed:
+        deltas[row.md5_hash] -= 1
+        changed_filenames.append(row.filename)
+
+    with _StageTimer(report, 'escribir', files=len(inserts) + len(updates) + len(removed)):
+        try:
+            if inserts:
+                db.session.execute(GameFile.__table__.insert(), inserts)
+            if updates:
+                db.session.execute(update(GameFile), updates)
+            if removed:
+                db.session.execute(delete(GameFile).where(GameFile.id.in_([row.id for row in removed])))
+            blob_store.apply_ref_deltas(deltas, sizes)
+            blob_store.record_chunk_manifests([
+                (md5_hash, file_size, block_size, saved.blocks)
+                for (_, _, saved), (md5_hash, file_size, _, _) in zip(entries, stored)
+                if saved.blocks is not None
+            ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            blob_store.discard_unregistered([item.md5_hash for item in stored if item.created])
+            blob_store.settle_stored(stored)
+            raise
+    report.inserted, report.updated, report.removed = len(inserts), len(updates), len(removed)
+
+    # 5. Vista plana y contenido que ya nadie usa
+    with _StageTimer(report, 'vista plana', files=len(changed_filenames)):
+        blob_store.settle_stored(stored)
+        blob_store.refresh_flat_views(changed_filenames)
+        blob_store.purge_unreferenced([md5_hash for md5_hash, delta in deltas.items() if delta < 0])
+
+    # 6. Variantes precomprimidas de los contenidos de texto nuevos
+    with _StageTimer(report, 'precomprimir', files=len(stored)):
+        blob_store.create_variants([
+            (item.md5_hash, filename) for (filename, _, _), item in zip(entries, stored) if item.created
+        ])
+
+    current_app.logger.info(
+        f"Ingesta en versión {version_id}: {report.inserted} nuevos, {report.updated} actualizados, "
+        f"{report.unchanged} sin cambios, {report.removed} eliminados - {report.summary()}"
+    )
+    return report
+
+
+def ingest_uploads(version_id, uploads, max_workers=None, progress=None):
+    """
+    Ingerir una lista de (FileStorage, filename, relative_path) en una versión.
+
+    Si un nombre aparece varias veces gana el último. Retorna un IngestReport;
+    la transacción queda confirmada y el manifiesto no se invalida aquí.
+    """
+    report = IngestReport(progress)
+    max_workers = max_workers or current_app.config.get('INGEST_WORKERS', 8)
+    block_size = current_app.config.get('FILE_BLOCK_MANIFEST_SIZE', 1024 * 1024)
+
+    # Un nombre por versión: la última aparición sustituye a las anteriores
+    unique = {}
+    for upload in uploads:
+        unique[upload[1]] = upload
+    uploads = list(unique.values())
+    if not uploads:
+        return report
+
+    saved = _save_parallel(
+        report, [upload[0] for upload in uploads],
+        lambda file, temp_path: save_upload(file.stream, temp_path, block_size=block_size), max_workers
+    )
+    entries = [(filename, relative_path, item) for (_, filename, relative_path), item in zip(uploads, saved)]
+    return _register(report, version_id, entries, block_size=block_size)
+
+
+# ==================== IMPORTACIÓN DE BUILDS (ZIP) ====================
+
+def _archive_members(zipf, strip_root=False):
+    """
+    Miembros de archivo del ZIP como lista de (ZipInfo, relative_path, filename).
+
+    Se descartan directorios y rutas inseguras (absolutas o con '..'). Con
+    `strip_root` se quita la carpeta raíz si todos los miembros comparten una.
+    """
+    members = []
+    skipped = []
+    for info in zipf.infolist():
+        if info.is_dir():
+            continue
+        relative_path = safe_archive_path(info.filename)
+        filename = secure_filename(relative_path.rsplit('/', 1)[-1]) if relative_path else ''
+        if not relative_path or not filename:
+            skipped.append(info.filename)
+            continue
+        members.append((info, relative_path, filename))
+
+    if strip_root and members:
+        roots = {relative_path.split('/', 1)[0] for _, relative_path, _ in members}
+        if len(roots) == 1 and all('/' in relative_path for _, relative_path, _ in members):
+            members = [(info, relative_path.split('/', 1)[1], filename)
+                       for info, relative_path, filename in members]
+
+    if skipped:
+        current_app.logger.warning(f"Miembros del ZIP ignorados por ruta no válida: {skipped[:20]}")
+    return members
+
+
+def _duplicate_filenames(version_id, members, replace=False):
+    """
+    Nombres que quedarían en más de una ruta de la versión tras importar
+    `members`, como {filename: [rutas]}.
+
+    El launcher descarga cada entrada del manifiesto por su nombre
+    (/api/files/<nombre>), que solo puede servir un contenido.
+    """
+    paths = {}
+    if not replace:
+        paths = {row.relative_path or row.filename: row.filename for row in db.session.query(
+            GameFile.relative_path, GameFile.filename
+        ).filter(GameFile.version_id == version_id)}
+    paths.update({relative_path: filename for _, relative_path, filename in members})
+
+    by_name = defaultdict(list)
+    for relative_path, filename in paths.items():
+        by_name[filename].append(relative_path)
+    return {filename: sorted(found) for filename, found in by_name.items() if len(found) > 1}
+
+
+def ingest_archive(version_id, archive_path, strip_root=False, replace=False, max_workers=None, progress=None):
+    """
+    Importar un build completo en ZIP como archivos de una versión.
+
+    Los miembros se extraen en paralelo (cada hilo con su propio ZipFile) y se
+    hashean mientras se escriben; todas las filas de GameFile se crean o
+    actualizan en una transacción, emparejadas por ruta relativa. Con
+    `replace` se eliminan de la versión los archivos que no están en el ZIP.
+    Se rechaza (ValueError) si un mismo nombre quedaría en varias carpetas.
+    `progress(etapa, hechos, total)` recibe el avance.
+    """
+    report = IngestReport(progress)
+    max_workers = max_workers or current_app.config.get('INGEST_WORKERS', 8)
+    max_size = current_app.config.get('BUILD_ARCHIVE_MAX_UNCOMPRESSED', 50 * 1024 ** 3)
+    block_size = current_app.config.get('FILE_BLOCK_MANIFEST_SIZE', 1024 * 1024)
+
+    with zipfile.ZipFile(archive_path) as zipf:
+        members = _archive_members(zipf, strip_root)
+
+    # Una entrada por ruta relativa: la última aparición gana
+    members = list({relative_path: (info, relative_path, filename)
+                    for info, relative_path, filename in members}.values())
+
+    duplicates = _duplicate_filenames(version_id, members, replace)
+    if duplicates:
+        listed = '; '.join(f"{filename}: {', '.join(found)}" for filename, found in sorted(duplicates.items())[:20])
+        raise ValueError(f"{len(duplicates)} nombres de archivo aparecen en varias carpetas y el launcher "
+                         f"los descarga por nombre, renómbralos antes de importar: {listed}")
+
+    total_size = sum(info.file_size for info, _, _ in members)
+    if total_size > max_size:
+        raise ValueError(f"El ZIP descomprimido ocupa {format_file_size(total_size)}, "
+                         f"más que el máximo permitido ({format_file_size(max_size)})")
+
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def extract(info, temp_path):
+        zipf = getattr(local, 'zipf', None)
+        if zipf is None:
+            zipf = local.zipf = zipfile.ZipFile(archive_path)
+            with handles_lock:
+                handles.append(zipf)
+        # ZipExtFile verifica el CRC-32 al terminar la lectura
+        with zipf.open(info) as source:
+            return save_upload(source, temp_path, block_size=block_size)
+
+    try:
+        saved = _save_parallel(report, [info for info, _, _ in members], extract, max_workers)
+    finally:
+        for zipf in handles:
+            zipf.close()
+
+    entries = [(filename, relative_path, item)
+               for (_, relative_path, filename), item in zip(members, saved)]
+    return _register(report, version_id, entries, key='relative_path', replace=replace, block_size=block_size)
@@ -79,6 +79,10 @@ def setup_database():
             db.create_all()
             print("  ✓ Tablas de base de datos creadas")
             
+            from schema_upgrades import upgrade_schema
+            upgrade_schema()
+            print("  ✓ Esquema actualizado")
+            
             # Verificar si ya existe un usuario admin
             admin = User.query.filter_by(username='admin').first()
             if admin:
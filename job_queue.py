@@ -0,0 +1,476 @@
+"""
+Cola de tareas en segundo plano para las operaciones largas del panel
+
+Las rutas de administración encolan una tarea (enqueue) y responden en el
+acto; cada proceso tiene unos hilos de fondo que las toman de launcher_job
+con un UPDATE condicional, de modo que entre varios workers de gunicorn (o
+varios nodos con la misma base de datos) cada tarea la ejecuta uno solo.
+
+- Reintentos: una tarea que falla vuelve a la cola con espera exponencial
+  hasta agotar max_attempts. Mientras se ejecuta, un hilo propio de la
+  tarea renueva su latido cada JOB_HEARTBEAT_INTERVAL segundos aunque el
+  manejador no informe de progreso; si el proceso muere a medias los
+  latidos cesan y otro worker la retoma (cuenta como un intento más).
+- Cancelación: una tarea pendiente se cancela directamente; una en curso
+  recibe la petición en su siguiente llamada a JobContext.progress().
+- Idempotencia: encolar con una idempotency_key ya usada retorna la tarea
+  existente si sigue activa o terminó hace poco, en lugar de repetirla.
+
+El progreso y el ritmo de cada tarea se emiten al panel con
+socketio_utils.emit_to_admin ('job_progress'). Los manejadores se
+registran con @job_handler('tipo') y reciben un JobContext y el payload.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from models import BackgroundJob, db
+
+JOB_STATUSES = ('pending', 'running', 'done', 'failed', 'cancelled')
+ACTIVE_STATUSES = ('pending', 'running')
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+_handlers = {}
+_queue = None
+_queue_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """El administrador canceló la tarea"""
+
+
+class JobAborted(Exception):
+    """La tarea ya no pertenece a este proceso (retomada por otro worker)"""
+
+
+def job_handler(kind, max_attempts=3, title=None):
+    """Registrar la función que ejecuta las tareas de tipo `kind`"""
+    def decorator(func):
+        _handlers[kind] = {'func': func, 'max_attempts': max_attempts, 'title': title or kind}
+        return func
+    return decorator
+
+
+def job_title(kind):
+    handler = _handlers.get(kind)
+    return handler['title'] if handler else kind
+
+
+def job_to_dict(job, **extra):
+    data = job.to_dict()
+    data['title'] = job_title(job.kind)
+    data.update(extra)
+    return data
+
+
+def _emit(event, data):
+    try:
+        from socketio_utils import emit_to_admin
+        emit_to_admin(event, data)
+    except Exception:
+        pass
+
+
+# ==================== ENCOLAR Y CANCELAR ====================
+
+def enqueue(kind, payload=None, idempotency_key=None, user_id=None, max_attempts=None):
+    """
+    Encolar una tarea y despertar a los hilos de este proceso.
+
+    Con `idempotency_key` se retorna la tarea existente si está activa o
+    terminó hace menos de JOB_IDEMPOTENCY_SECONDS; una fallida, cancelada o
+    más antigua se vuelve a poner en cola. Retorna el BackgroundJob (confirmado).
+    """
+    if kind not in _handlers:
+        raise ValueError(f"Tipo de tarea desconocido: {kind}")
+    if max_attempts is None:
+        max_attempts = _handlers[kind]['max_attempts']
+    body = json.dumps(payload or {})
+
+    job = None
+    if idempotency_key:
+        job = BackgroundJob.query.filter_by(idempotency_key=idempotency_key).first()
+        if job is not None and _reusable(job):
+            return job
+
+    if job is None:
+        job = BackgroundJob(kind=kind, payload=body, idempotency_key=idempotency_key,
+                            max_attempts=max_attempts, requested_by=user_id)
+        db.session.add(job)
+    else:
+        _reset(job, body, max_attempts, user_id)
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Otra petición encoló la misma clave a la vez
+        db.session.rollback()
+        return BackgroundJob.query.filter_by(idempotency_key=idempotency_key).one()
+
+    _emit('job_progress', job_to_dict(job))
+    queue = get_job_queue()
+    if queue is not None:
+        queue.wake()
+    return job
+
+
+def _reusable(job):
+    if job.status in ACTIVE_STATUSES:
+        return True
+    window = current_app.config.get('JOB_IDEMPOTENCY_SECONDS', 3600)
+    return (job.status == 'done' and job.finished_at is not None
+            and job.finished_at > datetime.utcnow() - timedelta(seconds=window))
+
+
+def _reset(job, payload, max_attempts, user_id):
+    job.payload = payload
+    job.status = 'pending'
+    job.attempts = 0
+    job.max_attempts = max_attempts
+    job.run_after = datetime.utcnow()
+    job.cancel_requested = False
+    job.progress_done = job.progress_total = 0
+    job.progress_message = job.result = job.error = None
+    job.requested_by = user_id or job.requested_by
+    job.created_at = datetime.utcnow()
+    job.started_at = job.heartbeat_at = job.finished_at = None
+
+
+def cancel(job_id):
+    """
+    Cancelar una tarea: si está pendiente, al momento; si está en curso, se
+    marca y la tarea se detiene en su siguiente punto de control. Retorna el
+    BackgroundJob o None si no existe.
+    """
+    table = BackgroundJob.__table__
+    db.session.execute(
+        table.update().where(table.c.id == job_id, table.c.status == 'pending')
+        .values(status='cancelled', finished_at=datetime.utcnow())
+    )
+    db.session.execute(
+        table.update().where(table.c.id == job_id, table.c.status == 'running')
+        .values(cancel_requested=True)
+    )
+    db.session.commit()
+
+    job = db.session.get(BackgroundJob, job_id)
+    if job is not None:
+        db.session.refresh(job)
+        _emit('job_progress', job_to_dict(job))
+    return job
+
+
+def active_job(idempotency_key):
+    """Tarea activa con esa clave, o None"""
+    return BackgroundJob.query.filter(
+        BackgroundJob.idempotency_key == idempotency_key,
+        BackgroundJob.status.in_(ACTIVE_STATUSES)
+    ).first()
+
+
+# ==================== EJECUCIÓN ====================
+
+class JobContext:
+    """
+    Lo que recibe un manejador para informar del progreso.
+
+    Las escrituras de progreso van por una conexión propia, así que no
+    confirman ni interfieren con la transacción de la sesión del manejador.
+    """
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job_id = job.id
+        self.kind = job.kind
+        self.attempt = job.attempts  # testigo: otro worker que la retome lo incrementa
+        self.max_attempts = job.max_attempts
+        self.cancellable = True  # el manejador lo desactiva cuando cancelar dejaría un estado a medias
+        self.done = job.progress_done or 0
+        self.total = job.progress_total or 0
+        self.message = job.progress_message
+        self._started = time.monotonic()
+        self._start_done = self.done
+        self._last_write = 0.0
+
+    @property
+    def last_attempt(self):
+        return self.attempt >= self.max_attempts
+
+    def throughput(self):
+        """Unidades por segundo en este intento"""
+        elapsed = time.monotonic() - self._started
+        return (self.done - self._start_done) / elapsed if elapsed > 0 else 0.0
+
+    def progress(self, done=None, total=None, message=None, force=False):
+        """
+        Anotar progreso (como mucho una vez por JOB_PROGRESS_INTERVAL salvo
+        `force`) y emitirlo al panel. Lanza JobCancelled si se pidió cancelar
+        (y la tarea aún es cancelable) y JobAborted si la tarea ya la tiene
+        otro proceso.
+        """
+        if done is not None:
+            self.done = done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message[:255]
+
+        now = time.monotonic()
+        if not force and now - self._last_write < self.queue.progress_interval:
+            return
+        self._last_write = now
+
+        table = BackgroundJob.__table__
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                table.update().where(
+                    table.c.id == self.job_id, table.c.status == 'running', table.c.attempts == self.attempt
+                ).values(heartbeat_at=datetime.utcnow(), progress_done=self.done,
+                         progress_total=self.total, progress_message=self.message)
+            ).rowcount
+            cancel_requested = connection.execute(
+                db.select(table.c.cancel_requested).where(table.c.id == self.job_id)
+            ).scalar()
+
+        if updated != 1:
+            raise JobAborted(f"Tarea {self.job_id} retomada por otro proceso")
+        if cancel_requested and self.cancellable:
+            raise JobCancelled(f"Tarea {self.job_id} cancelada")
+
+        _emit('job_progress', {
+            'id': self.job_id, 'kind': self.kind, 'title': job_title(self.kind), 'status': 'running',
+            'progress_done': self.done, 'progress_total': self.total,
+            'progress_message': self.message, 'throughput': round(self.throughput(), 1)
+        })
+
+    def check_cancelled(self):
+        """Punto de control sin cambiar el progreso"""
+        self.progress(force=True)
+
+
+class JobHeartbeat:
+    """Hilo que renueva heartbeat_at de una tarea en curso mientras su manejador trabaja"""
+
+    def __init__(self, app, context, interval):
+        self.app = app
+        self.context = context
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'job-heartbeat-{context.job_id}', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join(self.interval)
+
+    def _run(self):
+        table = BackgroundJob.__table__
+        context = self.context
+        while not self._stop.wait(self.interval):
+            try:
+                with self.app.app_context(), db.engine.begin() as connection:
+                    updated = connection.execute(
+                        table.update().where(
+                            table.c.id == context.job_id, table.c.status == 'running',
+                            table.c.attempts == context.attempt
+                        ).values(heartbeat_at=datetime.utcnow())
+                    ).rowcount
+            except Exception as e:
+                self.app.logger.warning(f"No se pudo renovar el latido de la tarea {context.job_id}: {e}")
+                continue
+            if updated != 1:
+                return  # la tarea ya no es de este proceso; progress() lo detectará
+
+
+class JobQueue:
+    """Hilos de fondo que ejecutan las tareas pendientes, reintentos y abandonadas"""
+
+    def __init__(self, app, workers=2, poll_interval=5, stale_seconds=300,
+                 retry_delay=30, progress_interval=1.0, heartbeat_interval=None):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.retry_delay = retry_delay
+        self.progress_interval = progress_interval
+        # Varios latidos por periodo de abandono: uno perdido no basta para que otro la retome
+        self.heartbeat_interval = heartbeat_interval or max(1, stale_seconds / 4)
+
+        self._pid = None
+        self._threads = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def ensure_started(self):
+        """Arrancar los hilos en este proceso (los workers de gunicorn se crean con fork)"""
+        if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+                return
+
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._threads = []
+                self._wake = threading.Event()
+                self._stop = threading.Event()
+
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'job-worker-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        self.ensure_started()
+        self._wake.set()
+
+    def shutdown(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._pid == os.getpid():
+            for thread in self._threads:
+                thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                while not self._stop.is_set() and self.run_next():
+                    pass
+            except Exception as e:
+                self.app.logger.error(f"Error en la cola de tareas: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    # --- Reclamar tareas ---
+
+    def _stale_cutoff(self):
+        return datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+
+    def _runnable(self, table):
+        now = datetime.utcnow()
+        return db.or_(
+            db.and_(table.c.status == 'pending', db.or_(table.c.run_after.is_(None), table.c.run_after <= now)),
+            db.and_(table.c.status == 'running', table.c.heartbeat_at < self._stale_cutoff())
+        )
+
+    def _claim(self, job_id):
+        """Tomar la tarea si sigue disponible. True si la ganó este proceso"""
+        table = BackgroundJob.__table__
+        now = datetime.utcnow()
+        result = db.session.execute(
+            table.update().where(table.c.id == job_id, self._runnable(table))
+            .values(status='running', attempts=table.c.attempts + 1, heartbeat_at=now,
+                    started_at=db.func.coalesce(table.c.started_at, now))
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    def run_next(self):
+        """Ejecutar una tarea disponible. Retorna True si ejecutó alguna"""
+        with self.app.app_context():
+            table = BackgroundJob.__table__
+            candidates = db.session.execute(
+                db.select(table.c.id).where(self._runnable(table)).order_by(table.c.id).limit(10)
+            ).scalars().all()
+
+            for job_id in candidates:
+                if self._claim(job_id):
+                    self.run_job(job_id)
+                    return True
+            return False
+
+    def _finish(self, context, **values):
+        """Cerrar el intento si la tarea sigue siendo de este proceso"""
+        table = BackgroundJob.__table__
+        db.session.execute(
+            table.update().where(
+                table.c.id == context.job_id, table.c.status == 'running', table.c.attempts == context.attempt
+            ).values(heartbeat_at=datetime.utcnow(), progress_done=context.done,
+                     progress_total=context.total, progress_message=context.message, **values)
+        )
+        db.session.commit()
+
+    def run_job(self, job_id):
+        """Ejecutar una tarea ya reclamada y registrar su resultado"""
+        app = self.app
+        job = db.session.get(BackgroundJob, job_id)
+        context = JobContext(self, job)
+        handler = _handlers.get(job.kind)
+
+        try:
+            if handler is None:
+                raise LookupError(f"No hay manejador para las tareas de tipo {job.kind}")
+            _emit('job_progress', job_to_dict(job))
+            with JobHeartbeat(app, context, self.heartbeat_interval):
+                result = handler['func'](context, **job.arguments)
+        except JobAborted as e:
+            db.session.rollback()
+            app.logger.warning(str(e))
+            return
+        except JobCancelled:
+            db.session.rollback()
+            self._finish(context, status='cancelled', finished_at=datetime.utcnow())
+            app.logger.info(f"Tarea {job_id} ({job.kind}) cancelada")
+        except Exception as e:
+            db.session.rollback()
+            retry = handler is not None and job.attempts < job.max_attempts
+            app.logger.error(f"Error en la tarea {job_id} ({job.kind}, intento {job.attempts}): {e}")
+            if retry:
+                delay = self.retry_delay * 2 ** (job.attempts - 1)
+                self._finish(context, status='pending', error=str(e)[:2000],
+                             run_after=datetime.utcnow() + timedelta(seconds=delay))
+            else:
+                self._finish(context, status='failed', error=str(e)[:2000], finished_at=datetime.utcnow())
+                _emit('notification', {
+                    'type': 'error',
+                    'message': f"{job_title(job.kind)}: {e}",
+                    'data': {'action': 'job_failed', 'job_id': job_id}
+                })
+        else:
+            self._finish(context, status='done', error=None, finished_at=datetime.utcnow(),
+                         result=json.dumps(result) if result is not None else None)
+            app.logger.info(f"Tarea {job_id} ({job.kind}) terminada en el intento {job.attempts}")
+
+        db.session.expire_all()
+        job = db.session.get(BackgroundJob, job_id)
+        if job is not None:
+            _emit('job_progress', job_to_dict(job, throughput=round(context.throughput(), 1)))
+
+
+def init_job_queue(app):
+    """Crear la cola de tareas según la configuración de la aplicación"""
+    global _queue
+
+    with _queue_lock:
+        if not app.config.get('JOB_QUEUE_ENABLED', True):
+            _queue = None
+            return None
+
+        _queue = JobQueue(
+            app,
+            workers=app.config.get('JOB_WORKERS', 2),
+            poll_interval=app.config.get('JOB_POLL_INTERVAL', 5),
+            stale_seconds=app.config.get('JOB_STALE_SECONDS', 300),
+            retry_delay=app.config.get('JOB_RETRY_DELAY', 30),
+            progress_interval=app.config.get('JOB_PROGRESS_INTERVAL', 1.0),
+            heartbeat_interval=app.config.get('JOB_HEARTBEAT_INTERVAL')
+        )
+        # Arranque perezoso en cada worker: retoma las tareas que quedaron a medias
+        app.before_request(_queue.ensure_started)
+        atexit.register(_queue.shutdown)
+        return _queue
+
+
+def get_job_queue():
+    return _queue
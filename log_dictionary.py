@@ -0,0 +1,138 @@
+"""
+Codificación compacta de los logs de descarga
+
+User-Agent y nombre de archivo se guardan una sola vez en sus tablas de
+diccionario (launcher_log_user_agent, launcher_log_file) y cada log solo
+lleva el id. Cada proceso mantiene una caché LRU valor -> id
+(LOG_INTERN_CACHE_SIZE por diccionario), así que en régimen normal codificar
+un lote no toca la base de datos: los clientes envían casi siempre los
+mismos User-Agent del launcher y piden los mismos archivos.
+
+Los valores nuevos se insertan en una transacción propia (ON CONFLICT DO
+NOTHING si el motor lo admite) antes de escribir el lote, de modo que un id
+en caché siempre existe en la base de datos.
+"""
+
+import threading
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from models import DownloadLog, FILE_TYPE_CODES, LogFile, LogUserAgent, db, normalize_ip
+
+
+class InternCache:
+    """Caché LRU valor -> id de una tabla de diccionario (id, value)"""
+
+    def __init__(self, model):
+        self.model = model
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _max_size(self):
+        return current_app.config.get('LOG_INTERN_CACHE_SIZE', 10000)
+
+    def ids(self, values):
+        """Ids de `values` (iterable de str), creando los que falten. Retorna {valor: id}"""
+        result, missing = {}, []
+        with self._lock:
+            for value in set(values):
+                if value in self._ids:
+                    self._ids.move_to_end(value)
+                    result[value] = self._ids[value]
+                else:
+                    missing.append(value)
+            self.hits += len(result)
+            self.misses += len(missing)
+
+        if missing:
+            loaded = self._load(missing)
+            result.update(loaded)
+            with self._lock:
+                self._ids.update(loaded)
+                while len(self._ids) > self._max_size():
+                    self._ids.popitem(last=False)
+        return result
+
+    def _select(self, connection, values):
+        table = self.model.__table__
+        return dict(connection.execute(
+            db.select(table.c.value, table.c.id).where(table.c.value.in_(values))
+        ).all())
+
+    def _load(self, values):
+        """Leer los ids y crear en una transacción propia los valores que no existan"""
+        table = self.model.__table__
+        with db.engine.begin() as connection:
+            found = self._select(connection, values)
+        new = [value for value in values if value not in found]
+        if not new:
+            return found
+
+        rows = [{'value': value} for value in new]
+        dialect = db.engine.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            if dialect == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            with db.engine.begin() as connection:
+                connection.execute(insert(table).on_conflict_do_nothing(index_elements=['value']), rows)
+        else:
+            for row in rows:
+                try:
+                    with db.engine.begin() as connection:
+                        connection.execute(table.insert(), row)
+                except IntegrityError:
+                    pass  # otro proceso lo insertó a la vez
+
+        with db.engine.begin() as connection:
+            found.update(self._select(connection, new))
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def stats(self):
+        return {'size': len(self._ids), 'hits': self.hits, 'misses': self.misses}
+
+
+user_agents = InternCache(LogUserAgent)
+files = InternCache(LogFile)
+
+
+def encode_records(records):
+    """
+    Convertir registros con las columnas de texto (ip_address, user_agent,
+    file_requested, file_type, success, created_at) en filas compactas para
+    insertar en launcher_download_log.
+    """
+    agent_ids = user_agents.ids(r['user_agent'] for r in records if r.get('user_agent') is not None)
+    file_ids = files.ids(r['file_requested'] or '' for r in records)
+
+    rows = []
+    for record in records:
+        ip = normalize_ip(record['ip_address'])
+        file_type = record.get('file_type')
+        known_type = file_type in FILE_TYPE_CODES
+        rows.append({
+            'ip': ip,
+            'ip_address': None if ip is not None else (record['ip_address'] or '')[:45],
+            'user_agent_id': agent_ids.get(record.get('user_agent')),
+            'user_agent': None,
+            'file_id': file_ids[record['file_requested'] or ''],
+            'file_requested': None,
+            'file_type_code': file_type if known_type else None,
+            'file_type': None if known_type else file_type,
+            'success': record.get('success', True),
+            'created_at': record['created_at']
+        })
+    return rows
+
+
+def insert_records(records):
+    """Insertar registros en formato compacto (sin confirmar la transacción)"""
+    if records:
+        db.session.execute(DownloadLog.__table__.insert(), encode_records(records))
@@ -0,0 +1,317 @@
+"""
+Particiones mensuales de launcher_download_log (PostgreSQL)
+
+En PostgreSQL la tabla de logs es un padre particionado por rango de
+created_at con una partición por mes (launcher_download_log_pAAAAMM) y una
+partición DEFAULT que recoge lo que llegue a un mes aún sin crear. El
+modelo DownloadLog no cambia: las inserciones se enrutan solas y las
+consultas acotadas por fecha (estadísticas, exportación, paginación por
+cursor) solo leen las particiones del rango.
+
+- La retención elimina particiones completas (DROP TABLE) en lugar de
+  borrar filas; solo el mes que contiene el corte se limpia fila a fila.
+- Las particiones se crean por adelantado (LOG_PARTITION_PREMAKE_MONTHS).
+  Si la DEFAULT ya tiene filas de ese mes se mueven a la nueva partición.
+- Una tabla existente se convierte sin copiar datos: pasa a ser la
+  partición launcher_download_log_legacy hasta el inicio del mes siguiente.
+  La tarea split_legacy_log_partition la reparte después mes a mes en
+  particiones normales, para que la retención también pueda eliminarlas;
+  las filas se mueven sin bloquear la tabla y el bloqueo exclusivo solo
+  cubre el DETACH/ATTACH final (ver split_legacy_month).
+
+En otros motores la tabla sigue siendo única y estas funciones no hacen nada.
+"""
+
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import current_app
+from models import DownloadLog, db
+
+TABLE = DownloadLog.__tablename__
+LEGACY_TABLE = f'{TABLE}_legacy'
+DEFAULT_TABLE = f'{TABLE}_default'
+CREATED_INDEX = 'idx_download_log_created_id'
+LEGACY_RANGE_CHECK = f'{LEGACY_TABLE}_range'
+
+_BOUND_RE = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+class LogPartition(namedtuple('LogPartition', 'name lower upper is_default')):
+    """Partición de la tabla de logs; lower/upper son None para MINVALUE/MAXVALUE"""
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'lower': self.lower.strftime('%Y-%m-%d') if self.lower else None,
+            'upper': self.upper.strftime('%Y-%m-%d') if self.upper else None,
+            'is_default': self.is_default
+        }
+
+
+def month_start(timestamp):
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(timestamp):
+    timestamp = month_start(timestamp)
+    if timestamp.month == 12:
+        return timestamp.replace(year=timestamp.year + 1, month=1)
+    return timestamp.replace(month=timestamp.month + 1)
+
+
+def partition_name(month):
+    return f'{TABLE}_p{month:%Y%m}'
+
+
+def _literal(timestamp):
+    # Los límites de partición no admiten parámetros; son fechas generadas aquí
+    return f"'{timestamp:%Y-%m-%d %H:%M:%S}'"
+
+
+def _execute(sql, params=None):
+    return db.session.execute(db.text(sql), params or {})
+
+
+def _parse_bound(value):
+    value = value.strip()
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+
+def partitioning_enabled():
+    return (current_app.config.get('LOG_PARTITIONING_ENABLED', True)
+            and db.engine.dialect.name == 'postgresql')
+
+
+def is_partitioned():
+    """True si launcher_download_log ya es una tabla particionada"""
+    if db.engine.dialect.name != 'postgresql':
+        return False
+    relkind = _execute(
+        "SELECT relkind FROM pg_class WHERE relname = :name AND pg_table_is_visible(oid)", {'name': TABLE}
+    ).scalar()
+    return relkind == 'p'
+
+
+def list_partitions():
+    """Particiones actuales ordenadas por su límite inferior (la DEFAULT al final)"""
+    if not is_partitioned():
+        return []
+
+    rows = _execute(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = :name AND pg_table_is_visible(parent.oid)", {'name': TABLE}
+    ).all()
+
+    partitions = []
+    for name, bound in rows:
+        match = _BOUND_RE.search(bound or '')
+        if match is None:
+            partitions.append(LogPartition(name, None, None, True))
+        else:
+            partitions.append(LogPartition(name, _parse_bound(match.group(1)), _parse_bound(match.group(2)), False))
+    return sorted(partitions, key=lambda p: (p.is_default, p.lower or datetime.min))
+
+
+def convert_to_partitioned():
+    """
+    Convertir la tabla de logs en particionada sin copiar filas.
+
+    La tabla actual se renombra a launcher_download_log_legacy y se adjunta
+    como la partición (MINVALUE, inicio del mes siguiente); si está vacía se
+    elimina. La secuencia de ids pasa al padre para que siga siendo única.
+    Todo ocurre en una transacción. Retorna True si convirtió la tabla.
+    """
+    if not partitioning_enabled() or is_partitioned():
+        return False
+
+    boundary = next_month(datetime.utcnow())
+
+    sequence = _execute("SELECT pg_get_serial_sequence(:name, 'id')", {'name': TABLE}).scalar()
+    has_rows = _execute(f"SELECT EXISTS (SELECT 1 FROM {TABLE})").scalar()
+
+    _execute(f"UPDATE {TABLE} SET created_at = now() AT TIME ZONE 'UTC' WHERE created_at IS NULL")
+    _execute(f"ALTER TABLE {TABLE} ALTER COLUMN created_at SET NOT NULL")
+    _execute(f"ALTER TABLE {TABLE} RENAME TO {LEGACY_TABLE}")
+    _execute(f"ALTER INDEX IF EXISTS {CREATED_INDEX} RENAME TO {LEGACY_TABLE}_created_id")
+
+    _execute(f"CREATE TABLE {TABLE} (LIKE {LEGACY_TABLE} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)")
+    if sequence:
+        _execute(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id")
+    _execute(f"CREATE INDEX {CREATED_INDEX} ON {TABLE} (created_at, id)")
+    _execute(f"CREATE TABLE {DEFAULT_TABLE} PARTITION OF {TABLE} DEFAULT")
+
+    if has_rows:
+        _execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {LEGACY_TABLE} "
+                 f"FOR VALUES FROM (MINVALUE) TO ({_literal(boundary)})")
+    else:
+        _execute(f"DROP TABLE {LEGACY_TABLE}")
+    db.session.commit()
+
+    current_app.logger.info(f"{TABLE} convertida en tabla particionada por mes"
+                            + (f" (histórico en {LEGACY_TABLE})" if has_rows else ""))
+    return True
+
+
+def create_partition(month):
+    """
+    Crear la partición del mes que empieza en `month`.
+
+    Si la partición DEFAULT ya tiene filas de ese mes se crea como tabla
+    suelta, se mueven las filas y se adjunta, todo en una transacción.
+    """
+    lower, upper = month_start(month), next_month(month)
+    name = partition_name(lower)
+    bounds = f"FOR VALUES FROM ({_literal(lower)}) TO ({_literal(upper)})"
+
+    stray = _execute(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_TABLE} "
+        f"WHERE created_at >= {_literal(lower)} AND created_at < {_literal(upper)})"
+    ).scalar()
+
+    if stray:
+        _execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+        _execute(
+            f"WITH moved AS (DELETE FROM {DEFAULT_TABLE} "
+            f"WHERE created_at >= {_literal(lower)} AND created_at < {_literal(upper)} RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        )
+        _execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} {bounds}")
+    else:
+        _execute(f"CREATE TABLE {name} PARTITION OF {TABLE} {bounds}")
+    db.session.commit()
+
+    current_app.logger.info(f"Partición {name} creada" + (" (con filas de la DEFAULT)" if stray else ""))
+    return name
+
+
+def legacy_partition():
+    """La partición launcher_download_log_legacy de la conversión, o None si ya no existe"""
+    return next((p for p in list_partitions() if p.name == LEGACY_TABLE), None)
+
+
+def split_legacy_month(settle=timedelta(days=1)):
+    """
+    Pasar el mes más antiguo de la partición legacy a su propia partición.
+
+    Solo se reparten meses cerrados hace más de `settle`, que ya no reciben
+    filas. Para que el bloqueo exclusivo del padre no dure más que el
+    DETACH/ATTACH:
+        1. en una transacción aparte (instantánea) se añade a la legacy un
+           CHECK NOT VALID con el rango que le quedará
+        2. se crea la tabla del mes, con un CHECK de su rango, y se mueven
+           sus filas; la legacy sigue adjunta y hasta el commit las lecturas
+           las ven allí
+        3. se valida el CHECK de la legacy (no bloquea lecturas ni escrituras)
+        4. DETACH de la legacy y ATTACH del mes y de la legacy con su nuevo
+           rango: los CHECK válidos evitan que PostgreSQL las recorra
+
+    Mientras existe el CHECK NOT VALID no se pueden modificar filas del mes
+    en la legacy, por eso la tarea espera a que termine la compactación.
+    Cuando la legacy se queda vacía se elimina. Retorna la partición creada,
+    o None si no queda nada que repartir por ahora.
+    """
+    legacy = legacy_partition()
+    if legacy is None:
+        return None
+
+    oldest = _execute(f"SELECT min(created_at) FROM {LEGACY_TABLE}").scalar()
+    if oldest is None:
+        _execute(f"ALTER TABLE {TABLE} DETACH PARTITION {LEGACY_TABLE}")
+        _execute(f"DROP TABLE {LEGACY_TABLE}")
+        db.session.commit()
+        current_app.logger.info(f"Partición {LEGACY_TABLE} vacía eliminada")
+        return None
+
+    lower, upper = month_start(oldest), next_month(oldest)
+    if upper > datetime.utcnow() - settle:
+        return None
+    name = partition_name(lower)
+    remaining = upper < legacy.upper
+
+    if remaining:
+        _execute(f"ALTER TABLE {LEGACY_TABLE} DROP CONSTRAINT IF EXISTS {LEGACY_RANGE_CHECK}")
+        _execute(f"ALTER TABLE {LEGACY_TABLE} ADD CONSTRAINT {LEGACY_RANGE_CHECK} "
+                 f"CHECK (created_at >= {_literal(upper)} AND created_at < {_literal(legacy.upper)}) NOT VALID")
+        db.session.commit()
+
+    try:
+        _execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+        _execute(f"ALTER TABLE {name} ADD CONSTRAINT {name}_range "
+                 f"CHECK (created_at >= {_literal(lower)} AND created_at < {_literal(upper)})")
+        _execute(
+            f"WITH moved AS (DELETE FROM {LEGACY_TABLE} WHERE created_at < {_literal(upper)} RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        )
+        _execute(f"CREATE INDEX {name}_created_id ON {name} (created_at, id)")
+        if remaining:
+            _execute(f"ALTER TABLE {LEGACY_TABLE} VALIDATE CONSTRAINT {LEGACY_RANGE_CHECK}")
+
+        # Bloqueo exclusivo del padre solo desde aquí hasta el commit
+        _execute(f"ALTER TABLE {TABLE} DETACH PARTITION {LEGACY_TABLE}")
+        _execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} "
+                 f"FOR VALUES FROM ({_literal(lower)}) TO ({_literal(upper)})")
+        if remaining:
+            _execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {LEGACY_TABLE} "
+                     f"FOR VALUES FROM ({_literal(upper)}) TO ({_literal(legacy.upper)})")
+            _execute(f"ALTER TABLE {LEGACY_TABLE} DROP CONSTRAINT {LEGACY_RANGE_CHECK}")
+        else:
+            _execute(f"DROP TABLE {LEGACY_TABLE}")
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        if remaining:
+            _execute(f"ALTER TABLE {LEGACY_TABLE} DROP CONSTRAINT IF EXISTS {LEGACY_RANGE_CHECK}")
+            db.session.commit()
+        raise
+
+    current_app.logger.info(f"Mes {lower:%Y-%m} de {LEGACY_TABLE} movido a {name}")
+    return name
+
+
+def ensure_partitions(months_ahead=None):
+    """Crear las particiones del mes actual y de los `months_ahead` siguientes. Retorna las creadas"""
+    if not partitioning_enabled() or not is_partitioned():
+        return []
+    if months_ahead is None:
+        months_ahead = current_app.config.get('LOG_PARTITION_PREMAKE_MONTHS', 2)
+
+    existing = [p for p in list_partitions() if not p.is_default]
+    created = []
+    month = month_start(datetime.utcnow())
+    for _ in range(months_ahead + 1):
+        upper = next_month(month)
+        covered = any((p.lower is None or p.lower < upper) and (p.upper is None or p.upper > month)
+                      for p in existing)
+        if not covered:
+            created.append(create_partition(month))
+        month = upper
+    return created
+
+
+def drop_partitions_before(cutoff):
+    """
+    Eliminar las particiones cuyo rango termina antes de `cutoff`.
+
+    Retorna [(nombre, filas estimadas)]; las filas salen de las estadísticas
+    del planificador para no recorrer lo que se va a eliminar.
+    """
+    if not partitioning_enabled() or not is_partitioned():
+        return []
+
+    dropped = []
+    for partition in list_partitions():
+        if partition.is_default or partition.upper is None or partition.upper > cutoff:
+            continue
+        rows = _execute(
+            "SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE relname = :name", {'name': partition.name}
+        ).scalar() or 0
+        _execute(f"DROP TABLE {partition.name}")
+        db.session.commit()
+        dropped.append((partition.name, rows))
+        current_app.logger.info(f"Partición {partition.name} eliminada por retención (~{rows} logs)")
+    return dropped
@@ -0,0 +1,236 @@
+"""
+Escritura asíncrona y por lotes de DownloadLog
+
+Las rutas de la API encolan los registros en una cola acotada en memoria y
+un hilo de fondo los inserta en bloque cada DOWNLOAD_LOG_BATCH_SIZE registros
+o cada DOWNLOAD_LOG_FLUSH_INTERVAL_MS milisegundos, lo que ocurra primero.
+Al cerrar el proceso se vacía la cola pendiente. Los registros se guardan en
+formato compacto (ver log_dictionary.py) y cada lote escrito se suma también
+a los agregados por hora y día (ver rollups.py) y a los sketches de IPs únicas
+y más descargados (ver sketches.py), que se vuelcan periódicamente.
+
+Políticas cuando la cola está llena (DOWNLOAD_LOG_QUEUE_POLICY):
+    drop  - descartar el registro nuevo y contarlo
+    block - esperar hasta DOWNLOAD_LOG_BLOCK_TIMEOUT_MS y descartar si sigue llena
+    sync  - escribir el registro en el hilo de la petición
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from models import db
+from log_dictionary import insert_records
+from rollups import record_rollups
+from sketches import flush_sketches, record_sketches
+
+QUEUE_POLICIES = ('drop', 'block', 'sync')
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class DownloadLogWriter:
+    """Cola acotada con hilo de volcado en bloque hacia launcher_download_log"""
+
+    def __init__(self, app, max_queue=10000, batch_size=500, flush_interval_ms=1000,
+                 policy='drop', block_timeout_ms=50):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Política de cola no válida: {policy}")
+
+        self.app = app
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.policy = policy
+        self.block_timeout = block_timeout_ms / 1000.0
+
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        """Arrancar el hilo en este proceso (los workers de gunicorn se crean con fork)"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='download-log-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, record):
+        """Encolar un registro (dict con las columnas de DownloadLog)"""
+        self._ensure_started()
+
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            pass
+
+        if self.policy == 'block':
+            try:
+                self._queue.put(record, timeout=self.block_timeout)
+                return True
+            except queue.Full:
+                pass
+        elif self.policy == 'sync':
+            return self._write([record])
+
+        self.dropped += 1
+        return False
+
+    def _drain(self, first):
+        """Tomar hasta batch_size registros sin esperar más del intervalo"""
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_sketches(due_only=True)
+                continue
+
+            self._write(self._drain(first))
+
+    def _flush_sketches(self, due_only):
+        try:
+            with self.app.app_context():
+                flush_sketches(due_only=due_only)
+        except Exception as e:
+            self.app.logger.error(f"Error volcando los sketches de logs: {e}")
+
+    def _write(self, records):
+        """Insertar un lote en una sola sentencia"""
+        if not records:
+            return True
+
+        try:
+            with self.app.app_context():
+                insert_records(records)
+                db.session.commit()
+                record_rollups(records)
+                record_sketches(records)
+            self.written += len(records)
+            return True
+        except Exception as e:
+            self.failed += len(records)
+            self.app.logger.error(f"Error escribiendo lote de {len(records)} logs de descarga: {e}")
+            try:
+                with self.app.app_context():
+                    db.session.rollback()
+            except Exception:
+                pass
+            return False
+
+    def flush(self):
+        """Volcar de inmediato todo lo pendiente en el hilo actual"""
+        if self._queue is None or self._pid != os.getpid():
+            return
+
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+
+        self._write(batch)
+
+    def shutdown(self, timeout=5):
+        """Detener el hilo y volcar la cola"""
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'policy': self.policy
+        }
+
+
+def init_log_writer(app):
+    """Crear el escritor de logs según la configuración de la aplicación"""
+    global _writer
+
+    with _writer_lock:
+        if not app.config.get('DOWNLOAD_LOG_ASYNC', True):
+            _writer = None
+            return None
+
+        _writer = DownloadLogWriter(
+            app,
+            max_queue=app.config.get('DOWNLOAD_LOG_QUEUE_SIZE', 10000),
+            batch_size=app.config.get('DOWNLOAD_LOG_BATCH_SIZE', 500),
+            flush_interval_ms=app.config.get('DOWNLOAD_LOG_FLUSH_INTERVAL_MS', 1000),
+            policy=app.config.get('DOWNLOAD_LOG_QUEUE_POLICY', 'drop'),
+            block_timeout_ms=app.config.get('DOWNLOAD_LOG_BLOCK_TIMEOUT_MS', 50)
+        )
+        atexit.register(_writer.shutdown)
+        return _writer
+
+
+def get_log_writer():
+    return _writer
+
+
+def enqueue_download_log(ip_address, user_agent, file_requested, file_type, success=True):
+    """
+    Registrar una descarga a través del escritor asíncrono.
+
+    Si el escritor no está habilitado se inserta directamente como antes.
+    """
+    # Recortar a la longitud de las columnas para que un valor largo no invalide el lote
+    record = {
+        'ip_address': ip_address,
+        'user_agent': (user_agent or '')[:500],
+        'file_requested': file_requested[:255],
+        'file_type': file_type,
+        'success': success,
+        'created_at': datetime.utcnow()
+    }
+
+    writer = _writer
+    if writer is not None:
+        return writer.submit(record)
+
+    insert_records([record])
+    db.session.commit()
+    record_rollups([record])
+    record_sketches([record])
+    return True
@@ -0,0 +1,342 @@
+"""
+Snapshot en memoria del manifiesto de actualizaciones (/api/update)
+y de los manifiestos delta entre versiones (/api/update/delta)
+
+El cuerpo de la respuesta se construye una sola vez como bytes ya serializados
+junto con su ETag, y se reconstruye solo cuando cambian las versiones, los
+archivos o los paquetes de actualización. Entre workers de gunicorn la
+coherencia se mantiene con un contador de generación guardado en
+ServerSettings, que cada worker consulta como mucho una vez por intervalo.
+Los deltas se cachean por par (desde, hasta) y se descartan al cambiar la
+generación.
+
+Cada snapshot guarda también sus variantes comprimidas (gzip y, si están
+instaladas, brotli y zstd), calculadas una sola vez al construirlo, y la
+lista de mensajes (/api/message) se cachea igual con su propia generación.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from compression import build_variants
+from models import GameVersion, GameFile, NewsMessage, UpdatePackage, ServerSettings, db
+from patch_builder import patches_for_pairs, patches_for_version
+
+GENERATION_KEY = 'manifest_generation'
+MESSAGES_GENERATION_KEY = 'messages_generation'
+
+_lock = threading.Lock()
+_snapshot = None
+_delta_cache = OrderedDict()
+_messages = None
+
+
+class ManifestSnapshot:
+    """Respuesta precalculada del manifiesto"""
+
+    __slots__ = ('body', 'variants', 'etag', 'status', 'generation', 'latest_version', 'built_at', 'checked_at')
+
+    def __init__(self, body, status, generation, latest_version=None):
+        self.body = body
+        self.variants = build_variants(body)
+        self.etag = hashlib.md5(body).hexdigest()
+        self.status = status
+        self.generation = generation
+        self.latest_version = latest_version
+        self.built_at = time.time()
+        self.checked_at = self.built_at
+
+
+def _read_generation(key=GENERATION_KEY):
+    """Leer el contador de generación compartido entre workers"""
+    return ServerSettings.get_value(key, '0')
+
+
+def _next_generation(key, description, retries=10):
+    """
+    Incrementar el contador de generación compartido y retornar el nuevo valor.
+
+    El incremento es un UPDATE condicional sobre el valor leído (como los
+    turnos de la cola de tareas): si otro proceso lo cambió a la vez se
+    vuelve a leer, así que dos invalidaciones nunca escriben la misma generación.
+    """
+    table = ServerSettings.__table__
+    for _ in range(retries):
+        current = db.session.execute(db.select(table.c.value).where(table.c.key == key)).scalar()
+        if current is None:
+            try:
+                db.session.execute(table.insert().values(
+                    key=key, value='1', description=description, updated_at=datetime.utcnow()
+                ))
+                db.session.commit()
+                return '1'
+            except IntegrityError:
+                db.session.rollback()  # otro proceso la creó a la vez
+                continue
+
+        try:
+            generation = str(int(current) + 1)
+        except ValueError:
+            generation = '1'
+        result = db.session.execute(
+            table.update().where(table.c.key == key, table.c.value == current)
+            .values(value=generation, updated_at=datetime.utcnow())
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return generation
+    raise RuntimeError(f"No se pudo incrementar la generación {key} tras {retries} intentos")
+
+
+def build_manifest_data():
+    """Construir el diccionario del manifiesto y su código de estado"""
+    latest_version = GameVersion.get_latest()
+
+    if not latest_version:
+        return {
+            "latest_version": "1.0.0.0",
+            "updates": [],
+            "file_hashes": []
+        }, 404
+
+    # Obtener todos los paquetes de actualización ordenados por versión
+    updates = db.session.query(GameVersion.version).join(
+        UpdatePackage, UpdatePackage.version_id == GameVersion.id
+    ).order_by(GameVersion.version_key).all()
+    update_filenames = [f"update_{row.version}.zip" for row in updates]
+
+    # Obtener hashes de archivos de la versión más reciente
+    files = db.session.query(
+        GameFile.filename, GameFile.relative_path, GameFile.md5_hash
+    ).filter(GameFile.version_id == latest_version.id).all()
+    patches = patches_for_version(latest_version.id)
+    file_hashes = []
+    for f in files:
+        entry = {
+            'FileName': f.filename,
+            'RelativePath': f.relative_path,
+            'MD5Hash': f.md5_hash
+        }
+        # Parche desde la versión anterior, si el archivo cambió y ya se generó
+        patch = patches.get(f.relative_path)
+        if patch is not None and patch.target_md5 == f.md5_hash:
+            entry['Patch'] = patch.to_manifest_dict()
+        file_hashes.append(entry)
+
+    return {
+        "latest_version": latest_version.version,
+        "updates": update_filenames,
+        "file_hashes": file_hashes
+    }, 200
+
+
+def _build_snapshot(generation):
+    data, status = build_manifest_data()
+    body = current_app.json.dumps(data).encode('utf-8')
+    latest_version = data['latest_version'] if status == 200 else None
+    return ManifestSnapshot(body, status, generation, latest_version)
+
+
+def _version_files(version_id):
+    """Mapa relative_path -> (filename, md5_hash) de una versión"""
+    rows = db.session.query(
+        GameFile.filename, GameFile.relative_path, GameFile.md5_hash
+    ).filter(GameFile.version_id == version_id).all()
+    return {row.relative_path: (row.filename, row.md5_hash) for row in rows}
+
+
+def build_delta_data(from_version, to_version):
+    """
+    Construir el manifiesto delta entre dos versiones.
+
+    Retorna solo los archivos añadidos o modificados en la versión destino,
+    las rutas eliminadas y la cadena ordenada de paquetes de actualización
+    posteriores a la versión origen.
+    """
+    source = GameVersion.query.filter_by(version=from_version).first()
+    target = GameVersion.query.filter_by(version=to_version).first()
+
+    if not source or not target:
+        return {"error": "Unknown version", "from_version": from_version}, 404
+
+    source_files = _version_files(source.id)
+    target_files = _version_files(target.id)
+
+    source_entries = {(path, md5) for path, (_, md5) in source_files.items()}
+    target_entries = {(path, md5) for path, (_, md5) in target_files.items()}
+
+    changed = sorted(target_entries - source_entries)
+    removed = sorted(source_files.keys() - target_files.keys())
+
+    # Parches que llevan del archivo instalado (versión origen) al de la versión destino
+    patches = patches_for_pairs(
+        (source_files[path][1], md5) for path, md5 in changed if path in source_files
+    )
+    file_hashes = []
+    for path, md5 in changed:
+        entry = {
+            'FileName': target_files[path][0],
+            'RelativePath': path,
+            'MD5Hash': md5
+        }
+        patch = patches.get((source_files[path][1], md5)) if path in source_files else None
+        if patch is not None:
+            entry['Patch'] = patch.to_manifest_dict()
+        file_hashes.append(entry)
+
+    # Paquetes de las versiones en el rango (origen, destino], por la clave numérica indexada
+    packages = GameVersion.newer_than(from_version, up_to=to_version).join(
+        UpdatePackage, UpdatePackage.version_id == GameVersion.id
+    ).with_entities(GameVersion.version_key, GameVersion.version).distinct().all()
+    chain = [row.version for row in packages]
+
+    return {
+        "from_version": from_version,
+        "latest_version": to_version,
+        "updates": [f"update_{version}.zip" for version in chain],
+        "file_hashes": file_hashes,
+        "removed_files": removed
+    }, 200
+
+
+def get_manifest_snapshot():
+    """Obtener el snapshot vigente, reconstruyéndolo si otro worker lo invalidó"""
+    global _snapshot
+
+    snapshot = _snapshot
+    now = time.time()
+    interval = current_app.config.get('MANIFEST_SNAPSHOT_CHECK_INTERVAL', 5)
+
+    if snapshot is not None and now - snapshot.checked_at < interval:
+        return snapshot
+
+    with _lock:
+        snapshot = _snapshot
+        if snapshot is not None and time.time() - snapshot.checked_at < interval:
+            return snapshot
+
+        generation = _read_generation()
+        if snapshot is not None and snapshot.generation == generation:
+            snapshot.checked_at = time.time()
+            return snapshot
+
+        _snapshot = _build_snapshot(generation)
+        current_app.logger.info(
+            f"Manifiesto reconstruido (generación {generation}, etag {_snapshot.etag})"
+        )
+        return _snapshot
+
+
+def get_delta_snapshot(from_version):
+    """Obtener el delta desde `from_version` hasta la versión actual, cacheado por par"""
+    snapshot = get_manifest_snapshot()
+    if snapshot.latest_version is None:
+        return snapshot
+
+    key = (snapshot.generation, from_version, snapshot.latest_version)
+
+    with _lock:
+        cached = _delta_cache.get(key)
+        if cached is not None:
+            _delta_cache.move_to_end(key)
+            return cached
+
+    data, status = build_delta_data(from_version, snapshot.latest_version)
+    body = current_app.json.dumps(data).encode('utf-8')
+    delta = ManifestSnapshot(body, status, snapshot.generation, snapshot.latest_version)
+
+    max_entries = current_app.config.get('MANIFEST_DELTA_CACHE_SIZE', 256)
+    with _lock:
+        # Descartar deltas de generaciones anteriores
+        for stale in [k for k in _delta_cache if k[0] != snapshot.generation]:
+            del _delta_cache[stale]
+        _delta_cache[key] = delta
+        while len(_delta_cache) > max_entries:
+            _delta_cache.popitem(last=False)
+
+    return delta
+
+
+def invalidate_manifest():
+    """
+    Invalidar el manifiesto tras un cambio en versiones, archivos o paquetes.
+
+    Incrementa la generación compartida para que el resto de workers
+    reconstruyan su copia y reconstruye inmediatamente la de este proceso.
+    """
+    global _snapshot
+
+    try:
+        with _lock:
+            generation = _next_generation(GENERATION_KEY, 'Generación del manifiesto de actualizaciones')
+            _snapshot = _build_snapshot(generation)
+            _delta_cache.clear()
+    except Exception as e:
+        db.session.rollback()
+        _snapshot = None
+        _delta_cache.clear()
+        current_app.logger.error(f"Error invalidando manifiesto: {e}")
+
+
+
+# ==================== MENSAJES ====================
+
+def build_messages_data():
+    """Lista de mensajes activos tal como la devuelve /api/message"""
+    active_messages = NewsMessage.query.filter_by(is_active=True).order_by(
+        NewsMessage.priority.desc(), NewsMessage.created_at.desc()
+    ).all()
+
+    return [{
+        'id': msg.id,
+        'type': msg.type,
+        'message': msg.message,
+        'priority': msg.priority,
+        'created_at': msg.created_at.isoformat() if msg.created_at else None
+    } for msg in active_messages]
+
+
+def _build_messages_snapshot(generation):
+    body = current_app.json.dumps(build_messages_data()).encode('utf-8')
+    return ManifestSnapshot(body, 200, generation)
+
+
+def get_messages_snapshot():
+    """Obtener la lista de mensajes precalculada, reconstruyéndola si otro worker la invalidó"""
+    global _messages
+
+    snapshot = _messages
+    interval = current_app.config.get('MANIFEST_SNAPSHOT_CHECK_INTERVAL', 5)
+    if snapshot is not None and time.time() - snapshot.checked_at < interval:
+        return snapshot
+
+    with _lock:
+        snapshot = _messages
+        if snapshot is not None and time.time() - snapshot.checked_at < interval:
+            return snapshot
+
+        generation = _read_generation(MESSAGES_GENERATION_KEY)
+        if snapshot is not None and snapshot.generation == generation:
+            snapshot.checked_at = time.time()
+            return snapshot
+
+        _messages = _build_messages_snapshot(generation)
+        return _messages
+
+
+def invalidate_messages():
+    """Invalidar la lista de mensajes tras crear, activar/desactivar o eliminar mensajes"""
+    global _messages
+
+    try:
+        with _lock:
+            generation = _next_generation(MESSAGES_GENERATION_KEY, 'Generación de la lista de mensajes')
+            _messages = _build_messages_snapshot(generation)
+    except Exception as e:
+        db.session.rollback()
+        _messages = None
+        current_app.logger.error(f"Error invalidando mensajes: {e}")
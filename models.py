@@ -1,7 +1,15 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import TypeDecorator, type_coerce
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import validates
+from sqlalchemy.sql.functions import FunctionElement
 from datetime import datetime
+import ipaddress
 import json
+from utils import version_sort_key
 
 db = SQLAlchemy()
 
@@ -57,6 +65,7 @@ class GameVersion(db.Model):
     __tablename__ = 'launcher_game_version'
     id = db.Column(db.Integer, primary_key=True)
     version = db.Column(db.String(20), unique=True, nullable=False)
+    version_key = db.Column(db.BigInteger, index=True)  # X.Y.Z.W empaquetado, ver utils.version_sort_key
     is_latest = db.Column(db.Boolean, default=False)
     release_notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -69,10 +78,58 @@ class GameVersion(db.Model):
     def __repr__(self):
         return f'<GameVersion {self.version}>'
 
+    @validates('version')
+    def _update_version_key(self, key, value):
+        # Mantener la clave numérica sincronizada con la cadena de versión
+        self.version_key = version_sort_key(value)
+        return value
+
+    @staticmethod
+    def newer_than(version_string, up_to=None):
+        """Consulta de versiones posteriores a `version_string` (y hasta `up_to`), en orden"""
+        query = GameVersion.query.filter(GameVersion.version_key > version_sort_key(version_string))
+        if up_to is not None:
+            query = query.filter(GameVersion.version_key <= version_sort_key(up_to))
+        return query.order_by(GameVersion.version_key)
+
     @staticmethod
     def get_latest():
         return GameVersion.query.filter_by(is_latest=True).first()
 
+    @staticmethod
+    def query_with_children():
+        """Versiones con archivos y paquetes precargados (una consulta por relación)"""
+        return GameVersion.query.options(
+            db.selectinload(GameVersion.files).load_only(
+                GameFile.id, GameFile.filename, GameFile.relative_path,
+                GameFile.md5_hash, GameFile.file_size, GameFile.version_id
+            ),
+            db.selectinload(GameVersion.update_packages)
+        )
+
+    @staticmethod
+    def query_summaries():
+        """
+        Versiones con solo las columnas de resumen y el número de archivos y
+        paquetes calculado en la misma consulta. Retorna filas
+        (GameVersion, files_count, update_packages_count).
+        """
+        files_count = db.session.query(db.func.count(GameFile.id)).filter(
+            GameFile.version_id == GameVersion.id
+        ).correlate(GameVersion).scalar_subquery()
+        packages_count = db.session.query(db.func.count(UpdatePackage.id)).filter(
+            UpdatePackage.version_id == GameVersion.id
+        ).correlate(GameVersion).scalar_subquery()
+
+        return db.session.query(
+            GameVersion,
+            files_count.label('files_count'),
+            packages_count.label('update_packages_count')
+        ).options(db.load_only(
+            GameVersion.id, GameVersion.version, GameVersion.is_latest,
+            GameVersion.release_notes, GameVersion.created_at, GameVersion.created_by
+        ))
+
     def set_as_latest(self):
         # Desmarcar la versión actual como latest
         current_latest = GameVersion.get_latest()
@@ -95,6 +152,19 @@ class GameVersion(db.Model):
             'update_packages': [u.id for u in self.update_packages]
         }
 
+    def to_summary_dict(self, files_count=0, update_packages_count=0):
+        """Serialización ligera sin la lista de archivos"""
+        return {
+            'id': self.id,
+            'version': self.version,
+            'is_latest': self.is_latest,
+            'release_notes': self.release_notes,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'created_by': self.created_by,
+            'files_count': files_count,
+            'update_packages_count': update_packages_count
+        }
+
 class UpdatePackage(db.Model):
     __tablename__ = 'launcher_update_package'
     id = db.Column(db.Integer, primary_key=True)
@@ -108,6 +178,11 @@ class UpdatePackage(db.Model):
 
     def __repr__(self):
         return f'<UpdatePackage {self.filename}>'
+
+    @staticmethod
+    def query_with_version():
+        """Paquetes unidos a su versión (para ordenar y mostrar sin consultas extra)"""
+        return UpdatePackage.query.join(GameVersion).options(db.contains_eager(UpdatePackage.version))
     
     def to_dict(self):
         return {
@@ -124,6 +199,9 @@ class UpdatePackage(db.Model):
 
 class GameFile(db.Model):
     __tablename__ = 'launcher_game_file'
+    __table_args__ = (
+        db.Index('idx_game_file_version_created_id', 'version_id', 'created_at', 'id'),  # paginación por cursor
+    )
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     relative_path = db.Column(db.String(500), nullable=False)
@@ -136,6 +214,15 @@ class GameFile(db.Model):
     def __repr__(self):
         return f'<GameFile {self.filename}>'
 
+    @staticmethod
+    def query_with_version():
+        """Archivos con las columnas básicas de su versión en la misma consulta"""
+        return GameFile.query.options(
+            db.joinedload(GameFile.version).load_only(
+                GameVersion.id, GameVersion.version, GameVersion.is_latest
+            )
+        )
+
     def to_dict(self):
         return {
             'FileName': self.filename,
@@ -234,15 +321,191 @@ class ServerSettings(db.Model):
         db.session.commit()
         return setting
 
+# ==================== LOGS DE DESCARGA (FORMATO COMPACTO) ====================
+
+# Tipos de archivo registrados y su código; solo se añaden al final
+FILE_TYPE_CODES = {
+    'update': 1, 'launcher': 2, 'game_file': 3, 'update_check': 4, 'launcher_check': 5,
+    'messages': 6, 'banner': 7, 'patch': 8, 'launcher_updater': 9, 'PBConfig': 10
+}
+FILE_TYPE_NAMES = {code: name for name, code in FILE_TYPE_CODES.items()}
+
+
+def normalize_ip(value):
+    """IP en su forma canónica, o None si no es una dirección válida"""
+    try:
+        return str(ipaddress.ip_address((value or '').strip()))
+    except ValueError:
+        return None
+
+
+class IPAddressType(TypeDecorator):
+    """IP como inet en PostgreSQL y 16 bytes (IPv4 mapeada en IPv6) en otros motores"""
+    impl = db.LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.INET())
+        return dialect.type_descriptor(db.LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        address = ipaddress.ip_address(value)
+        if dialect.name == 'postgresql':
+            return str(address)
+        if address.version == 4:
+            address = ipaddress.IPv6Address(f'::ffff:{address}')
+        return address.packed
+
+    def process_result_value(self, value, dialect):
+        # Las expresiones que combinan con la columna de texto pueden traer str
+        if value is None or isinstance(value, str):
+            return value
+        address = ipaddress.IPv6Address(bytes(value))
+        return str(address.ipv4_mapped or address)
+
+
+class FileTypeCode(TypeDecorator):
+    """file_type guardado como SMALLINT según FILE_TYPE_CODES"""
+    impl = db.SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else FILE_TYPE_CODES[value]
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else FILE_TYPE_NAMES.get(value)
+
+
+class ip_text(FunctionElement):
+    """
+    ip_text(compacta, anterior): la IP de la fila como texto. En PostgreSQL
+    se convierte en SQL (la columna anterior puede ser inet o varchar); en
+    otros motores se combinan las columnas y la decodifica IPAddressType.
+    """
+    type = IPAddressType()
+    inherit_cache = True
+
+
+@compiles(ip_text)
+def _compile_ip_text(element, compiler, **kw):
+    compact, raw = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f'coalesce({compact}, {raw})'
+
+
+@compiles(ip_text, 'postgresql')
+def _compile_ip_text_postgresql(element, compiler, **kw):
+    compact, raw = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f"coalesce(host({compact}), regexp_replace(CAST({raw} AS TEXT), '/(32|128)$', ''))"
+
+
+class LogUserAgent(db.Model):
+    """Diccionario de User-Agent de los logs de descarga"""
+    __tablename__ = 'launcher_log_user_agent'
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(500), unique=True, nullable=False)
+
+
+class LogFile(db.Model):
+    """Diccionario de nombres de archivo de los logs de descarga"""
+    __tablename__ = 'launcher_log_file'
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(255), unique=True, nullable=False)
+
+
 class DownloadLog(db.Model):
+    """
+    Registro de descarga en formato compacto.
+
+    User-Agent y archivo son ids de diccionario, la IP es inet/binaria y el
+    tipo un código. Las columnas de texto originales solo guardan las filas
+    aún sin migrar y los valores que el formato compacto no admite (IP no
+    válida, tipo desconocido). ip_address, user_agent, file_requested y
+    file_type se leen igual que antes, también en consultas.
+    """
     __tablename__ = 'launcher_download_log'
+    __table_args__ = (
+        db.Index('idx_download_log_created_id', 'created_at', 'id'),  # paginación por cursor
+    )
     id = db.Column(db.Integer, primary_key=True)
-    ip_address = db.Column(db.String(45), nullable=False)
-    user_agent = db.Column(db.String(500))
-    file_requested = db.Column(db.String(255), nullable=False)
-    file_type = db.Column(db.String(50))  # 'update', 'launcher', 'game_file'
+    ip = db.Column(IPAddressType)
+    user_agent_id = db.Column(db.Integer, db.ForeignKey('launcher_log_user_agent.id'))
+    file_id = db.Column(db.Integer, db.ForeignKey('launcher_log_file.id'))
+    file_type_code = db.Column(FileTypeCode)
     success = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # clave de partición en PostgreSQL
+
+    # Formato anterior en texto (NULL cuando el valor está en las columnas compactas)
+    raw_ip_address = db.Column('ip_address', db.String(45))
+    raw_user_agent = db.Column('user_agent', db.String(500))
+    raw_file_requested = db.Column('file_requested', db.String(255))
+    raw_file_type = db.Column('file_type', db.String(50))
+
+    user_agent_entry = db.relationship('LogUserAgent', lazy='joined')
+    file_entry = db.relationship('LogFile', lazy='joined')
+
+    @hybrid_property
+    def ip_address(self):
+        return self.ip if self.ip is not None else self.raw_ip_address
+
+    @ip_address.inplace.setter
+    def _ip_address_setter(self, value):
+        self.ip = normalize_ip(value)
+        self.raw_ip_address = None if self.ip is not None else value
+
+    @ip_address.inplace.expression
+    @classmethod
+    def _ip_address_expression(cls):
+        return ip_text(cls.ip, cls.raw_ip_address).label('ip_address')
+
+    @hybrid_property
+    def user_agent(self):
+        return self.user_agent_entry.value if self.user_agent_entry is not None else self.raw_user_agent
+
+    @user_agent.inplace.setter
+    def _user_agent_setter(self, value):
+        # Sin pasar por el diccionario; la migración la compacta después
+        self.user_agent_id = None
+        self.raw_user_agent = value
+
+    @user_agent.inplace.expression
+    @classmethod
+    def _user_agent_expression(cls):
+        value = db.select(LogUserAgent.value).where(LogUserAgent.id == cls.user_agent_id).scalar_subquery()
+        return db.func.coalesce(value, cls.raw_user_agent).label('user_agent')
+
+    @hybrid_property
+    def file_requested(self):
+        return self.file_entry.value if self.file_entry is not None else self.raw_file_requested
+
+    @file_requested.inplace.setter
+    def _file_requested_setter(self, value):
+        self.file_id = None
+        self.raw_file_requested = value
+
+    @file_requested.inplace.expression
+    @classmethod
+    def _file_requested_expression(cls):
+        value = db.select(LogFile.value).where(LogFile.id == cls.file_id).scalar_subquery()
+        return db.func.coalesce(value, cls.raw_file_requested).label('file_requested')
+
+    @hybrid_property
+    def file_type(self):
+        return self.file_type_code if self.file_type_code is not None else self.raw_file_type
+
+    @file_type.inplace.setter
+    def _file_type_setter(self, value):
+        known = value in FILE_TYPE_CODES
+        self.file_type_code = value if known else None
+        self.raw_file_type = None if known else value
+
+    @file_type.inplace.expression
+    @classmethod
+    def _file_type_expression(cls):
+        decoded = db.case(FILE_TYPE_NAMES, value=type_coerce(cls.file_type_code, db.SmallInteger))
+        return db.func.coalesce(decoded, cls.raw_file_type).label('file_type')
 
     def __repr__(self):
         return f'<DownloadLog {self.ip_address}: {self.file_requested}>'
@@ -257,3 +520,295 @@ class DownloadLog(db.Model):
             'success': self.success,
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
         }
+
+
+class DownloadRollup(db.Model):
+    __tablename__ = 'launcher_download_rollup'
+    __table_args__ = (
+        db.UniqueConstraint('granularity', 'bucket', 'file_type', 'file_requested', 'success',
+                            name='uq_download_rollup_key'),
+        db.Index('idx_download_rollup_bucket', 'granularity', 'bucket'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(10), nullable=False)  # 'hour', 'day'
+    bucket = db.Column(db.DateTime, nullable=False)  # inicio de la hora o del día (UTC)
+    file_type = db.Column(db.String(50), nullable=False, default='')
+    file_requested = db.Column(db.String(255), nullable=False)
+    success = db.Column(db.Boolean, nullable=False, default=True)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DownloadRollup {self.granularity} {self.bucket}: {self.file_requested}={self.count}>'
+
+    def to_dict(self):
+        return {
+            'granularity': self.granularity,
+            'bucket': self.bucket.strftime('%Y-%m-%d %H:%M:%S'),
+            'file_type': self.file_type,
+            'file_requested': self.file_requested,
+            'success': self.success,
+            'count': self.count
+        }
+
+
+class FileBlob(db.Model):
+    """Contenido almacenado una sola vez en uploads/blobs, referenciado por GameFile.md5_hash"""
+    __tablename__ = 'launcher_file_blob'
+    md5_hash = db.Column(db.String(32), primary_key=True)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # filas de GameFile que lo usan
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<FileBlob {self.md5_hash} refs={self.ref_count}>'
+
+    def to_dict(self):
+        return {
+            'md5_hash': self.md5_hash,
+            'file_size': self.file_size,
+            'ref_count': self.ref_count,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
+        }
+
+
+class PackageBuild(db.Model):
+    """Construcción en segundo plano de update_<versión>.zip a partir de la diferencia entre versiones"""
+    __tablename__ = 'launcher_package_build'
+    __table_args__ = (
+        db.Index('idx_package_build_status', 'status', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    version_id = db.Column(db.Integer, db.ForeignKey('launcher_game_version.id'), nullable=False)
+    from_version_id = db.Column(db.Integer, db.ForeignKey('launcher_game_version.id'))  # None: paquete completo
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed
+    compress_level = db.Column(db.Integer, nullable=False, default=6)
+    total_files = db.Column(db.Integer, default=0)
+    done_files = db.Column(db.Integer, default=0)
+    stored_files = db.Column(db.Integer, default=0)  # miembros guardados sin comprimir
+    total_bytes = db.Column(db.BigInteger, default=0)
+    done_bytes = db.Column(db.BigInteger, default=0)
+    package_size = db.Column(db.BigInteger)
+    error = db.Column(db.Text)
+    package_id = db.Column(db.Integer, db.ForeignKey('launcher_update_package.id', ondelete='SET NULL'))
+    requested_by = db.Column(db.Integer, db.ForeignKey('launcher_user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # un build 'running' sin latido reciente se retoma
+    finished_at = db.Column(db.DateTime)
+
+    version = db.relationship('GameVersion', foreign_keys=[version_id])
+    from_version = db.relationship('GameVersion', foreign_keys=[from_version_id])
+
+    def __repr__(self):
+        return f'<PackageBuild {self.id} {self.status}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'version_id': self.version_id,
+            'version': self.version.version if self.version else None,
+            'from_version_id': self.from_version_id,
+            'from_version': self.from_version.version if self.from_version else None,
+            'status': self.status,
+            'compress_level': self.compress_level,
+            'total_files': self.total_files,
+            'done_files': self.done_files,
+            'stored_files': self.stored_files,
+            'total_bytes': self.total_bytes,
+            'done_bytes': self.done_bytes,
+            'package_size': self.package_size,
+            'error': self.error,
+            'package_id': self.package_id,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None
+        }
+
+
+class FilePatch(db.Model):
+    """Parche binario (bsdiff) de un archivo entre una versión y la anterior"""
+    __tablename__ = 'launcher_file_patch'
+    __table_args__ = (
+        db.Index('idx_file_patch_version_path', 'version_id', 'relative_path'),
+        db.Index('idx_file_patch_pair', 'source_md5', 'target_md5'),
+        db.Index('idx_file_patch_status', 'status', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    version_id = db.Column(db.Integer, db.ForeignKey('launcher_game_version.id'), nullable=False)
+    from_version_id = db.Column(db.Integer, db.ForeignKey('launcher_game_version.id'), nullable=False)
+    relative_path = db.Column(db.String(500), nullable=False)
+    source_md5 = db.Column(db.String(32), nullable=False)
+    target_md5 = db.Column(db.String(32), nullable=False)  # hash resultante tras aplicar el parche
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, skipped, failed
+    patch_size = db.Column(db.BigInteger)
+    patch_md5 = db.Column(db.String(32))
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<FilePatch {self.relative_path} {self.status}>'
+
+    @property
+    def patch_name(self):
+        # El archivo se comparte entre filas con el mismo par de contenidos
+        return f'{self.source_md5}_{self.target_md5}.bsdiff'
+
+    def to_manifest_dict(self):
+        return {
+            'Url': f'/api/patches/{self.patch_name}',
+            'Format': 'bsdiff4',
+            'Size': self.patch_size,
+            'MD5Hash': self.patch_md5,
+            'FromMD5Hash': self.source_md5,
+            'ResultMD5Hash': self.target_md5
+        }
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'version_id': self.version_id,
+            'from_version_id': self.from_version_id,
+            'relative_path': self.relative_path,
+            'source_md5': self.source_md5,
+            'target_md5': self.target_md5,
+            'status': self.status,
+            'patch_size': self.patch_size,
+            'patch_md5': self.patch_md5,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
+        }
+
+
+class FileChunkManifest(db.Model):
+    """Hashes por bloque fijo de un contenido del almacén, calculados al ingerirlo"""
+    __tablename__ = 'launcher_file_chunks'
+    md5_hash = db.Column(db.String(32), primary_key=True)  # mismo contenido que FileBlob.md5_hash
+    file_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    algorithm = db.Column(db.String(20), nullable=False, default='blake2b-128')
+    digest_size = db.Column(db.SmallInteger, nullable=False, default=16)
+    digests = db.Column(db.LargeBinary, nullable=False)  # hashes concatenados, digest_size bytes cada uno
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<FileChunkManifest {self.md5_hash} {self.chunk_count} bloques>'
+
+    @property
+    def chunk_count(self):
+        return len(self.digests) // self.digest_size
+
+    def hex_digests(self):
+        size = self.digest_size
+        return [self.digests[i:i + size].hex() for i in range(0, len(self.digests), size)]
+
+    def to_dict(self):
+        return {
+            'md5': self.md5_hash,
+            'file_size': self.file_size,
+            'algorithm': self.algorithm,
+            'chunk_size': self.chunk_size,
+            'chunk_count': self.chunk_count,
+            'chunks': self.hex_digests()  # el bloque i ocupa [i * chunk_size, min((i + 1) * chunk_size, file_size))
+        }
+
+
+class BackgroundJob(db.Model):
+    """Tarea de administración ejecutada en segundo plano (ver job_queue.py)"""
+    __tablename__ = 'launcher_job'
+    __table_args__ = (
+        db.Index('idx_job_status_run_after', 'status', 'run_after'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # nombre del manejador registrado
+    payload = db.Column(db.Text, nullable=False, default='{}')  # argumentos en JSON
+    idempotency_key = db.Column(db.String(200), unique=True)  # la misma clave no encola dos veces
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed, cancelled
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow)  # reintentos con espera creciente
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    progress_done = db.Column(db.BigInteger, default=0)
+    progress_total = db.Column(db.BigInteger, default=0)
+    progress_message = db.Column(db.String(255))
+    result = db.Column(db.Text)  # JSON
+    error = db.Column(db.Text)
+    requested_by = db.Column(db.Integer, db.ForeignKey('launcher_user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # una tarea 'running' sin latido reciente se retoma
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<BackgroundJob {self.id} {self.kind} {self.status}>'
+
+    @property
+    def arguments(self):
+        return json.loads(self.payload or '{}')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'cancel_requested': self.cancel_requested,
+            'progress_done': self.progress_done,
+            'progress_total': self.progress_total,
+            'progress_message': self.progress_message,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S') if self.started_at else None,
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None
+        }
+
+
+class ScheduledTask(db.Model):
+    """Tarea de mantenimiento periódica y su turno entre procesos (ver scheduler.py)"""
+    __tablename__ = 'launcher_scheduled_task'
+    name = db.Column(db.String(50), primary_key=True)
+    interval_seconds = db.Column(db.Integer, nullable=False)
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    next_run_at = db.Column(db.DateTime, nullable=False)
+    lease_owner = db.Column(db.String(100))  # proceso (host:pid) que está encolando la ejecución
+    lease_until = db.Column(db.DateTime)  # un turno caducado lo puede tomar otro proceso
+    last_run_at = db.Column(db.DateTime)
+    last_job_id = db.Column(db.Integer, db.ForeignKey('launcher_job.id', ondelete='SET NULL'))
+    run_count = db.Column(db.Integer, nullable=False, default=0)
+
+    last_job = db.relationship('BackgroundJob')
+
+    def __repr__(self):
+        return f'<ScheduledTask {self.name} next={self.next_run_at}>'
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'interval_seconds': self.interval_seconds,
+            'enabled': self.enabled,
+            'next_run_at': self.next_run_at.strftime('%Y-%m-%d %H:%M:%S') if self.next_run_at else None,
+            'last_run_at': self.last_run_at.strftime('%Y-%m-%d %H:%M:%S') if self.last_run_at else None,
+            'last_job_id': self.last_job_id,
+            'last_status': self.last_job.status if self.last_job else None,
+            'run_count': self.run_count
+        }
+
+
+class LogSketch(db.Model):
+    """Resumen aproximado de los logs de un bucket (HyperLogLog o top-K, ver sketches.py)"""
+    __tablename__ = 'launcher_log_sketch'
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'granularity', 'bucket', name='uq_log_sketch_key'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # unique_ips, top_files, top_ips
+    granularity = db.Column(db.String(10), nullable=False)  # hour, day
+    bucket = db.Column(db.DateTime, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)  # concurrencia optimista al fusionar
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<LogSketch {self.kind} {self.granularity} {self.bucket}>'
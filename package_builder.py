@@ -0,0 +1,510 @@
+"""
+Construcción automática de paquetes de actualización
+
+A partir de los GameFile de dos versiones se arma update_<versión>.zip solo
+con los archivos añadidos o modificados en la versión destino y se registra
+(o actualiza) su UpdatePackage con tamaño y MD5.
+
+Las construcciones se piden con request_build() y las ejecuta un hilo de
+fondo por proceso, que las toma de launcher_package_build con un UPDATE
+condicional (solo un worker de gunicorn gana cada una). Los miembros se
+comprimen en paralelo (ver parallel_zip.py) a un directorio de trabajo
+uploads/updates/.build_<destino>_<origen>/, uno por contenido, con un
+.json al lado cuando ya están completos. Si el proceso muere a medias, el
+build deja de emitir latidos y otro worker lo retoma aprovechando los
+miembros ya comprimidos.
+
+El ZIP terminado se guarda con su MD5 en el nombre
+(update_<versión>.<md5>.zip) y UpdatePackage.file_path pasa a apuntarlo en
+la misma transacción que su md5_hash y file_size, que además cierra el
+build solo si sigue en 'running'. /api/updates/<nombre> sirve el file_path
+vigente (published_package), así que nunca hay bytes nuevos con el hash
+anterior; el archivo previo se borra tras el commit.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from flask import current_app
+from models import GameFile, GameVersion, PackageBuild, UpdatePackage, db
+from parallel_zip import CompressedMember, add_precompressed, compress_member
+from utils import BlockHasher
+import blob_store
+
+BUILD_STATUSES = ('pending', 'running', 'done', 'failed')
+ACTIVE_STATUSES = ('pending', 'running')
+
+_builder = None
+_builder_lock = threading.Lock()
+
+
+PublishedPackage = namedtuple('PublishedPackage', 'path md5_hash file_size etag')
+
+
+class BuildAborted(Exception):
+    """El build dejó de pertenecer a este proceso (eliminado o retomado por otro)"""
+
+
+class _HashingWriter:
+    """Archivo de salida que calcula el MD5 y los hashes por bloque de lo que se escribe"""
+
+    def __init__(self, fileobj, block_size):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.blocks = BlockHasher(block_size)
+        self.size = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.blocks.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+# ==================== DIFERENCIAS ENTRE VERSIONES ====================
+
+def previous_version(version):
+    """Versión inmediatamente anterior por version_key, o None"""
+    if version.version_key is None:
+        return None
+    return GameVersion.query.filter(
+        GameVersion.version_key < version.version_key
+    ).order_by(GameVersion.version_key.desc()).first()
+
+
+def diff_version_files(to_version_id, from_version_id=None):
+    """
+    Archivos de la versión destino añadidos o modificados respecto al origen.
+
+    Retorna una lista de (relative_path, md5_hash, file_size) ordenada por
+    ruta. Sin versión de origen se incluyen todos los archivos.
+    """
+    rows = db.session.query(
+        GameFile.relative_path, GameFile.md5_hash, GameFile.file_size
+    ).filter(GameFile.version_id == to_version_id).all()
+
+    source = set()
+    if from_version_id is not None:
+        source = set(db.session.query(GameFile.relative_path, GameFile.md5_hash).filter(
+            GameFile.version_id == from_version_id
+        ).all())
+
+    members = {}
+    for relative_path, md5_hash, file_size in rows:
+        if (relative_path, md5_hash) not in source:
+            members[relative_path] = (relative_path, md5_hash, file_size or 0)
+    return [members[path] for path in sorted(members)]
+
+
+def package_path(app, version, md5_hash=None):
+    """Ruta de update_<versión>.zip o, con `md5_hash`, de ese contenido concreto"""
+    name = f'update_{version}.{md5_hash}.zip' if md5_hash else f'update_{version}.zip'
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'updates', name)
+
+
+def published_package(filename):
+    """
+    PublishedPackage del UpdatePackage que se sirve como `filename`, o None si
+    no hay registro o su archivo no está. El ETag solo se da si el tamaño en
+    disco coincide con el registrado.
+    """
+    row = db.session.query(UpdatePackage.file_path, UpdatePackage.md5_hash, UpdatePackage.file_size).filter(
+        UpdatePackage.filename == filename
+    ).order_by(UpdatePackage.id.desc()).first()
+    if row is None or not row.file_path or not os.path.isfile(row.file_path):
+        return None
+    etag = None
+    if row.md5_hash and os.path.getsize(row.file_path) == row.file_size:
+        etag = f'{row.md5_hash}-{row.file_size}'
+    return PublishedPackage(row.file_path, row.md5_hash, row.file_size, etag)
+
+
+def remove_unreferenced_package(path, keep=None):
+    """Borrar un archivo de paquete si ningún UpdatePackage lo usa (y no es `keep`)"""
+    if not path or path == keep or not os.path.exists(path):
+        return
+    if UpdatePackage.query.filter_by(file_path=path).first() is None:
+        os.remove(path)
+
+
+def work_dir(app, build):
+    """Directorio de miembros comprimidos, compartido por los reintentos del mismo par"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'updates',
+                        f'.build_{build.version_id}_{build.from_version_id or 0}')
+
+
+# ==================== PETICIONES ====================
+
+def request_build(version, from_version=None, user_id=None, level=None):
+    """
+    Pedir la construcción del paquete de `version` desde `from_version`.
+
+    Si ya hay un build activo para el mismo par se reutiliza; uno fallido se
+    vuelve a poner en cola. Retorna el PackageBuild (confirmado).
+    """
+    if level is None:
+        level = current_app.config.get('PACKAGE_BUILD_COMPRESS_LEVEL', 6)
+    from_version_id = from_version.id if from_version is not None else None
+
+    build = PackageBuild.query.filter(
+        PackageBuild.version_id == version.id,
+        PackageBuild.from_version_id.is_(None) if from_version_id is None
+        else PackageBuild.from_version_id == from_version_id,
+        PackageBuild.status.in_(ACTIVE_STATUSES + ('failed',))
+    ).order_by(PackageBuild.id.desc()).first()
+
+    if build is None:
+        build = PackageBuild(version_id=version.id, from_version_id=from_version_id,
+                             requested_by=user_id, compress_level=level)
+        db.session.add(build)
+    elif build.status == 'failed':
+        build.status = 'pending'
+        build.error = None
+        build.compress_level = level
+        build.requested_by = user_id or build.requested_by
+    db.session.commit()
+
+    builder = get_package_builder()
+    if builder is not None:
+        builder.wake()
+    return build
+
+
+# ==================== CONSTRUCCIÓN ====================
+
+def _compress_to_work_dir(source, directory, md5_hash, level, name):
+    """Comprimir un contenido al directorio de trabajo (se ejecuta en el pool)"""
+    data_path = os.path.join(directory, f'{md5_hash}.bin')
+    tmp = f'{data_path}.{uuid.uuid4().hex}.part'
+    try:
+        member = compress_member(source, tmp, level, name=name)
+        os.replace(tmp, data_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    meta = dict(member._asdict(), level=level)
+    meta_tmp = f'{data_path}.{uuid.uuid4().hex}.json.part'
+    with open(meta_tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_tmp, os.path.join(directory, f'{md5_hash}.json'))
+    return md5_hash, member
+
+
+def _load_compressed(directory, md5_hash, level):
+    """Miembro ya comprimido en un intento anterior, o None"""
+    meta_path = os.path.join(directory, f'{md5_hash}.json')
+    data_path = os.path.join(directory, f'{md5_hash}.bin')
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.pop('level') != level or os.path.getsize(data_path) != meta['compress_size']:
+            return None
+        return CompressedMember(**meta)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+class PackageBuilder:
+    """Hilo de fondo que ejecuta los builds pendientes o abandonados"""
+
+    def __init__(self, app, max_workers=4, poll_interval=10, stale_seconds=120, heartbeat_interval=2):
+        self.app = app
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.heartbeat_interval = heartbeat_interval
+
+        self._pid = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def ensure_started(self):
+        """Arrancar el hilo en este proceso (los workers de gunicorn se crean con fork)"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+
+            self._pid = os.getpid()
+            self._wake = threading.Event()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='package-builder', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self.ensure_started()
+        self._wake.set()
+
+    def shutdown(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                while not self._stop.is_set() and self.run_next():
+                    pass
+            except Exception as e:
+                self.app.logger.error(f"Error en el constructor de paquetes: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    # --- Reclamar builds ---
+
+    def _stale_cutoff(self):
+        return datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+
+    def _claim(self, build_id):
+        """Tomar el build si sigue pendiente o abandonado. True si lo ganó este proceso"""
+        table = PackageBuild.__table__
+        now = datetime.utcnow()
+        result = db.session.execute(
+            table.update().where(
+                table.c.id == build_id,
+                db.or_(
+                    table.c.status == 'pending',
+                    db.and_(table.c.status == 'running', table.c.heartbeat_at < self._stale_cutoff())
+                )
+            ).values(status='running', heartbeat_at=now,
+                     started_at=db.func.coalesce(table.c.started_at, now))
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    def _heartbeat(self, build_id, **values):
+        """Anotar progreso y emitirlo al panel. Lanza BuildAborted si el build ya no es de este proceso"""
+        table = PackageBuild.__table__
+        result = db.session.execute(
+            table.update().where(table.c.id == build_id, table.c.status == 'running')
+            .values(heartbeat_at=datetime.utcnow(), **values)
+        )
+        db.session.commit()
+        if result.rowcount != 1:
+            raise BuildAborted(f"Build {build_id} cancelado o retomado por otro proceso")
+        if values:
+            try:
+                from socketio_utils import emit_to_admin
+                emit_to_admin('package_build_progress', dict(values, build_id=build_id))
+            except Exception:
+                pass
+
+    def run_next(self):
+        """Ejecutar un build pendiente o abandonado. Retorna True si ejecutó alguno"""
+        with self.app.app_context():
+            candidates = db.session.query(PackageBuild.id).filter(db.or_(
+                PackageBuild.status == 'pending',
+                db.and_(PackageBuild.status == 'running', PackageBuild.heartbeat_at < self._stale_cutoff())
+            )).order_by(PackageBuild.id).limit(10).all()
+
+            for (build_id,) in candidates:
+                if self._claim(build_id):
+                    self.run_build(build_id)
+                    return True
+            return False
+
+    # --- Ejecución ---
+
+    def run_build(self, build_id):
+        """Construir un build ya reclamado, marcándolo como terminado o fallido"""
+        app = self.app
+        try:
+            build = db.session.get(PackageBuild, build_id)
+            package = self._build(build)
+        except BuildAborted as e:
+            db.session.rollback()
+            app.logger.warning(str(e))
+            return None
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error construyendo paquete (build {build_id}): {e}")
+            db.session.execute(
+                PackageBuild.__table__.update().where(PackageBuild.id == build_id).values(
+                    status='failed', error=str(e)[:2000], finished_at=datetime.utcnow()
+                )
+            )
+            db.session.commit()
+            try:
+                from socketio_utils import notify_admin
+                notify_admin(f"Error construyendo paquete de actualización: {e}", 'error',
+                             {'action': 'update_build_failed', 'build_id': build_id})
+            except Exception:
+                pass
+            return None
+
+        from manifest_cache import invalidate_manifest
+        from socketio_utils import notify_update_created
+        invalidate_manifest()
+        try:
+            notify_update_created(build.version.version, package.filename)
+        except Exception:
+            pass
+        return package
+
+    def _build(self, build):
+        app = self.app
+        version = build.version
+        level = build.compress_level
+        members = diff_version_files(build.version_id, build.from_version_id)
+        if not members:
+            raise ValueError("No hay archivos nuevos ni modificados entre las versiones")
+
+        # Un trabajo por contenido distinto: las rutas con el mismo MD5 comparten miembro
+        contents = {}
+        for relative_path, md5_hash, file_size in members:
+            contents.setdefault(md5_hash, (relative_path, file_size))
+
+        directory = work_dir(app, build)
+        os.makedirs(directory, exist_ok=True)
+
+        compressed = {}
+        pending = []
+        for md5_hash, (relative_path, file_size) in contents.items():
+            member = _load_compressed(directory, md5_hash, level)
+            if member is not None:
+                compressed[md5_hash] = member
+                continue
+            source = blob_store.blob_path(md5_hash)
+            if source is None or not os.path.exists(source):
+                raise FileNotFoundError(f"Contenido no encontrado para {relative_path} ({md5_hash})")
+            pending.append((md5_hash, source, relative_path))
+
+        total_bytes = sum(file_size for _, file_size in contents.values())
+        done_bytes = sum(member.file_size for member in compressed.values())
+        self._heartbeat(build.id, total_files=len(contents), done_files=len(compressed),
+                        total_bytes=total_bytes, done_bytes=done_bytes)
+        if compressed:
+            app.logger.info(f"Build {build.id}: retomando con {len(compressed)}/{len(contents)} miembros ya comprimidos")
+
+        # 1. Comprimir en paralelo, con latidos aunque un miembro grande tarde
+        if pending:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='package-build') as pool:
+                futures = {pool.submit(_compress_to_work_dir, source, directory, md5_hash, level, name)
+                           for md5_hash, source, name in pending}
+                try:
+                    while futures:
+                        finished, futures = wait(futures, timeout=self.heartbeat_interval,
+                                                 return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            md5_hash, member = future.result()
+                            compressed[md5_hash] = member
+                            done_bytes += member.file_size
+                        self._heartbeat(build.id, done_files=len(compressed), done_bytes=done_bytes)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        # 2. Ensamblar en orden de ruta y calcular el MD5 mientras se escribe
+        date_time = (version.created_at or datetime.utcnow()).timetuple()[:6]
+        if date_time[0] < 1980:
+            date_time = (1980, 1, 1, 0, 0, 0)
+        target = package_path(app, version.version)
+        block_size = app.config.get('FILE_BLOCK_MANIFEST_SIZE', 1024 * 1024)
+        tmp = f'{target}.{uuid.uuid4().hex}.part'
+        try:
+            with open(tmp, 'wb') as raw:
+                writer = _HashingWriter(raw, block_size)
+                with zipfile.ZipFile(writer, 'w', allowZip64=True) as zipf:
+                    for relative_path, md5_hash, _ in members:
+                        add_precompressed(zipf, relative_path, os.path.join(directory, f'{md5_hash}.bin'),
+                                          compressed[md5_hash], date_time)
+            self._heartbeat(build.id)
+            md5_hash = writer.md5.hexdigest()
+            content_path = package_path(app, version.version, md5_hash)
+            os.replace(tmp, content_path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        # 3. Cerrar el build y publicar el paquete en una transacción, solo si
+        #    el build sigue siendo de este proceso
+        stored_files = sum(1 for member in compressed.values() if member.method == zipfile.ZIP_STORED)
+        table = PackageBuild.__table__
+        result = db.session.execute(
+            table.update().where(table.c.id == build.id, table.c.status == 'running').values(
+                status='done', package_size=writer.size, stored_files=stored_files,
+                done_files=len(contents), done_bytes=total_bytes, finished_at=datetime.utcnow()
+            )
+        )
+        if result.rowcount != 1:
+            db.session.rollback()
+            remove_unreferenced_package(content_path)
+            raise BuildAborted(f"Build {build.id} cancelado o retomado por otro proceso")
+
+        filename = os.path.basename(target)
+        package = UpdatePackage.query.filter_by(version_id=version.id).first()
+        old_path = None
+        if package is not None:
+            old_path = package.file_path
+            package.filename = filename
+            package.file_path = content_path
+            package.file_size = writer.size
+            package.md5_hash = md5_hash
+        else:
+            package = UpdatePackage(filename=filename, version_id=version.id, file_path=content_path,
+                                    file_size=writer.size, md5_hash=md5_hash,
+                                    uploaded_by=build.requested_by)
+            db.session.add(package)
+        blob_store.record_chunk_manifests([(md5_hash, writer.size, block_size, writer.blocks.digest())])
+        db.session.flush()
+        db.session.execute(table.update().where(table.c.id == build.id).values(package_id=package.id))
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            remove_unreferenced_package(content_path)
+            raise
+
+        remove_unreferenced_package(old_path, keep=content_path)
+        shutil.rmtree(directory, ignore_errors=True)
+        app.logger.info(
+            f"Paquete {filename} construido (build {build.id}): {len(members)} archivos, "
+            f"{writer.size} bytes, {stored_files} sin comprimir"
+        )
+        return package
+
+
+def init_package_builder(app):
+    """Crear el constructor de paquetes según la configuración de la aplicación"""
+    global _builder
+
+    with _builder_lock:
+        if not app.config.get('PACKAGE_BUILD_ENABLED', True):
+            _builder = None
+            return None
+
+        _builder = PackageBuilder(
+            app,
+            max_workers=app.config.get('PACKAGE_BUILD_WORKERS', os.cpu_count() or 1),
+            poll_interval=app.config.get('PACKAGE_BUILD_POLL_INTERVAL', 10),
+            stale_seconds=app.config.get('PACKAGE_BUILD_STALE_SECONDS', 120)
+        )
+        # Arranque perezoso en cada worker: retoma los builds que quedaron a medias
+        app.before_request(_builder.ensure_started)
+        atexit.register(_builder.shutdown)
+        return _builder
+
+
+def get_package_builder():
+    return _builder
@@ -0,0 +1,137 @@
+"""
+Paginación por cursor (keyset) sobre (created_at, id)
+
+En lugar de OFFSET + COUNT(*) cada página se pide con una condición sobre la
+última fila vista, de modo que la página 5.000 cuesta lo mismo que la
+primera. Los cursores son tokens opacos (base64 de la clave y la dirección).
+Los totales pueden ser exactos, aproximados (estadísticas del planificador de
+PostgreSQL o agregados) o no calcularse.
+"""
+
+import base64
+import json
+from datetime import datetime
+from models import db
+
+TOTAL_MODES = ('exact', 'approx', 'none')
+
+
+class KeysetPage:
+    """Página de resultados con cursores anterior/siguiente"""
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None,
+                 total=None, total_is_approximate=False):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.total_is_approximate = total_is_approximate
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def to_dict(self):
+        return {
+            'perPage': self.per_page,
+            'total': self.total,
+            'totalIsApproximate': self.total_is_approximate,
+            'hasNext': self.has_next,
+            'hasPrev': self.has_prev,
+            'nextCursor': self.next_cursor,
+            'prevCursor': self.prev_cursor
+        }
+
+
+def encode_cursor(created_at, row_id, direction):
+    """Codificar la clave (created_at, id) y la dirección en un token opaco"""
+    payload = json.dumps([created_at.isoformat(), row_id, direction], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decodificar un token. Retorna (created_at, id, dirección) o None si no es válido"""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        created_at, row_id, direction = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if direction not in ('next', 'prev'):
+            return None
+        return datetime.fromisoformat(created_at), int(row_id), direction
+    except (ValueError, TypeError):
+        return None
+
+
+def keyset_paginate(query, created_column, id_column, cursor=None, per_page=50,
+                    total=None, total_is_approximate=False):
+    """
+    Paginar `query` en orden descendente por (created_at, id).
+
+    `cursor` es el token recibido del cliente; sin cursor se devuelve la
+    primera página.
+    """
+    decoded = decode_cursor(cursor)
+
+    if decoded is None:
+        rows = query.order_by(created_column.desc(), id_column.desc()).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        items = rows[:per_page]
+        has_next, has_prev = has_more, False
+    else:
+        created_at, row_id, direction = decoded
+        if direction == 'next':
+            rows = query.filter(db.or_(
+                created_column < created_at,
+                db.and_(created_column == created_at, id_column < row_id)
+            )).order_by(created_column.desc(), id_column.desc()).limit(per_page + 1).all()
+            items = rows[:per_page]
+            has_next, has_prev = len(rows) > per_page, True
+        else:
+            rows = query.filter(db.or_(
+                created_column > created_at,
+                db.and_(created_column == created_at, id_column > row_id)
+            )).order_by(created_column.asc(), id_column.asc()).limit(per_page + 1).all()
+            items = list(reversed(rows[:per_page]))
+            has_next, has_prev = True, len(rows) > per_page
+
+    next_cursor = prev_cursor = None
+    if items:
+        if has_next:
+            next_cursor = encode_cursor(items[-1].created_at, items[-1].id, 'next')
+        if has_prev:
+            prev_cursor = encode_cursor(items[0].created_at, items[0].id, 'prev')
+
+    return KeysetPage(items, per_page, next_cursor, prev_cursor, total, total_is_approximate)
+
+
+def approximate_table_count(table_name):
+    """
+    Número aproximado de filas según las estadísticas del planificador.
+
+    En una tabla particionada se suman las de sus particiones. Solo
+    disponible en PostgreSQL; en otros motores retorna None.
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return None
+
+    estimate = db.session.execute(
+        db.text(
+            "SELECT CASE WHEN parent.relkind = 'p' THEN ("
+            "  SELECT SUM(GREATEST(child.reltuples, 0))::bigint FROM pg_inherits"
+            "  JOIN pg_class child ON child.oid = pg_inherits.inhrelid"
+            "  WHERE pg_inherits.inhparent = parent.oid"
+            ") ELSE parent.reltuples::bigint END "
+            "FROM pg_class parent WHERE parent.relname = :name"
+        ),
+        {'name': table_name}
+    ).scalar()
+
+    if estimate is None or estimate < 0:
+        return None
+    return int(estimate)
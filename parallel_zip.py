@@ -0,0 +1,271 @@
+"""
+Escritura de ZIP con miembros comprimidos en paralelo
+
+Cada miembro se comprime por separado a un archivo intermedio con DEFLATE
+crudo (o se copia tal cual en modo STORED) y después se ensambla el ZIP en
+orden determinista copiando esos bytes ya comprimidos detrás de su cabecera
+local. La compresión, que es lo costoso, puede repartirse entre varios
+núcleos con un pool de hilos (zlib libera el GIL) o de procesos.
+
+El método de cada miembro se decide por tipo y por la entropía de una
+muestra inicial: los tipos ya comprimidos (zip, imágenes, audio, vídeo...)
+y los datos casi aleatorios se guardan sin comprimir, los de entropía media
+con el nivel más rápido y el resto con el nivel pedido. Si el DEFLATE final
+no ahorra al menos un 3 % el miembro se guarda también sin comprimir.
+"""
+
+import fnmatch
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+COPY_BUFFER_SIZE = 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVINGS_RATIO = 0.97  # comprimido / original por encima del cual se usa STORED
+STORED_ENTROPY = 7.5      # bits por byte de la muestra a partir de los que no se comprime
+FAST_ENTROPY = 6.0        # a partir de aquí un nivel alto apenas gana y cuesta mucho más
+FAST_LEVEL = 1
+BATCH_BYTES = 8 * 1024 * 1024  # los archivos pequeños se agrupan en tareas de este tamaño
+BATCH_FILES = 64
+
+INCOMPRESSIBLE_EXTENSIONS = frozenset({
+    '.zip', '.7z', '.rar', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.cab',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.mp3', '.ogg', '.opus', '.mp4', '.webm', '.avi', '.mkv', '.bik'
+})
+
+CompressedMember = namedtuple('CompressedMember', 'method crc file_size compress_size')
+
+
+def is_incompressible(name):
+    """True si la extensión indica contenido ya comprimido"""
+    return os.path.splitext(name)[1].lower() in INCOMPRESSIBLE_EXTENSIONS
+
+
+def sample_entropy(data):
+    """Entropía de Shannon en bits por byte (0 a 8)"""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def choose_level(source_path, level, name=None):
+    """
+    Nivel de compresión para un miembro: 0 (STORED), FAST_LEVEL o `level`.
+
+    Se decide por la extensión y por la entropía del primer bloque.
+    """
+    if level == 0 or is_incompressible(name or source_path):
+        return 0
+    with open(source_path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    if len(sample) < SAMPLE_SIZE:
+        return level  # archivos pequeños: decide el resultado completo
+    entropy = sample_entropy(sample)
+    if entropy >= STORED_ENTROPY:
+        return 0
+    if entropy >= FAST_ENTROPY:
+        return min(level, FAST_LEVEL)
+    return level
+
+
+def _store(source_path, target_path):
+    """Copiar el archivo calculando su CRC-32"""
+    crc = 0
+    size = 0
+    with open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+        while True:
+            chunk = src.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            dst.write(chunk)
+    return CompressedMember(zipfile.ZIP_STORED, crc, size, size)
+
+
+def _deflate(source_path, target_path, level):
+    """Comprimir con DEFLATE crudo (sin cabecera zlib), como lo espera el ZIP"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    compress_size = 0
+    with open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+        while True:
+            chunk = src.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            compress_size += len(data)
+            dst.write(data)
+        data = compressor.flush()
+        compress_size += len(data)
+        dst.write(data)
+    return CompressedMember(zipfile.ZIP_DEFLATED, crc, size, compress_size)
+
+
+def compress_member(source_path, target_path, level=6, name=None):
+    """
+    Comprimir `source_path` en `target_path` listo para add_precompressed().
+
+    `name` (por defecto el origen) se usa para reconocer la extensión.
+    Retorna un CompressedMember.
+    """
+    level = choose_level(source_path, level, name)
+    if level == 0:
+        return _store(source_path, target_path)
+
+    member = _deflate(source_path, target_path, level)
+    if member.compress_size >= member.file_size * MIN_SAVINGS_RATIO and member.file_size:
+        return _store(source_path, target_path)
+    return member
+
+
+def compress_batch(jobs):
+    """compress_member() para una lista de (origen, destino, nivel, nombre); tarea del pool"""
+    return [compress_member(*job) for job in jobs]
+
+
+def add_precompressed(zipf, arcname, data_path, member, date_time=(1980, 1, 1, 0, 0, 0), mode=0o644):
+    """
+    Añadir a un ZipFile abierto en modo 'w' un miembro ya comprimido.
+
+    Como los tamaños y el CRC se conocen de antemano, la cabecera local se
+    escribe completa y los datos se copian sin recomprimir ni volver atrás
+    en el archivo (funciona también sobre flujos que no admiten seek).
+    """
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.compress_type = member.method
+    zinfo.CRC = member.crc
+    zinfo.file_size = member.file_size
+    zinfo.compress_size = member.compress_size
+    zinfo.external_attr = (mode & 0xFFFF) << 16
+
+    with zipf._lock:
+        zinfo.header_offset = zipf.fp.tell()
+        zipf._writecheck(zinfo)
+        zip64 = member.file_size > zipfile.ZIP64_LIMIT or member.compress_size > zipfile.ZIP64_LIMIT
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        with open(data_path, 'rb') as data:
+            shutil.copyfileobj(data, zipf.fp, COPY_BUFFER_SIZE)
+
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        zipf.start_dir = zipf.fp.tell()
+        zipf._didModify = True
+    return zinfo
+
+
+# ==================== EXCLUSIONES ====================
+
+def compile_excludes(patterns):
+    """
+    Compilar los patrones de exclusión en una sola expresión regular.
+
+    Un patrón sin comodines excluye las rutas que lo contienen (como hasta
+    ahora); uno con * ? o [ se compara, estilo fnmatch, con la ruta completa
+    o con cualquier sufijo que empiece tras una '/'. Retorna una función
+    ruta -> bool.
+    """
+    alternatives = []
+    for pattern in patterns or ():
+        pattern = pattern.replace('\\', '/')
+        if any(char in pattern for char in '*?['):
+            alternatives.append(r'(?:^|/)' + fnmatch.translate(pattern))
+        elif pattern:
+            alternatives.append(re.escape(pattern))
+
+    if not alternatives:
+        return lambda path: False
+    regex = re.compile('|'.join(f'(?:{alternative})' for alternative in alternatives))
+    return lambda path: regex.search(path) is not None
+
+
+# ==================== ESCRITURA COMPLETA ====================
+
+def _process_context():
+    """Contexto para el pool de procesos sin heredar hilos del worker por fork"""
+    methods = multiprocessing.get_all_start_methods()
+    if 'forkserver' in methods:
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _batches(jobs):
+    """Agrupar trabajos consecutivos hasta BATCH_BYTES o BATCH_FILES por tarea"""
+    batch, size = [], 0
+    for job in jobs:
+        batch.append(job)
+        size += job[4]
+        if size >= BATCH_BYTES or len(batch) >= BATCH_FILES:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def write_zip(zip_path, members, level=6, max_workers=None, executor='process'):
+    """
+    Escribir un ZIP con los miembros comprimidos en paralelo.
+
+    `members` es una lista de (ruta de origen, nombre en el ZIP); el orden de
+    la lista es el del archivo resultante. `executor` es 'process', 'thread'
+    o 'serial'. Los intermedios van a un directorio temporal junto al ZIP y
+    cada uno se borra en cuanto se copia, así que el disco extra se limita a
+    lo que va por delante de la escritura. Retorna la lista de CompressedMember.
+    """
+    directory = os.path.dirname(os.path.abspath(zip_path))
+    work = tempfile.mkdtemp(prefix='.zip-', dir=directory)
+    jobs = [(source, os.path.join(work, str(index)), level, arcname, os.path.getsize(source))
+            for index, (source, arcname) in enumerate(members)]
+    batches = list(_batches(jobs))
+
+    if executor == 'serial':
+        pool = None
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='zip')
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=_process_context())
+    else:
+        raise ValueError(f"Ejecutor no válido: {executor}")
+
+    results = []
+    try:
+        if pool is None:
+            pending = ((batch, None) for batch in batches)
+        else:
+            pending = [(batch, pool.submit(compress_batch, [job[:4] for job in batch])) for batch in batches]
+
+        with zipfile.ZipFile(zip_path, 'w', allowZip64=True) as zipf:
+            for batch, future in pending:
+                compressed = future.result() if future is not None else compress_batch([job[:4] for job in batch])
+                for (source, target, _, arcname, _), member in zip(batch, compressed):
+                    stat = os.stat(source)
+                    date_time = _zip_date_time(stat.st_mtime)
+                    add_precompressed(zipf, arcname, target, member, date_time, stat.st_mode)
+                    os.remove(target)
+                    results.append(member)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+def _zip_date_time(timestamp):
+    """Fecha de modificación en el formato del ZIP (no admite años anteriores a 1980)"""
+    date_time = time.localtime(timestamp)[:6]
+    return date_time if date_time[0] >= 1980 else (1980, 1, 1, 0, 0, 0)
@@ -0,0 +1,399 @@
+"""
+Parches binarios entre versiones consecutivas de cada archivo del juego
+
+Cuando un archivo cambia entre una versión y la anterior (misma ruta
+relativa, distinto MD5) se genera un parche bsdiff que el launcher puede
+aplicar en lugar de descargar el archivo completo. El manifiesto anuncia
+cada parche terminado con su URL, tamaño, MD5 y el hash de origen y
+resultante (ver FilePatch.to_manifest_dict).
+
+schedule_patches() calcula los pares que debe tener una versión y deja en
+cola los que faltan en launcher_file_patch. Un hilo de fondo por proceso
+reclama las filas pendientes con un UPDATE condicional y las genera en un
+pool de procesos con límite de memoria (RLIMIT_AS): bsdiff necesita unas
+17 veces el tamaño del archivo de origen, así que los que no caben se
+marcan como omitidos. Los parches que no ahorran lo suficiente frente al
+archivo completo también se omiten.
+
+Los archivos viven en uploads/patches/<md5 origen>_<md5 destino>.bsdiff,
+compartidos por todas las filas con el mismo par, y purge_orphan_patches()
+borra los que ya no usa ninguna fila (al eliminar versiones o reprogramar).
+
+Requiere el paquete bsdiff4; sin él no se generan parches y el manifiesto
+no cambia.
+"""
+
+import atexit
+import hashlib
+import multiprocessing
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from flask import current_app
+from models import FilePatch, GameFile, GameVersion, db
+from package_builder import previous_version
+import blob_store
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+_PATCH_NAME_RE = re.compile(r'^([0-9a-f]{32})_([0-9a-f]{32})\.bsdiff$')
+BSDIFF_MEMORY_FACTOR = 17  # bytes de memoria por byte de origen (sufijos + datos)
+
+_generator = None
+_generator_lock = threading.Lock()
+
+
+def patch_root(app=None):
+    return os.path.join((app or current_app).config['UPLOAD_FOLDER'], 'patches')
+
+
+def parse_patch_name(name):
+    """(md5 origen, md5 destino) de un nombre de parche, o None si no es válido"""
+    match = _PATCH_NAME_RE.match(name or '')
+    return match.groups() if match else None
+
+
+# ==================== PROGRAMACIÓN ====================
+
+def _desired_patches(version, previous):
+    """Mapa relative_path -> (md5 origen, md5 destino) de los archivos que cambiaron"""
+    if previous is None:
+        return {}
+    source = dict(db.session.query(GameFile.relative_path, GameFile.md5_hash).filter(
+        GameFile.version_id == previous.id
+    ).all())
+    target = db.session.query(GameFile.relative_path, GameFile.md5_hash).filter(
+        GameFile.version_id == version.id
+    ).all()
+    return {
+        relative_path: (source[relative_path], md5_hash)
+        for relative_path, md5_hash in target
+        if relative_path in source and source[relative_path] != md5_hash
+    }
+
+
+def schedule_patches(version):
+    """
+    Sincronizar los parches de `version` con su versión anterior.
+
+    Elimina las filas que ya no corresponden (otra versión anterior o archivos
+    que cambiaron) y encola las que faltan. Retorna cuántas se encolaron.
+    """
+    previous = previous_version(version)
+    desired = _desired_patches(version, previous)
+
+    existing = FilePatch.query.filter_by(version_id=version.id).all()
+    obsolete = []
+    for patch in existing:
+        pair = desired.get(patch.relative_path)
+        if previous is None or patch.from_version_id != previous.id or pair != (patch.source_md5, patch.target_md5):
+            obsolete.append(patch.id)
+        else:
+            del desired[patch.relative_path]
+
+    if obsolete:
+        FilePatch.query.filter(FilePatch.id.in_(obsolete)).delete(synchronize_session=False)
+    if desired:
+        now = datetime.utcnow()
+        db.session.execute(FilePatch.__table__.insert(), [{
+            'version_id': version.id, 'from_version_id': previous.id,
+            'relative_path': relative_path, 'source_md5': source_md5, 'target_md5': target_md5,
+            'status': 'pending', 'created_at': now
+        } for relative_path, (source_md5, target_md5) in desired.items()])
+    db.session.commit()
+
+    if obsolete:
+        purge_orphan_patches()
+    if desired:
+        generator = get_patch_generator()
+        if generator is not None:
+            generator.wake()
+    return len(desired)
+
+
+def schedule_version_patches(version):
+    """Programar los parches de `version` y de la siguiente, cuya anterior puede haber cambiado"""
+    queued = schedule_patches(version)
+    if version.version_key is not None:
+        following = GameVersion.query.filter(
+            GameVersion.version_key > version.version_key
+        ).order_by(GameVersion.version_key).first()
+        if following is not None:
+            queued += schedule_patches(following)
+    return queued
+
+
+def delete_version_patches(version_id):
+    """Eliminar (sin confirmar) las filas de parches que usan una versión como origen o destino"""
+    FilePatch.query.filter(db.or_(
+        FilePatch.version_id == version_id, FilePatch.from_version_id == version_id
+    )).delete(synchronize_session=False)
+
+
+def purge_orphan_patches():
+    """Borrar los archivos de parche que ya no usa ninguna fila terminada. Retorna cuántos"""
+    directory = patch_root()
+    if not os.path.isdir(directory):
+        return 0
+
+    used = {f'{source}_{target}.bsdiff' for source, target in db.session.query(
+        FilePatch.source_md5, FilePatch.target_md5
+    ).filter(FilePatch.status.in_(('pending', 'running', 'done'))).distinct()}
+
+    removed = 0
+    for name in os.listdir(directory):
+        if parse_patch_name(name) and name not in used:
+            os.remove(os.path.join(directory, name))
+            removed += 1
+    if removed:
+        current_app.logger.info(f"Parches sin uso eliminados: {removed}")
+    return removed
+
+
+# ==================== CONSULTAS PARA EL MANIFIESTO ====================
+
+def patches_for_version(version_id):
+    """Parches terminados de una versión por ruta relativa"""
+    rows = FilePatch.query.filter_by(version_id=version_id, status='done').all()
+    return {patch.relative_path: patch for patch in rows}
+
+
+def patches_for_pairs(pairs):
+    """Parches terminados para pares (md5 origen, md5 destino), por par"""
+    pairs = set(pairs)
+    if not pairs:
+        return {}
+    rows = FilePatch.query.filter(
+        FilePatch.status == 'done',
+        FilePatch.target_md5.in_({target for _, target in pairs})
+    ).all()
+    return {(patch.source_md5, patch.target_md5): patch for patch in rows
+            if (patch.source_md5, patch.target_md5) in pairs}
+
+
+def find_patch(name):
+    """Fila terminada para un nombre de archivo de parche, o None"""
+    pair = parse_patch_name(name)
+    if pair is None:
+        return None
+    return FilePatch.query.filter_by(source_md5=pair[0], target_md5=pair[1], status='done').first()
+
+
+# ==================== GENERACIÓN ====================
+
+def _limit_memory(limit):
+    """Inicializador de los procesos del pool: limitar su espacio de direcciones"""
+    if not limit:
+        return
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def generate_patch(source_path, target_path, patch_path):
+    """Generar un parche bsdiff (se ejecuta en el pool). Retorna (tamaño, md5)"""
+    tmp = f'{patch_path}.{uuid.uuid4().hex}.part'
+    try:
+        bsdiff4.file_diff(source_path, target_path, tmp)
+        md5 = hashlib.md5()
+        with open(tmp, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, patch_path)
+        return size, md5.hexdigest()
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class PatchGenerator:
+    """Hilo de fondo que reclama parches pendientes y los genera en un pool de procesos"""
+
+    def __init__(self, app, max_workers=2, memory_limit=2 * 1024 ** 3, max_ratio=0.6,
+                 poll_interval=30, stale_seconds=900, batch_size=32):
+        self.app = app
+        self.max_workers = max_workers
+        self.memory_limit = memory_limit
+        self.max_ratio = max_ratio
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.batch_size = batch_size
+
+        self._pid = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def ensure_started(self):
+        """Arrancar el hilo en este proceso (los workers de gunicorn se crean con fork)"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+
+            self._pid = os.getpid()
+            self._wake = threading.Event()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='patch-generator', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self.ensure_started()
+        self._wake.set()
+
+    def shutdown(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                while not self._stop.is_set() and self.run_batch():
+                    pass
+            except Exception as e:
+                self.app.logger.error(f"Error en el generador de parches: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _claim(self):
+        """Reclamar hasta batch_size filas pendientes o abandonadas"""
+        table = FilePatch.__table__
+        stale = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        available = db.or_(
+            table.c.status == 'pending',
+            db.and_(table.c.status == 'running', table.c.claimed_at < stale)
+        )
+        candidates = [row.id for row in db.session.query(FilePatch.id).filter(available)
+                      .order_by(FilePatch.id).limit(self.batch_size)]
+
+        claimed = []
+        for patch_id in candidates:
+            result = db.session.execute(
+                table.update().where(table.c.id == patch_id, available)
+                .values(status='running', claimed_at=datetime.utcnow())
+            )
+            if result.rowcount == 1:
+                claimed.append(patch_id)
+        db.session.commit()
+        return FilePatch.query.filter(FilePatch.id.in_(claimed)).all() if claimed else []
+
+    def _finish(self, patches, **values):
+        """Anotar el resultado en las filas que siguen reclamadas por este proceso"""
+        table = FilePatch.__table__
+        db.session.execute(
+            table.update().where(table.c.id.in_([patch.id for patch in patches]), table.c.status == 'running')
+            .values(finished_at=datetime.utcnow(), **values)
+        )
+
+    def run_batch(self):
+        """Generar un lote de parches. Retorna True si había trabajo"""
+        with self.app.app_context():
+            patches = self._claim()
+            if not patches:
+                return False
+
+            directory = patch_root(self.app)
+            os.makedirs(directory, exist_ok=True)
+
+            # Un trabajo por par de contenidos: varias rutas pueden compartir parche
+            jobs = {}
+            for patch in patches:
+                jobs.setdefault((patch.source_md5, patch.target_md5), []).append(patch)
+
+            to_generate = {}
+            for (source_md5, target_md5), rows in jobs.items():
+                source, target = blob_store.blob_path(source_md5), blob_store.blob_path(target_md5)
+                patch_path = os.path.join(directory, rows[0].patch_name)
+                if bsdiff4 is None:
+                    self._finish(rows, status='skipped', error='bsdiff4 no está instalado')
+                elif not (source and target and os.path.exists(source) and os.path.exists(target)):
+                    self._finish(rows, status='failed', error='Contenido de origen o destino no encontrado')
+                elif os.path.getsize(source) * BSDIFF_MEMORY_FACTOR + os.path.getsize(target) > self.memory_limit:
+                    self._finish(rows, status='skipped', error='Archivo demasiado grande para el límite de memoria')
+                else:
+                    to_generate[(source_md5, target_md5)] = (source, target, patch_path)
+            db.session.commit()
+
+            generated = 0
+            if to_generate:
+                generated = self._generate(jobs, to_generate)
+            if generated:
+                from manifest_cache import invalidate_manifest
+                invalidate_manifest()
+            return True
+
+    def _generate(self, jobs, to_generate):
+        context = multiprocessing.get_context(
+            'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        )
+        generated = 0
+        with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context,
+                                 initializer=_limit_memory, initargs=(self.memory_limit,)) as pool:
+            futures = {pool.submit(generate_patch, *paths): pair for pair, paths in to_generate.items()}
+            for future in as_completed(futures):
+                pair = futures[future]
+                rows = jobs[pair]
+                patch_path = to_generate[pair][2]
+                try:
+                    size, md5 = future.result()
+                except MemoryError:
+                    self._finish(rows, status='skipped', error='Límite de memoria superado')
+                except Exception as e:
+                    self._finish(rows, status='failed', error=str(e)[:2000] or type(e).__name__)
+                else:
+                    target_size = os.path.getsize(to_generate[pair][1])
+                    if target_size and size > target_size * self.max_ratio:
+                        os.remove(patch_path)
+                        self._finish(rows, status='skipped', patch_size=size,
+                                     error='El parche no ahorra suficiente frente al archivo completo')
+                    else:
+                        self._finish(rows, status='done', patch_size=size, patch_md5=md5, error=None)
+                        generated += 1
+                db.session.commit()
+
+        self.app.logger.info(f"Parches generados: {generated} de {len(to_generate)}")
+        return generated
+
+
+def init_patch_generator(app):
+    """Crear el generador de parches según la configuración de la aplicación"""
+    global _generator
+
+    with _generator_lock:
+        if not app.config.get('PATCH_ENABLED', True):
+            _generator = None
+            return None
+
+        if bsdiff4 is None:
+            app.logger.warning("bsdiff4 no está instalado: no se generarán parches binarios")
+
+        _generator = PatchGenerator(
+            app,
+            max_workers=app.config.get('PATCH_WORKERS', 2),
+            memory_limit=app.config.get('PATCH_WORKER_MEMORY_LIMIT', 2 * 1024 ** 3),
+            max_ratio=app.config.get('PATCH_MAX_RATIO', 0.6),
+            poll_interval=app.config.get('PATCH_POLL_INTERVAL', 30),
+            stale_seconds=app.config.get('PATCH_STALE_SECONDS', 900)
+        )
+        # Arranque perezoso en cada worker: retoma los parches que quedaron pendientes
+        app.before_request(_generator.ensure_started)
+        atexit.register(_generator.shutdown)
+        return _generator
+
+
+def get_patch_generator():
+    return _generator
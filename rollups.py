@@ -0,0 +1,194 @@
+"""
+Agregados precalculados de descargas por hora y por día
+
+Cada lote escrito en launcher_download_log se agrega en memoria y se suma a
+launcher_download_rollup por (granularidad, bucket, file_type,
+file_requested, success) con un upsert atómico. El dashboard, /api/stats y
+/admin/logs/stats leen de estos agregados, de modo que su coste depende del
+número de horas/días consultados y no del tamaño de la tabla de logs.
+
+backfill_rollups() recalcula los agregados de un rango a partir de los logs
+históricos.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from models import DownloadLog, DownloadRollup, db
+
+GRANULARITIES = ('hour', 'day')
+KEY_COLUMNS = ('granularity', 'bucket', 'file_type', 'file_requested', 'success')
+
+
+def bucket_start(timestamp, granularity):
+    """Inicio del bucket (hora o día) que contiene `timestamp`"""
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def aggregate_records(records, counts=None):
+    """Agregar registros de log (dicts) en contadores por clave de rollup"""
+    counts = Counter() if counts is None else counts
+    for record in records:
+        created_at = record.get('created_at') or datetime.utcnow()
+        file_type = record.get('file_type') or ''
+        success = record.get('success', True) is not False
+        for granularity in GRANULARITIES:
+            counts[(granularity, bucket_start(created_at, granularity),
+                    file_type, record['file_requested'], success)] += 1
+    return counts
+
+
+def _dialect_insert():
+    """insert() con soporte ON CONFLICT para el dialecto activo, si existe"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+
+def apply_increments(counts):
+    """Sumar los contadores a la tabla de agregados (sin confirmar la transacción)"""
+    if not counts:
+        return
+
+    table = DownloadRollup.__table__
+    rows = [dict(zip(KEY_COLUMNS, key), count=value) for key, value in counts.items()]
+
+    insert = _dialect_insert()
+    if insert is not None:
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(KEY_COLUMNS),
+            set_={'count': table.c.count + stmt.excluded['count']}
+        )
+        db.session.execute(stmt, rows)
+        return
+
+    # Dialectos sin ON CONFLICT: actualizar y si no existe insertar
+    for row in rows:
+        result = db.session.execute(
+            table.update()
+            .where(*[table.c[column] == row[column] for column in KEY_COLUMNS])
+            .values(count=table.c.count + row['count'])
+        )
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(**row))
+
+
+def record_rollups(records, retries=3):
+    """Incorporar un lote de logs ya guardados a los agregados"""
+    counts = aggregate_records(records)
+
+    for attempt in range(retries):
+        try:
+            apply_increments(counts)
+            db.session.commit()
+            return True
+        except Exception as e:
+            db.session.rollback()
+            if attempt == retries - 1:
+                current_app.logger.error(f"Error actualizando agregados de descargas: {e}")
+    return False
+
+
+def backfill_rollups(start=None, end=None, chunk_size=10000):
+    """
+    Recalcular los agregados a partir de los logs históricos.
+
+    El rango se amplía a días completos. Si no se indica inicio se usa el
+    log más antiguo. Retorna el número de logs procesados.
+    """
+    end = end or datetime.utcnow()
+    if start is None:
+        start = db.session.query(db.func.min(DownloadLog.created_at)).scalar()
+        if start is None:
+            return 0
+
+    start = bucket_start(start, 'day')
+    end = bucket_start(end, 'day') + timedelta(days=1)
+
+    DownloadRollup.query.filter(
+        DownloadRollup.bucket >= start,
+        DownloadRollup.bucket < end
+    ).delete(synchronize_session=False)
+
+    rows = db.session.query(
+        DownloadLog.file_requested, DownloadLog.file_type,
+        DownloadLog.success, DownloadLog.created_at
+    ).filter(
+        DownloadLog.created_at >= start,
+        DownloadLog.created_at < end
+    ).yield_per(chunk_size)
+
+    # Las claves están acotadas por horas x archivos del rango, no por el número de logs
+    processed = 0
+    counts = Counter()
+    for row in rows:
+        aggregate_records((row._asdict(),), counts)
+        processed += 1
+
+    apply_increments(counts)
+    db.session.commit()
+
+    current_app.logger.info(f"Agregados de descargas recalculados: {processed} logs desde {start}")
+    return processed
+
+
+# ==================== CONSULTAS ====================
+
+def _sum_query(granularity):
+    return db.session.query(db.func.coalesce(db.func.sum(DownloadRollup.count), 0)).filter(
+        DownloadRollup.granularity == granularity
+    )
+
+
+def total_downloads(success=None, since=None):
+    """Total de descargas, opcionalmente filtrado por estado y desde una fecha"""
+    granularity = 'day' if since is None else 'hour'
+    query = _sum_query(granularity)
+    if success is not None:
+        query = query.filter(DownloadRollup.success == success)
+    if since is not None:
+        query = query.filter(DownloadRollup.bucket >= bucket_start(since, 'hour'))
+    return int(query.scalar() or 0)
+
+
+def downloads_by_type():
+    """Descargas totales agrupadas por file_type"""
+    rows = db.session.query(
+        DownloadRollup.file_type, db.func.sum(DownloadRollup.count)
+    ).filter(
+        DownloadRollup.granularity == 'day'
+    ).group_by(DownloadRollup.file_type).all()
+    return {(file_type or None): int(count) for file_type, count in rows}
+
+
+def popular_files(limit=10, since=None):
+    """Archivos más solicitados, en total o desde una fecha"""
+    granularity = 'day' if since is None else 'hour'
+    total = db.func.sum(DownloadRollup.count)
+    query = db.session.query(DownloadRollup.file_requested, total).filter(
+        DownloadRollup.granularity == granularity
+    )
+    if since is not None:
+        query = query.filter(DownloadRollup.bucket >= bucket_start(since, 'hour'))
+    rows = query.group_by(DownloadRollup.file_requested).order_by(total.desc()).limit(limit).all()
+    return [(file_requested, int(count)) for file_requested, count in rows]
+
+
+def series(granularity, start, end):
+    """Descargas por bucket en [start, end) como dict bucket -> total"""
+    rows = db.session.query(
+        DownloadRollup.bucket, db.func.sum(DownloadRollup.count)
+    ).filter(
+        DownloadRollup.granularity == granularity,
+        DownloadRollup.bucket >= start,
+        DownloadRollup.bucket < end
+    ).group_by(DownloadRollup.bucket).all()
+    return {bucket: int(count) for bucket, count in rows}
@@ -72,8 +72,16 @@ def initialize_database():
         with app.app_context():
             # Crear tablas si no existen
             db.create_all()
+            
+            # Aplicar columnas e índices nuevos sobre tablas existentes
+            from schema_upgrades import upgrade_schema
+            upgrade_schema()
             logger.info("Base de datos inicializada correctamente")
             
+            # Precargar el índice de dispositivos antes de crear los workers
+            from ban_index import ban_index
+            ban_index.load()
+            
             # Crear usuario administrador por defecto
             #create_admin_user()
             
@@ -129,8 +137,10 @@ def run_production():
             'access_logfile': 'logs/access.log',
             'error_logfile': 'logs/error.log',
             'loglevel': 'info',
-            'capture_output': True
+            'capture_output': True,
+            'sendfile': True if app.config.get('FILE_OFFLOAD_MODE') == 'sendfile' else None
         }
+        logger.info(f"Modo de entrega de archivos: {app.config.get('FILE_OFFLOAD_MODE', 'none')}")
         
         GunicornApp(app, options).run()
         
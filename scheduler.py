@@ -0,0 +1,269 @@
+"""
+Programador de las tareas de mantenimiento periódicas
+
+Cada proceso tiene un hilo que revisa launcher_scheduled_task; cuando una
+tarea vence, el primer proceso que toma su turno (UPDATE condicional sobre
+lease_owner/lease_until) la encola en job_queue.py y calcula la siguiente
+ejecución. Así, entre los workers de gunicorn y los nodos que comparten la
+base de datos, cada tarea se encola una sola vez por intervalo:
+
+- El turno caduca a los SCHEDULER_LEASE_SECONDS; si el proceso muere entre
+  tomarlo y encolar, otro lo retoma y la clave de idempotencia de la
+  ejecución (schedule:<tarea>:<vencimiento>) evita encolarla dos veces.
+- La siguiente ejecución lleva un margen aleatorio (SCHEDULER_JITTER) para
+  que las tareas no coincidan siempre en el mismo instante.
+- El historial son las propias tareas de la cola (reintentos, progreso y
+  resultado incluidos); se conservan SCHEDULER_HISTORY_DAYS días.
+"""
+
+import atexit
+import os
+import random
+import socket
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from models import BackgroundJob, ScheduledTask, db
+import job_queue
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class MaintenanceTask(namedtuple('MaintenanceTask', 'name kind title interval_key default_interval enabled_key payload')):
+    """Tarea periódica: tipo de tarea de la cola, intervalo y argumentos según la configuración"""
+
+    def interval(self, config):
+        return max(60, int(config.get(self.interval_key, self.default_interval)))
+
+    def enabled(self, config):
+        return self.enabled_key is None or bool(config.get(self.enabled_key, True))
+
+
+MAINTENANCE_TASKS = (
+    MaintenanceTask('log_retention', 'cleanup_logs', 'Retención de logs',
+                    'LOG_RETENTION_INTERVAL', 86400, 'LOG_RETENTION_ENABLED',
+                    lambda config: {'days': config.get('LOG_RETENTION_DAYS', 90)}),
+    MaintenanceTask('log_partitions', 'maintain_log_partitions', 'Crear particiones de logs',
+                    'LOG_PARTITION_CHECK_INTERVAL', 86400, 'LOG_PARTITIONING_ENABLED',
+                    lambda config: {'months_ahead': config.get('LOG_PARTITION_PREMAKE_MONTHS', 2)}),
+    MaintenanceTask('rollup_refresh', 'rebuild_rollups', 'Recalcular estadísticas del día anterior',
+                    'ROLLUP_REFRESH_INTERVAL', 86400, 'ROLLUP_REFRESH_ENABLED',
+                    lambda config: {'days': 1, 'include_today': False}),
+    MaintenanceTask('backup_rotation', 'rotate_backups', 'Rotación de backups',
+                    'BACKUP_INTERVAL', 3600, 'BACKUP_ENABLED',
+                    lambda config: {'max_age_days': config.get('BACKUP_RETENTION_DAYS', 30)}),
+    MaintenanceTask('integrity_scan', 'integrity_scan', 'Verificar integridad de blobs',
+                    'INTEGRITY_SCAN_INTERVAL', 86400, 'INTEGRITY_SCAN_ENABLED',
+                    lambda config: {'verify_hash': config.get('INTEGRITY_SCAN_VERIFY_HASH', False)}),
+)
+
+_tasks_by_name = {task.name: task for task in MAINTENANCE_TASKS}
+
+
+def maintenance_task(name):
+    return _tasks_by_name.get(name)
+
+
+def history_key_prefix(name):
+    return f'schedule:{name}:'
+
+
+def run_now(name):
+    """Adelantar la siguiente ejecución de una tarea al próximo ciclo del programador"""
+    table = ScheduledTask.__table__
+    result = db.session.execute(
+        table.update().where(table.c.name == name).values(next_run_at=datetime.utcnow())
+    )
+    db.session.commit()
+    if result.rowcount and _scheduler is not None:
+        _scheduler.wake()
+    return result.rowcount == 1
+
+
+class MaintenanceScheduler:
+    """Hilo por proceso que encola las tareas periódicas vencidas"""
+
+    def __init__(self, app, poll_interval=60, jitter=300, lease_seconds=120, history_days=30):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.jitter = jitter
+        self.lease_seconds = lease_seconds
+        self.history_days = history_days
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'[:100]
+
+        self._pid = None
+        self._thread = None
+        self._synced = False
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def ensure_started(self):
+        """Arrancar el hilo en este proceso (los workers de gunicorn se crean con fork)"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.owner = f'{socket.gethostname()}:{self._pid}'[:100]
+                self._synced = False
+                self._wake = threading.Event()
+                self._stop = threading.Event()
+
+            self._thread = threading.Thread(target=self._run, name='maintenance-scheduler', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self.ensure_started()
+        self._wake.set()
+
+    def shutdown(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._pid == os.getpid() and self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self.tick()
+            except Exception as e:
+                self.app.logger.error(f"Error en el programador de mantenimiento: {e}")
+            # Cada proceso revisa en un momento distinto
+            self._wake.wait(self.poll_interval * random.uniform(0.8, 1.2))
+            self._wake.clear()
+
+    # --- Programación ---
+
+    def _jitter(self, interval):
+        return timedelta(seconds=random.uniform(0, min(self.jitter, interval / 10)))
+
+    def sync_tasks(self):
+        """Crear las filas que falten y aplicar los intervalos y activaciones de la configuración"""
+        config = self.app.config
+        now = datetime.utcnow()
+        for task in MAINTENANCE_TASKS:
+            interval = task.interval(config)
+            row = db.session.get(ScheduledTask, task.name)
+            if row is None:
+                db.session.add(ScheduledTask(name=task.name, interval_seconds=interval,
+                                             enabled=task.enabled(config),
+                                             next_run_at=now + self._jitter(interval)))
+                try:
+                    db.session.commit()
+                except IntegrityError:
+                    # Otro proceso la creó a la vez
+                    db.session.rollback()
+                continue
+
+            row.enabled = task.enabled(config)
+            if row.interval_seconds != interval:
+                row.interval_seconds = interval
+                row.next_run_at = min(row.next_run_at, now + timedelta(seconds=interval) + self._jitter(interval))
+            db.session.commit()
+        self._synced = True
+
+    def tick(self):
+        """Encolar las tareas vencidas cuyo turno gane este proceso. Retorna las encoladas"""
+        if not self._synced:
+            self.sync_tasks()
+
+        # (nombre, vencimiento) leídos de una vez: tras cada commit otro proceso pudo reprogramarlas
+        due = db.session.query(ScheduledTask.name, ScheduledTask.next_run_at).filter(
+            ScheduledTask.enabled.is_(True),
+            ScheduledTask.next_run_at <= datetime.utcnow()
+        ).order_by(ScheduledTask.next_run_at).all()
+
+        enqueued = []
+        for name, due_at in due:
+            task = maintenance_task(name)
+            if task is None or not self._acquire(name, due_at):
+                continue
+            try:
+                job = self._dispatch(task, due_at)
+            except Exception:
+                db.session.rollback()
+                self._release(name)
+                raise
+            enqueued.append(job)
+        return enqueued
+
+    def _acquire(self, name, due_at):
+        """Tomar el turno de la tarea si sigue vencida y nadie lo tiene. True si lo ganó este proceso"""
+        table = ScheduledTask.__table__
+        now = datetime.utcnow()
+        result = db.session.execute(
+            table.update().where(
+                table.c.name == name,
+                table.c.next_run_at == due_at,
+                table.c.next_run_at <= now,
+                db.or_(table.c.lease_until.is_(None), table.c.lease_until < now)
+            ).values(lease_owner=self.owner, lease_until=now + timedelta(seconds=self.lease_seconds))
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    def _release(self, name, **values):
+        table = ScheduledTask.__table__
+        db.session.execute(
+            table.update().where(table.c.name == name, table.c.lease_owner == self.owner)
+            .values(lease_owner=None, lease_until=None, **values)
+        )
+        db.session.commit()
+
+    def _dispatch(self, task, due_at):
+        """Encolar la ejecución correspondiente a `due_at` y programar la siguiente"""
+        config = self.app.config
+        prefix = history_key_prefix(task.name)
+        job = job_queue.enqueue(task.kind, task.payload(config),
+                                idempotency_key=f'{prefix}{due_at:%Y%m%dT%H%M%S}')
+
+        interval = task.interval(config)
+        now = datetime.utcnow()
+        self._release(task.name, next_run_at=now + timedelta(seconds=interval) + self._jitter(interval),
+                      last_run_at=now, last_job_id=job.id,
+                      run_count=ScheduledTask.__table__.c.run_count + 1)
+
+        # Historial acotado
+        BackgroundJob.query.filter(
+            BackgroundJob.idempotency_key.like(f'{prefix}%'),
+            BackgroundJob.status.in_(job_queue.FINISHED_STATUSES),
+            BackgroundJob.finished_at < now - timedelta(days=self.history_days),
+            BackgroundJob.id != job.id
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+        self.app.logger.info(f"Mantenimiento '{task.name}' encolado como tarea {job.id}")
+        return job
+
+
+def init_scheduler(app):
+    """Crear el programador de mantenimiento según la configuración de la aplicación"""
+    global _scheduler
+
+    with _scheduler_lock:
+        if not app.config.get('SCHEDULER_ENABLED', True) or job_queue.get_job_queue() is None:
+            _scheduler = None
+            return None
+
+        _scheduler = MaintenanceScheduler(
+            app,
+            poll_interval=app.config.get('SCHEDULER_POLL_INTERVAL', 60),
+            jitter=app.config.get('SCHEDULER_JITTER', 300),
+            lease_seconds=app.config.get('SCHEDULER_LEASE_SECONDS', 120),
+            history_days=app.config.get('SCHEDULER_HISTORY_DAYS', 30)
+        )
+        app.before_request(_scheduler.ensure_started)
+        atexit.register(_scheduler.shutdown)
+        return _scheduler
+
+
+def get_scheduler():
+    return _scheduler
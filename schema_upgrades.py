@@ -0,0 +1,190 @@
+"""
+Actualizaciones de esquema para bases de datos existentes
+
+db.create_all() crea las tablas que faltan pero no modifica las existentes.
+Estas funciones son idempotentes y se ejecutan al inicializar la base de
+datos para añadir columnas e índices nuevos y rellenar sus valores.
+"""
+
+import re
+from datetime import datetime
+from flask import current_app
+from models import DownloadLog, DownloadRollup, FileBlob, GameFile, GameVersion, LogSketch, db
+from utils import version_sort_key
+
+
+def _column_names(table_name):
+    return {column['name'] for column in db.inspect(db.engine).get_columns(table_name)}
+
+
+def _index_names(table_name):
+    return {index['name'] for index in db.inspect(db.engine).get_indexes(table_name)}
+
+
+def add_version_key():
+    """Añadir y rellenar launcher_game_version.version_key"""
+    table = GameVersion.__tablename__
+
+    if 'version_key' not in _column_names(table):
+        db.session.execute(db.text(f'ALTER TABLE {table} ADD COLUMN version_key BIGINT'))
+        db.session.commit()
+        current_app.logger.info(f"Columna version_key añadida a {table}")
+
+    index_name = f'ix_{table}_version_key'
+    if index_name not in _index_names(table):
+        db.session.execute(db.text(f'CREATE INDEX {index_name} ON {table} (version_key)'))
+        db.session.commit()
+
+    pending = db.session.query(GameVersion.id, GameVersion.version).filter(
+        GameVersion.version_key.is_(None)
+    ).all()
+    for version_id, version in pending:
+        key = version_sort_key(version)
+        if key is not None:
+            db.session.execute(
+                GameVersion.__table__.update()
+                .where(GameVersion.id == version_id)
+                .values(version_key=key)
+            )
+    db.session.commit()
+
+    return len(pending)
+
+
+def adopt_blob_store():
+    """Incorporar al almacén por contenido los archivos subidos antes de existir"""
+    if FileBlob.query.first() is not None or GameFile.query.first() is None:
+        return 0
+
+    import blob_store
+    created, missing = blob_store.adopt_flat_files()
+    current_app.logger.info(f"Almacén de blobs inicializado: {created} blobs, {len(missing)} sin contenido")
+    return created
+
+
+def partition_download_log():
+    """Convertir launcher_download_log en tabla particionada por mes y crear las particiones próximas"""
+    import log_partitions
+    log_partitions.convert_to_partitioned()
+    return log_partitions.ensure_partitions()
+
+
+def split_legacy_log_partition():
+    """
+    Encolar el reparto por meses del histórico de la conversión
+    (split_legacy_log_partition), salvo que antes haya que compactarlo
+    """
+    import admin_jobs
+    return admin_jobs.enqueue_legacy_split()
+
+
+def _drop_not_null(table_name, names):
+    """Quitar NOT NULL de las columnas `names` (SQLite no lo admite en ALTER y hay que rehacer la tabla)"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        for name in names:
+            db.session.execute(db.text(f'ALTER TABLE {table_name} ALTER COLUMN {name} DROP NOT NULL'))
+        db.session.commit()
+        return
+
+    if dialect != 'sqlite':
+        # MySQL/MariaDB: MODIFY redefine la columna completa
+        table = db.metadata.tables[table_name]
+        for name in names:
+            column_type = table.c[name].type.compile(dialect=db.engine.dialect)
+            db.session.execute(db.text(f'ALTER TABLE {table_name} MODIFY {name} {column_type} NULL'))
+        db.session.commit()
+        return
+
+    # SQLite: crear la tabla nueva con el mismo DDL sin NOT NULL, copiar las
+    # filas, sustituir la original y recrear sus índices, en una transacción
+    db.session.commit()
+    with db.engine.begin() as connection:
+        create_sql = connection.execute(db.text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table_name}
+        ).scalar()
+        index_sql = connection.execute(db.text(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :name AND sql IS NOT NULL"),
+            {'name': table_name}
+        ).scalars().all()
+
+        for name in names:
+            create_sql = re.sub(rf'(\b{name}\b[^,]*?)\s+NOT NULL', r'\1', create_sql, count=1)
+        temp_name = f'{table_name}_rebuild'
+        create_sql = re.sub(rf'^CREATE TABLE\s+"?{table_name}"?', f'CREATE TABLE {temp_name}', create_sql)
+
+        connection.execute(db.text(f'DROP TABLE IF EXISTS {temp_name}'))
+        connection.execute(db.text(create_sql))
+        connection.execute(db.text(f'INSERT INTO {temp_name} SELECT * FROM {table_name}'))
+        connection.execute(db.text(f'DROP TABLE {table_name}'))
+        connection.execute(db.text(f'ALTER TABLE {temp_name} RENAME TO {table_name}'))
+        for sql in index_sql:
+            connection.execute(db.text(sql))
+
+
+def add_compact_log_columns():
+    """
+    Añadir las columnas compactas a launcher_download_log y encolar la
+    migración por lotes de las filas históricas (tarea compact_download_logs)
+    """
+    table = DownloadLog.__table__
+    existing = _column_names(table.name)
+    for name in ('ip', 'user_agent_id', 'file_id', 'file_type_code'):
+        if name not in existing:
+            column_type = table.c[name].type.compile(dialect=db.engine.dialect)
+            db.session.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {name} {column_type}'))
+            db.session.commit()
+            current_app.logger.info(f"Columna {name} añadida a {table.name}")
+
+    # Las filas compactas dejan a NULL las columnas de texto
+    columns = {column['name']: column for column in db.inspect(db.engine).get_columns(table.name)}
+    not_null = [name for name in ('ip_address', 'file_requested') if not columns[name]['nullable']]
+    if not_null:
+        _drop_not_null(table.name, not_null)
+        current_app.logger.info(f"{table.name}: {', '.join(not_null)} admiten NULL")
+
+    if db.session.query(DownloadLog.id).filter(DownloadLog.file_id.is_(None)).first() is None:
+        return False
+
+    import admin_jobs  # registra el manejador
+    import job_queue
+    job_queue.enqueue('compact_download_logs', idempotency_key='compact_download_logs')
+    return True
+
+
+def backfill_download_stats():
+    """
+    Encolar el recálculo de los agregados y los sketches de descargas (tarea
+    rebuild_rollups) para los LOG_RETENTION_DAYS últimos días si aún no hay
+    ninguno pero sí logs, como ocurre al actualizar desde una versión sin
+    ellos. Solo se recalcula lo que falta.
+
+    Solo se miran y se recalculan los días anteriores al actual: los procesos
+    ya actualizados pueden haber empezado a registrar el de hoy.
+    """
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    include_rollups = DownloadRollup.query.filter(DownloadRollup.bucket < today).first() is None
+    include_sketches = LogSketch.query.filter(LogSketch.bucket < today).first() is None
+    if not (include_rollups or include_sketches) or \
+            db.session.query(DownloadLog.id).filter(DownloadLog.created_at < today).first() is None:
+        return False
+
+    import admin_jobs  # registra el manejador
+    import job_queue
+    job_queue.enqueue('rebuild_rollups', {
+        'days': current_app.config.get('LOG_RETENTION_DAYS', 90),
+        'include_today': False,
+        'include_rollups': include_rollups,
+        'include_sketches': include_sketches
+    }, idempotency_key='backfill_download_stats')
+    return True
+
+
+def upgrade_schema():
+    """Aplicar todas las actualizaciones pendientes"""
+    add_version_key()
+    adopt_blob_store()
+    partition_download_log()
+    add_compact_log_columns()
+    split_legacy_log_partition()
+    backfill_download_stats()
@@ -0,0 +1,377 @@
+"""
+Estadísticas aproximadas de los logs de descarga con sketches
+
+- IPs únicas: HyperLogLog por hora y por día (2^LOG_HLL_PRECISION registros
+  de un byte; error estándar 1.04 / sqrt(registros), 1.6% con 12).
+- Más descargados: Space-Saving de LOG_TOPK_CAPACITY contadores por hora y
+  por día, para archivos y para IPs. Cada contador sobreestima como mucho
+  en su `error`, que se muestra junto al valor.
+
+El escritor de logs (log_writer.py) alimenta los sketches de su proceso con
+cada lote y cada LOG_SKETCH_FLUSH_INTERVAL segundos los fusiona en
+launcher_log_sketch (UPDATE condicional sobre `version`, así varios workers
+fusionan sin perder datos). Las consultas leen unas pocas filas por bucket,
+no la tabla de logs, y añaden lo que este proceso aún no ha volcado.
+"""
+
+import atexit
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from models import DownloadLog, LogSketch, db, normalize_ip
+from rollups import bucket_start
+
+GRANULARITIES = ('hour', 'day')
+
+
+# ==================== HYPERLOGLOG ====================
+
+class HyperLogLog:
+    """Cardinalidad aproximada con 2^precision registros y hash de 64 bits"""
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8', 'replace'), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("No se pueden fusionar HyperLogLog de distinta precisión")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # corrección para rangos pequeños
+        return int(round(estimate))
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def to_bytes(self):
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0], data[1:])
+
+
+# ==================== SPACE-SAVING ====================
+
+class SpaceSaving:
+    """
+    Top-K aproximado: como mucho `capacity` contadores [cuenta, error]. La
+    cuenta real de un elemento está entre cuenta - error y cuenta.
+    """
+
+    def __init__(self, capacity=100, counters=None, total=0):
+        self.capacity = capacity
+        self.counters = counters or {}
+        self.total = total
+
+    def _min_count(self):
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(count for count, _ in self.counters.values())
+
+    def add(self, item, count=1):
+        self.total += count
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [count, 0]
+        else:
+            # Sustituir el menor: el nuevo hereda su cuenta como error
+            victim = min(self.counters, key=lambda key: self.counters[key][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[item] = [floor + count, floor]
+
+    def update(self, counts):
+        for item, count in counts.items():
+            self.add(item, count)
+        return self
+
+    def merge(self, other):
+        """Fusionar dos resúmenes (cada lado aporta su mínimo a lo que no tiene)"""
+        own_floor, other_floor = self._min_count(), other._min_count()
+        merged = {}
+        for item in set(self.counters) | set(other.counters):
+            count, error = self.counters.get(item, (own_floor, own_floor))
+            other_count, other_error = other.counters.get(item, (other_floor, other_floor))
+            merged[item] = [count + other_count, error + other_error]
+        kept = sorted(merged.items(), key=lambda entry: entry[1][0], reverse=True)[:self.capacity]
+        self.counters = dict(kept)
+        self.total += other.total
+        return self
+
+    def top(self, limit=10):
+        """[(elemento, cuenta, error)] de mayor a menor cuenta"""
+        ranked = sorted(self.counters.items(), key=lambda entry: entry[1][0], reverse=True)
+        return [(item, count, error) for item, (count, error) in ranked[:limit]]
+
+    def to_bytes(self):
+        return json.dumps({
+            'capacity': self.capacity,
+            'total': self.total,
+            'counters': [[item, count, error] for item, (count, error) in self.counters.items()]
+        }, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        state = json.loads(bytes(data).decode('utf-8'))
+        counters = {item: [count, error] for item, count, error in state['counters']}
+        return cls(state['capacity'], counters, state['total'])
+
+
+def _load(kind, data):
+    return HyperLogLog.from_bytes(data) if kind == 'unique_ips' else SpaceSaving.from_bytes(data)
+
+
+# ==================== ACUMULACIÓN Y VOLCADO ====================
+
+class SketchAccumulator:
+    """Sketches de este proceso pendientes de fusionar en launcher_log_sketch"""
+
+    def __init__(self, app):
+        self.app = app
+        self.precision = app.config.get('LOG_HLL_PRECISION', 12)
+        self.capacity = app.config.get('LOG_TOPK_CAPACITY', 100)
+        self.flush_interval = app.config.get('LOG_SKETCH_FLUSH_INTERVAL', 60)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def _new(self, kind):
+        return HyperLogLog(self.precision) if kind == 'unique_ips' else SpaceSaving(self.capacity)
+
+    def record(self, records):
+        """Sumar un lote de registros (dicts con ip_address, file_requested, created_at)"""
+        groups = {}
+        for record in records:
+            for granularity in GRANULARITIES:
+                bucket = bucket_start(record['created_at'], granularity)
+                ips, file_counts, ip_counts = groups.setdefault((granularity, bucket), (set(), Counter(), Counter()))
+                ip = normalize_ip(record['ip_address']) or (record['ip_address'] or '')
+                ips.add(ip)
+                file_counts[record['file_requested'] or ''] += 1
+                ip_counts[ip] += 1
+
+        with self._lock:
+            for (granularity, bucket), (ips, file_counts, ip_counts) in groups.items():
+                hll = self._pending.setdefault(('unique_ips', granularity, bucket), self._new('unique_ips'))
+                for ip in ips:
+                    hll.add(ip)
+                self._pending.setdefault(('top_files', granularity, bucket), self._new('top_files')).update(file_counts)
+                self._pending.setdefault(('top_ips', granularity, bucket), self._new('top_ips')).update(ip_counts)
+
+    def pending(self, kind, granularity, since=None):
+        """Copias de lo que este proceso aún no ha volcado en los buckets desde `since`"""
+        with self._lock:
+            return [_load(kind, sketch.to_bytes()) for (k, g, bucket), sketch in self._pending.items()
+                    if k == kind and g == granularity and (since is None or bucket >= since)]
+
+    def flush_if_due(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            return self.flush()
+        return 0
+
+    def flush(self):
+        """Fusionar lo pendiente en la base de datos (requiere contexto de aplicación)"""
+        self._last_flush = time.monotonic()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        failed = {}
+        for key, sketch in pending.items():
+            try:
+                merge_into_store(*key, sketch)
+            except Exception as e:
+                db.session.rollback()
+                failed[key] = sketch
+                self.app.logger.error(f"Error guardando el sketch {key}: {e}")
+
+        if failed:
+            # Se reintenta en el siguiente volcado junto con lo nuevo
+            with self._lock:
+                for key, sketch in failed.items():
+                    current = self._pending.get(key)
+                    self._pending[key] = sketch.merge(current) if current is not None else sketch
+        return len(pending) - len(failed)
+
+
+def merge_into_store(kind, granularity, bucket, sketch, retries=5):
+    """Fusionar `sketch` con la fila persistida (reintenta si otro proceso la cambió a la vez)"""
+    table = LogSketch.__table__
+    key = db.and_(table.c.kind == kind, table.c.granularity == granularity, table.c.bucket == bucket)
+    for _ in range(retries):
+        row = db.session.execute(db.select(table.c.data, table.c.version).where(key)).first()
+        if row is None:
+            try:
+                db.session.execute(table.insert().values(
+                    kind=kind, granularity=granularity, bucket=bucket, data=sketch.to_bytes(),
+                    version=1, updated_at=datetime.utcnow()
+                ))
+                db.session.commit()
+                return
+            except IntegrityError:
+                db.session.rollback()
+                continue
+
+        merged = _load(kind, row.data).merge(sketch)
+        result = db.session.execute(table.update().where(key, table.c.version == row.version).values(
+            data=merged.to_bytes(), version=row.version + 1, updated_at=datetime.utcnow()
+        ))
+        db.session.commit()
+        if result.rowcount == 1:
+            return
+    raise RuntimeError(f"No se pudo fusionar el sketch {kind}/{granularity}/{bucket} tras {retries} intentos")
+
+
+def backfill_sketches(start, end, chunk_size=10000):
+    """
+    Reconstruir los sketches de los días entre `start` y `end` (ambos
+    incluidos) a partir de los logs. Retorna el número de logs procesados.
+    """
+    start = bucket_start(start, 'day')
+    end = bucket_start(end, 'day') + timedelta(days=1)
+
+    LogSketch.query.filter(LogSketch.bucket >= start, LogSketch.bucket < end).delete(synchronize_session=False)
+
+    rows = db.session.query(
+        DownloadLog.ip_address, DownloadLog.file_requested, DownloadLog.created_at
+    ).filter(
+        DownloadLog.created_at >= start,
+        DownloadLog.created_at < end
+    ).yield_per(chunk_size)
+
+    builder = SketchAccumulator(current_app._get_current_object())
+    processed = 0
+    batch = []
+    for row in rows:
+        batch.append(row._asdict())
+        if len(batch) >= chunk_size:
+            builder.record(batch)
+            processed += len(batch)
+            batch = []
+    builder.record(batch)
+    processed += len(batch)
+
+    db.session.commit()
+    builder.flush()
+    return processed
+
+
+def prune_sketches(before):
+    """Eliminar los sketches de buckets anteriores a `before` (sin confirmar la transacción)"""
+    return LogSketch.query.filter(LogSketch.bucket < before).delete(synchronize_session=False)
+
+
+# ==================== CONSULTAS ====================
+
+def _combined(kind, granularity, since=None):
+    """Fusión de los sketches persistidos y pendientes desde `since` (None si no hay datos)"""
+    if since is not None:
+        since = bucket_start(since, granularity)
+    query = db.session.query(LogSketch.data).filter(
+        LogSketch.kind == kind, LogSketch.granularity == granularity
+    )
+    if since is not None:
+        query = query.filter(LogSketch.bucket >= since)
+
+    sketches = [_load(kind, data) for data, in query.all()]
+    if _accumulator is not None:
+        sketches.extend(_accumulator.pending(kind, granularity, since))
+
+    combined = None
+    for sketch in sketches:
+        combined = sketch if combined is None else combined.merge(sketch)
+    return combined
+
+
+def unique_ips(since=None, granularity='hour'):
+    """
+    IPs únicas aproximadas en los buckets desde `since` (todo si es None).
+    Retorna {'value', 'error', 'relative_error'}; `error` es una desviación estándar.
+    """
+    hll = _combined('unique_ips', granularity, since)
+    if hll is None:
+        return {'value': 0, 'error': 0, 'relative_error': 0}
+    value = hll.count()
+    return {'value': value, 'error': int(math.ceil(value * hll.relative_error())),
+            'relative_error': round(hll.relative_error() * 100, 2)}
+
+
+def top_items(kind, since=None, limit=10, granularity='hour'):
+    """[{'item', 'count', 'error'}] más frecuentes (kind: top_files o top_ips)"""
+    summary = _combined(kind, granularity, since)
+    if summary is None:
+        return []
+    return [{'item': item, 'count': count, 'error': error} for item, count, error in summary.top(limit)]
+
+
+# ==================== INICIALIZACIÓN ====================
+
+_accumulator = None
+
+
+def init_sketches(app):
+    """Crear el acumulador de sketches según la configuración de la aplicación"""
+    global _accumulator
+    if not app.config.get('LOG_SKETCHES_ENABLED', True):
+        _accumulator = None
+        return None
+
+    _accumulator = SketchAccumulator(app)
+    # Registrado antes que el escritor de logs: se ejecuta después de que vacíe su cola
+    atexit.register(_flush_at_exit, app)
+    return _accumulator
+
+
+def _flush_at_exit(app):
+    try:
+        with app.app_context():
+            flush_sketches()
+    except Exception as e:
+        app.logger.error(f"Error volcando los sketches de logs: {e}")
+
+
+def get_accumulator():
+    return _accumulator
+
+
+def record_sketches(records):
+    """Sumar registros a los sketches del proceso y volcarlos si toca (requiere contexto de aplicación)"""
+    if _accumulator is not None and records:
+        _accumulator.record(records)
+        _accumulator.flush_if_due()
+
+
+def flush_sketches(due_only=False):
+    """Volcar los sketches pendientes del proceso (requiere contexto de aplicación)"""
+    if _accumulator is None:
+        return 0
+    if due_only:
+        return _accumulator.flush_if_due()
+    return _accumulator.flush()
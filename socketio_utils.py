@@ -60,10 +60,11 @@ def notify_admin(message, type='info', data=None):
 def broadcast_stats_update():
     """Enviar actualización de estadísticas a todos los admins"""
     try:
-        from models import DownloadLog, GameVersion, GameFile, UpdatePackage, NewsMessage
+        from models import GameVersion, GameFile, UpdatePackage, NewsMessage
+        import rollups
         
         stats = {
-            'total_downloads': DownloadLog.query.count(),
+            'total_downloads': rollups.total_downloads(),
             'total_versions': GameVersion.query.count(),
             'total_files': GameFile.query.count(),
             'total_updates': UpdatePackage.query.count(),
@@ -66,19 +66,21 @@ document.addEventListener('DOMContentLoaded', function() {
                     search: '',
                     extension: '',
                     size: '',
-                    page: 1, // Controla la paginación a nivel de API
+                    cursor: null, // Cursor opaco de la API (paginación keyset)
                     per_page: 50, // Controla la paginación a nivel de API
                 },
                 
                 // Paginación (ahora reflejará la API)
                 pagination: {
-                    page: 1,
-                    pages: 1,
                     perPage: 50,
                     total: 0,
+                    totalIsApproximate: false,
                     hasNext: false,
-                    hasPrev: false
+                    hasPrev: false,
+                    nextCursor: null,
+                    prevCursor: null
                 },
+                currentPage: 1,
 
                 // Selección
                 selectedFiles: [],
@@ -145,56 +147,24 @@ document.addEventListener('DOMContentLoaded', function() {
             },
             
             /**
-             * Total de páginas (ahora de la API)
+             * Total de páginas estimado a partir del total de la API (puede ser aproximado)
              */
             totalPages() {
-                return this.pagination.pages;
+                if (!this.pagination.total) return this.currentPage;
+                return Math.max(this.currentPage, Math.ceil(this.pagination.total / this.pagination.perPage));
             },
             
             /**
-             * Páginas visibles en paginación (basado en totalPages de la API)
-             */
-            visiblePages() {
-                const total = this.pagination.pages;
-                const current = this.pagination.page;
-                const pages = [];
-                
-                if (total <= 7) {
-                    for (let i = 1; i <= total; i++) {
-                        pages.push(i);
-                    }
-                } else {
-                    if (current <= 4) {
-                        for (let i = 1; i <= 5; i++) pages.push(i);
-                        pages.push('...');
-                        pages.push(total);
-                    } else if (current >= total - 3) {
-                        pages.push(1);
-                        pages.push('...');
-                        for (let i = total - 4; i <= total; i++) pages.push(i);
-                    } else {
-                        pages.push(1);
-                        pages.push('...');
-                        for (let i = current - 1; i <= current + 1; i++) pages.push(i);
-                        pages.push('...');
-                        pages.push(total);
-                    }
-                }
-                return pages;
-            },
-            
-            /**
-             * Índices para mostrar en paginación (ahora de la API)
+             * Índices para mostrar en paginación
              */
             startIndex() {
-                if (this.pagination.total === 0) return 0;
-                return (this.pagination.page - 1) * this.pagination.perPage + 1;
+                if (this.files.length === 0) return 0;
+                return (this.currentPage - 1) * this.pagination.perPage + 1;
             },
             
             endIndex() {
-                if (this.pagination.total === 0) return 0;
-                const end = this.pagination.page * this.pagination.perPage;
-                return Math.min(end, this.pagination.total);
+                if (this.files.length === 0) return 0;
+                return this.startIndex + this.files.length - 1;
             },
             
             /**
@@ -258,7 +228,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
                 try {
                     const params = {
-                        page: this.filters.page,
+                        cursor: this.filters.cursor,
                         per_page: this.filters.per_page,
                         version_id: this.currentVersionId // Pasar el filtro de versión si existe
                         // Los filtros de búsqueda, extensión y tamaño se aplicarán client-side a 'files'
@@ -284,19 +254,22 @@ document.addEventListener('DOMContentLoaded', function() {
              * Aplicar filtros (debounced para búsqueda) y recargar datos de la API si es necesario
              */
             applyFilters() {
-                // Al cambiar filtros como search, extension, size, la paginación debe resetearse a 1
-                this.filters.page = 1;
                 // Si el filtro de versión cambia (desde el dropdown de Flask), la página se recargaría,
                 // así que esta función solo aplica los filtros locales (search, extension, size).
                 this.updateSelection(); // Re-evaluar selección
             },
             
             /**
-             * Cambiar página y recargar datos de la API
+             * Cambiar de página ('next' o 'prev') usando los cursores de la API
              */
-            changePage(page) {
-                if (page >= 1 && page <= this.pagination.pages && page !== this.pagination.page) {
-                    this.filters.page = page;
+            changePage(direction) {
+                if (direction === 'next' && this.pagination.hasNext) {
+                    this.filters.cursor = this.pagination.nextCursor;
+                    this.currentPage += 1;
+                    this.loadFilesData(); // Volver a cargar datos para la nueva página
+                } else if (direction === 'prev' && this.pagination.hasPrev) {
+                    this.filters.cursor = this.pagination.prevCursor;
+                    this.currentPage -= 1;
                     this.loadFilesData(); // Volver a cargar datos para la nueva página
                 }
             },
@@ -2,11 +2,16 @@ import os
 import hashlib
 import zipfile
 from datetime import datetime
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import namedtuple
 from flask import current_app, flash, request,redirect, url_for
 from werkzeug.utils import secure_filename
 import shutil
 import json
+import uuid
+from parallel_zip import compile_excludes, write_zip
+
+HASH_CHUNK_SIZE = 1024 * 1024  # 1MB por lectura/escritura
 
 def calculate_file_hash(file_path, algorithm='md5'):
     """Calcular hash de un archivo"""
@@ -14,13 +19,94 @@ def calculate_file_hash(file_path, algorithm='md5'):
     
     try:
         with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
                 hash_algo.update(chunk)
         return hash_algo.hexdigest()
     except Exception as e:
         current_app.logger.error(f"Error calculating {algorithm} for {file_path}: {e}")
         return None
 
+class SavedUpload(namedtuple('SavedUpload', 'path size digests blocks', defaults=(None,))):
+    """
+    Resultado de save_upload: ruta final, tamaño en bytes, hashes por
+    algoritmo y, si se pidieron, los hashes por bloque concatenados (bytes)
+    """
+
+    @property
+    def md5(self):
+        return self.digests.get('md5')
+
+BLOCK_HASH_ALGORITHM = 'blake2b-128'
+
+class BlockHasher:
+    """
+    Hashes BLAKE2b de 16 bytes por bloque fijo, alimentados con trozos de
+    cualquier tamaño (los bloques no tienen que coincidir con las lecturas)
+    """
+
+    digest_size = 16
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._digests = bytearray()
+        self._current = hashlib.blake2b(digest_size=self.digest_size)
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.block_size - self._filled)
+            self._current.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.block_size:
+                self._digests += self._current.digest()
+                self._current = hashlib.blake2b(digest_size=self.digest_size)
+                self._filled = 0
+
+    def digest(self):
+        """Hashes concatenados, incluido el último bloque incompleto"""
+        if self._filled:
+            return bytes(self._digests) + self._current.digest()
+        return bytes(self._digests)
+
+def save_upload(stream, target_path, algorithms=('md5',), chunk_size=HASH_CHUNK_SIZE, block_size=None):
+    """
+    Guardar un flujo subido calculando sus hashes en la misma pasada.
+
+    Se escribe en bloques grandes a un temporal junto al destino y se renombra
+    de forma atómica al terminar, así que nunca queda un archivo a medias en
+    `target_path` y no hace falta releerlo para obtener el tamaño o los hashes.
+    Con `block_size` se calculan además los hashes por bloque (BlockHasher).
+    """
+    digests = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    blocks = BlockHasher(block_size) if block_size else None
+    directory = os.path.dirname(target_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f'.{os.path.basename(target_path)}.{uuid.uuid4().hex}.part')
+
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                for digest in digests.values():
+                    digest.update(chunk)
+                if blocks is not None:
+                    blocks.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return SavedUpload(target_path, size, {name: digest.hexdigest() for name, digest in digests.items()},
+                       blocks.digest() if blocks is not None else None)
+
 def allowed_file(filename, file_type='file'):
     """Verificar si el archivo tiene una extensión permitida"""
     if not filename or '.' not in filename:
@@ -52,73 +138,119 @@ def format_file_size(size_bytes):
     return f"{size_bytes:.1f} PB"
 
 def validate_version_format(version_string):
-    """Validar formato de versión (X.Y.Z.W)"""
+    """
+    Validar formato de versión (X.Y.Z.W): cuatro números no negativos que
+    quepan en la clave de ordenación (X hasta 32767, el resto hasta 65535)
+    """
     try:
-        parts = version_string.split('.')
-        if len(parts) != 4:
+        if len(version_string.split('.')) != 4:
             return False
-        
-        # Verificar que todas las partes sean números
-        for part in parts:
-            int(part)
-        
-        return True
-    except:
+    except AttributeError:
         return False
+    
+    parsed = parse_version(version_string)
+    return parsed is not None and parsed.sort_key is not None
+
+# Bits por componente en la clave numérica de versión (X.Y.Z.W -> entero de 64 bits)
+VERSION_PART_BITS = 16
+VERSION_PART_MAX = (1 << VERSION_PART_BITS) - 1
+
+class ParsedVersion(namedtuple('ParsedVersion', 'major minor patch build')):
+    """Versión X.Y.Z.W ya separada en enteros; se compara como tupla"""
+    __slots__ = ()
+    
+    @property
+    def sort_key(self):
+        """Clave entera ordenable, o None si algún componente no cabe en 16 bits"""
+        if self.major > VERSION_PART_MAX >> 1 or any(part > VERSION_PART_MAX for part in self[1:]):
+            return None
+        key = 0
+        for part in self:
+            key = (key << VERSION_PART_BITS) | part
+        return key
+    
+    def __str__(self):
+        return '.'.join(str(part) for part in self)
+
+@lru_cache(maxsize=4096)
+def parse_version(version_string):
+    """Parsear una versión (rellenando con ceros hasta 4 partes). Retorna None si no es válida"""
+    try:
+        parts = [int(x) for x in version_string.split('.')]
+    except (AttributeError, ValueError):
+        return None
+    
+    if not 1 <= len(parts) <= 4 or any(part < 0 for part in parts):
+        return None
+    
+    # Rellenar con ceros si es necesario
+    parts.extend([0] * (4 - len(parts)))
+    return ParsedVersion(*parts)
+
+def version_sort_key(version_string):
+    """Clave entera de ordenación de una versión X.Y.Z.W, o None si no es válida"""
+    parsed = parse_version(version_string)
+    return parsed.sort_key if parsed else None
 
 def compare_versions(version1, version2):
     """Comparar dos versiones. Retorna -1, 0, 1"""
-    try:
-        v1_parts = [int(x) for x in version1.split('.')]
-        v2_parts = [int(x) for x in version2.split('.')]
-        
-        # Rellenar con ceros si es necesario
-        while len(v1_parts) < 4:
-            v1_parts.append(0)
-        while len(v2_parts) < 4:
-            v2_parts.append(0)
-        
-        for i in range(4):
-            if v1_parts[i] < v2_parts[i]:
-                return -1
-            elif v1_parts[i] > v2_parts[i]:
-                return 1
-        
-        return 0
-    except:
+    v1 = parse_version(version1)
+    v2 = parse_version(version2)
+    
+    if v1 is None or v2 is None:
         return 0
+    
+    return (v1 > v2) - (v1 < v2)
 
-def create_zip_archive(source_path, zip_path, exclude_patterns=None):
-    """Crear archivo ZIP desde un directorio"""
-    exclude_patterns = exclude_patterns or []
+def create_zip_archive(source_path, zip_path, exclude_patterns=None, compress_level=None,
+                       max_workers=None, executor=None):
+    """
+    Crear archivo ZIP desde un directorio o un archivo.
+
+    Los miembros se comprimen en paralelo (ver parallel_zip.write_zip) y se
+    escriben ordenados por ruta, así que el mismo árbol produce siempre el
+    mismo orden. Los patrones de exclusión se compilan en una sola expresión.
+    """
+    config = current_app.config
+    compress_level = config.get('ZIP_COMPRESS_LEVEL', 6) if compress_level is None else compress_level
+    max_workers = max_workers or config.get('ZIP_WORKERS') or None
+    executor = executor or config.get('ZIP_EXECUTOR', 'process')
     
     try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            if os.path.isfile(source_path):
-                # Si es un archivo individual
-                zipf.write(source_path, os.path.basename(source_path))
-            else:
-                # Si es un directorio
-                for root, dirs, files in os.walk(source_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        relative_path = os.path.relpath(file_path, source_path)
-                        
-                        # Verificar patrones de exclusión
-                        should_exclude = False
-                        for pattern in exclude_patterns:
-                            if pattern in relative_path:
-                                should_exclude = True
-                                break
-                        
-                        if not should_exclude:
-                            zipf.write(file_path, relative_path)
+        if os.path.isfile(source_path):
+            # Si es un archivo individual
+            members = [(source_path, os.path.basename(source_path))]
+        else:
+            # Si es un directorio
+            is_excluded = compile_excludes(exclude_patterns)
+            members = []
+            for root, dirs, files in os.walk(source_path):
+                dirs.sort()
+                for file in sorted(files):
+                    file_path = os.path.join(root, file)
+                    relative_path = os.path.relpath(file_path, source_path).replace(os.sep, '/')
+                    if not is_excluded(relative_path):
+                        members.append((file_path, relative_path))
         
+        write_zip(zip_path, members, compress_level, max_workers, executor)
         return True
     except Exception as e:
         current_app.logger.error(f"Error creating ZIP archive: {e}")
         return False
 
+def safe_archive_path(member_name):
+    """
+    Ruta relativa normalizada ('/' como separador) de un miembro de un ZIP,
+    o None si es absoluta o intenta salir del directorio de destino.
+    """
+    name = member_name.replace('\\', '/')
+    if name.startswith('/') or (len(name) > 1 and name[1] == ':'):
+        return None
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        return None
+    return '/'.join(parts)
+
 def extract_zip_archive(zip_path, extract_to, overwrite=True):
     """Extraer archivo ZIP"""
     try:
@@ -133,10 +265,11 @@ def extract_zip_archive(zip_path, extract_to, overwrite=True):
             # Extraer archivos
             for member in zipf.infolist():
                 # Prevenir path traversal attacks
-                if ".." in member.filename or member.filename.startswith("/"):
+                member_path = safe_archive_path(member.filename)
+                if member_path is None or member.is_dir():
                     continue
                 
-                target_path = os.path.join(extract_to, member.filename)
+                target_path = os.path.join(extract_to, *member_path.split('/'))
                 
                 # Verificar si el archivo ya existe
                 if os.path.exists(target_path) and not overwrite: